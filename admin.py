@@ -6,6 +6,7 @@ from telegram.ext import ContextTypes
 from config import ADMIN_IDS
 from db import get_stats, get_bookings_by_date
 from helpers import format_day
+from metrics import timed
 
 logger = logging.getLogger("excursion_bot")
 
@@ -14,6 +15,7 @@ def is_admin(user_id: int) -> bool:
     return user_id in ADMIN_IDS
 
 
+@timed("handler")
 async def admin_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not is_admin(update.effective_user.id):
         await update.message.reply_text("⛔ Нет доступа.")
@@ -26,6 +28,7 @@ async def admin_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text("🔧 Админ-панель", reply_markup=keyboard)
 
 
+@timed("handler")
 async def admin_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     q = update.callback_query
     await q.answer()
@@ -0,0 +1,185 @@
+"""Moves past days, their slots and bookings, and old finished broadcasts to
+the archive database (ARCHIVE_DB_PATH), so hot tables hold current data only.
+
+Rows are copied into the ATTACHed archive and deleted from the main database
+in batches of BATCH_SIZE, one short transaction each. WAL transactions are
+not atomic across attached files, so the copy is INSERT OR IGNORE: a batch
+interrupted between the two commits is simply redone on the next run.
+day_stats / slot_stats and booking_events stay in the main database as
+history; archiving is not a cancellation and does not touch them.
+"""
+
+import logging
+import time
+from datetime import datetime, timedelta, timezone
+
+from config import ARCHIVE_DB_PATH, BROADCAST_ARCHIVE_DAYS
+from db import _connect, _iter_rows
+from metrics import Counter, timed
+
+logger = logging.getLogger("excursion_bot")
+
+ROWS_ARCHIVED = Counter("excursion_rows_archived_total", "Rows moved to the archive database", ("table",))
+
+BATCH_SIZE = 500
+BATCH_PAUSE = 0.05  # seconds between batches, lets bookings in
+
+ARCHIVE_SCHEMA = [
+    """CREATE TABLE IF NOT EXISTS archive.days (
+        id INTEGER PRIMARY KEY,
+        date TEXT NOT NULL,
+        capacity_day INTEGER NOT NULL
+    )""",
+    """CREATE TABLE IF NOT EXISTS archive.time_slots (
+        id INTEGER PRIMARY KEY,
+        day_id INTEGER NOT NULL,
+        time TEXT NOT NULL,
+        capacity_time INTEGER NOT NULL
+    )""",
+    """CREATE TABLE IF NOT EXISTS archive.bookings (
+        id INTEGER PRIMARY KEY,
+        telegram_user_id INTEGER NOT NULL,
+        name TEXT NOT NULL,
+        persons INTEGER NOT NULL,
+        day_id INTEGER NOT NULL,
+        time_slot_id INTEGER NOT NULL,
+        created_at TEXT NOT NULL,
+        reminder_sent INTEGER DEFAULT 0,
+        phone TEXT
+    )""",
+    "CREATE INDEX IF NOT EXISTS archive.idx_bookings_day_id ON bookings(day_id)",
+    "CREATE INDEX IF NOT EXISTS archive.idx_bookings_user ON bookings(telegram_user_id)",
+    """CREATE TABLE IF NOT EXISTS archive.broadcasts (
+        id INTEGER PRIMARY KEY,
+        text TEXT NOT NULL,
+        image_path TEXT,
+        button_text TEXT,
+        button_url TEXT,
+        status TEXT NOT NULL,
+        scheduled_at TEXT,
+        sent_at TEXT,
+        completed_at TEXT,
+        total INTEGER DEFAULT 0,
+        success INTEGER DEFAULT 0,
+        failed INTEGER DEFAULT 0,
+        created_at TEXT NOT NULL
+    )""",
+]
+
+# Listed explicitly: older databases got some columns by ALTER TABLE
+COLUMNS = {
+    "days": "id, date, capacity_day",
+    "time_slots": "id, day_id, time, capacity_time",
+    "bookings": "id, telegram_user_id, name, persons, day_id, time_slot_id, created_at, reminder_sent, phone",
+    "broadcasts": "id, text, image_path, button_text, button_url, status, scheduled_at, sent_at, "
+                  "completed_at, total, success, failed, created_at",
+}
+
+# table -> query for the next batch of ids to move (parameters: cutoff, limit)
+_BATCHES = {
+    "bookings": """
+        SELECT b.id FROM bookings b JOIN days d ON d.id = b.day_id
+        WHERE d.date < ? LIMIT ?
+    """,
+    "time_slots": """
+        SELECT ts.id FROM time_slots ts JOIN days d ON d.id = ts.day_id
+        WHERE d.date < ?
+          AND NOT EXISTS (SELECT 1 FROM bookings WHERE time_slot_id = ts.id)
+        LIMIT ?
+    """,
+    "days": """
+        SELECT d.id FROM days d
+        WHERE d.date < ?
+          AND NOT EXISTS (SELECT 1 FROM time_slots WHERE day_id = d.id)
+          AND NOT EXISTS (SELECT 1 FROM bookings WHERE day_id = d.id)
+        LIMIT ?
+    """,
+    "broadcasts": """
+        SELECT id FROM broadcasts
+        WHERE status IN ('completed', 'failed') AND created_at < ?
+        LIMIT ?
+    """,
+}
+
+
+def _attach(conn):
+    conn.execute("ATTACH DATABASE ? AS archive", (ARCHIVE_DB_PATH,))
+    conn.execute("PRAGMA archive.journal_mode = WAL")
+    for statement in ARCHIVE_SCHEMA:
+        conn.execute(statement)
+
+
+def _move(conn, table: str, cutoff: str) -> int:
+    moved = 0
+    while True:
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            ids = [row[0] for row in conn.execute(_BATCHES[table], (cutoff, BATCH_SIZE))]
+            if ids:
+                marks = ",".join("?" * len(ids))
+                conn.execute(f"""
+                    INSERT OR IGNORE INTO archive.{table} ({COLUMNS[table]})
+                    SELECT {COLUMNS[table]} FROM main.{table} WHERE id IN ({marks})
+                """, ids)
+                conn.execute(f"DELETE FROM main.{table} WHERE id IN ({marks})", ids)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        moved += len(ids)
+        if len(ids) < BATCH_SIZE:
+            return moved
+        time.sleep(BATCH_PAUSE)
+
+
+@timed("job")
+def run_archival() -> dict:
+    """Archive everything dated before today and broadcasts older than
+    BROADCAST_ARCHIVE_DAYS. Returns rows moved per table."""
+    today = datetime.now().strftime("%Y-%m-%d")
+    broadcast_cutoff = (datetime.now(timezone.utc) - timedelta(days=BROADCAST_ARCHIVE_DAYS)).strftime("%Y-%m-%d %H:%M:%S")
+    conn = _connect()
+    try:
+        _attach(conn)
+        # Children first: bookings reference slots and days
+        moved = {
+            "bookings": _move(conn, "bookings", today),
+            "time_slots": _move(conn, "time_slots", today),
+            "days": _move(conn, "days", today),
+            "broadcasts": _move(conn, "broadcasts", broadcast_cutoff),
+        }
+        # Holds on archived slots can only be expired ones
+        conn.execute("DELETE FROM seat_holds WHERE time_slot_id NOT IN (SELECT id FROM time_slots)")
+        conn.commit()
+    finally:
+        conn.close()
+
+    for table, count in moved.items():
+        if count:
+            ROWS_ARCHIVED.inc(table, amount=count)
+    if any(moved.values()):
+        logger.info("Archived %s", moved)
+    return moved
+
+
+def iter_booking_history(date_from: str | None = None, date_to: str | None = None):
+    """Current and archived bookings in a date range, for reports."""
+    date_from = date_from or "0000-00-00"
+    date_to = date_to or "9999-99-99"
+    columns = """b.id, d.date, ts.time, b.name, b.phone, b.persons, b.telegram_user_id, b.created_at"""
+    conn = _connect(check_same_thread=False)
+    _attach(conn)
+    yield from _iter_rows(f"""
+        SELECT {columns}, 'active' AS status
+        FROM main.bookings b
+        JOIN main.days d ON d.id = b.day_id
+        JOIN main.time_slots ts ON ts.id = b.time_slot_id
+        WHERE d.date BETWEEN :date_from AND :date_to
+        UNION ALL
+        SELECT {columns}, 'archived'
+        FROM archive.bookings b
+        JOIN archive.days d ON d.id = b.day_id
+        JOIN archive.time_slots ts ON ts.id = b.time_slot_id
+        WHERE d.date BETWEEN :date_from AND :date_to
+        ORDER BY 2, 3, 8
+    """, {"date_from": date_from, "date_to": date_to}, conn=conn)
@@ -0,0 +1,195 @@
+"""Online backups of the SQLite databases with the SQLite backup API.
+
+The copy is made BACKUP_PAGES pages per step with a BACKUP_STEP_SLEEP pause
+between steps, so each step holds its read snapshot only briefly and the
+bot's writes go on in between. If another connection writes during the
+backup, SQLite restarts the copy on the next step; after MAX_RESTARTS the
+rest is copied in one step (in WAL mode a reader does not block writers, it
+only holds back checkpoints for that step).
+
+Each snapshot is gzipped to BACKUP_DIR as <name>-YYYYmmdd-HHMMSS.db.gz; the
+newest BACKUP_KEEP per database are kept.
+
+Usage:
+    python backup.py                 # snapshot now
+    python backup.py verify [file]   # restore a snapshot to a temp file and check it
+    # or inside Docker:
+    docker compose exec bot python backup.py verify
+"""
+
+import argparse
+import glob
+import gzip
+import logging
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+from config import DB_PATH, ARCHIVE_DB_PATH, BACKUP_DIR, BACKUP_KEEP, BACKUP_PAGES, BACKUP_STEP_SLEEP
+from connection import connect
+from metrics import Gauge, timed
+
+logger = logging.getLogger("excursion_bot")
+
+BACKUP_LAST_SUCCESS = Gauge("excursion_backup_last_success_timestamp", "Unix time of the last successful backup")
+BACKUP_LAST_SECONDS = Gauge("excursion_backup_last_duration_seconds", "Duration of the last backup of the main database")
+BACKUP_LAST_BYTES = Gauge("excursion_backup_last_size_bytes", "Compressed size of the last backup of the main database")
+
+MAX_RESTARTS = 5
+VERIFY_TABLES = ("days", "time_slots", "bookings", "subscribers", "broadcasts")
+
+
+class _TooManyRestarts(Exception):
+    pass
+
+
+def _snapshot_name(db_path: str, stamp: str) -> str:
+    name = os.path.splitext(os.path.basename(db_path))[0]
+    return os.path.join(BACKUP_DIR, f"{name}-{stamp}.db.gz")
+
+
+def _copy(db_path: str, target: str) -> dict:
+    """Copy db_path to the plain SQLite file target, step by step."""
+    progress = {"steps": 0, "restarts": 0, "pages": 0, "remaining": None}
+
+    def on_step(status, remaining, total):
+        progress["steps"] += 1
+        progress["pages"] = total
+        if progress["remaining"] is not None and remaining > progress["remaining"]:
+            progress["restarts"] += 1
+            if progress["restarts"] >= MAX_RESTARTS:
+                raise _TooManyRestarts()
+        progress["remaining"] = remaining
+        if remaining:
+            time.sleep(BACKUP_STEP_SLEEP)
+
+    source = connect(db_path)
+    dest = sqlite3.connect(target)
+    try:
+        try:
+            source.backup(dest, pages=BACKUP_PAGES, progress=on_step)
+        except _TooManyRestarts:
+            logger.warning("Backup of %s restarted %d times, copying in one step", db_path, progress["restarts"])
+            source.backup(dest)
+    finally:
+        dest.close()
+        source.close()
+    return progress
+
+
+def _backup_one(db_path: str, stamp: str) -> dict:
+    started = time.monotonic()
+    target = _snapshot_name(db_path, stamp)
+    fd, plain = tempfile.mkstemp(dir=BACKUP_DIR, suffix=".db")
+    os.close(fd)
+    try:
+        progress = _copy(db_path, plain)
+        with open(plain, "rb") as src, gzip.open(target + ".part", "wb", compresslevel=6) as dst:
+            shutil.copyfileobj(src, dst, 1024 * 1024)
+        os.replace(target + ".part", target)
+    finally:
+        for path in (plain, target + ".part"):
+            if os.path.exists(path):
+                os.remove(path)
+
+    seconds = time.monotonic() - started
+    result = {
+        "file": target,
+        "seconds": seconds,
+        "pages": progress["pages"],
+        "pages_per_sec": progress["pages"] / seconds if seconds else 0.0,
+        "restarts": progress["restarts"],
+        "bytes": os.path.getsize(target),
+    }
+    logger.info(
+        "Backup %s: %d pages in %.1fs (%.0f pages/s, %d restarts), %d bytes",
+        target, result["pages"], seconds, result["pages_per_sec"], result["restarts"], result["bytes"],
+    )
+    return result
+
+
+def _prune(db_path: str):
+    pattern = _snapshot_name(db_path, "*")
+    for path in sorted(glob.glob(pattern), reverse=True)[BACKUP_KEEP:]:
+        os.remove(path)
+        logger.info("Old backup removed: %s", path)
+
+
+@timed("job")
+def run_backup() -> list[dict]:
+    """Snapshot the main and archive databases, then drop old snapshots."""
+    os.makedirs(BACKUP_DIR, exist_ok=True)
+    stamp = datetime.now().strftime("%Y%m%d-%H%M%S")
+    results = []
+    for db_path in (DB_PATH, ARCHIVE_DB_PATH):
+        if not os.path.exists(db_path):
+            continue
+        results.append(_backup_one(db_path, stamp))
+        _prune(db_path)
+
+    BACKUP_LAST_SUCCESS.set(time.time())
+    if results:
+        BACKUP_LAST_SECONDS.set(results[0]["seconds"])
+        BACKUP_LAST_BYTES.set(results[0]["bytes"])
+    return results
+
+
+def latest_backup(db_path: str = DB_PATH) -> str | None:
+    snapshots = sorted(glob.glob(_snapshot_name(db_path, "*")))
+    return snapshots[-1] if snapshots else None
+
+
+def verify_backup(path: str) -> dict:
+    """Restore a snapshot into a temp file and check it opens and is intact.
+
+    Returns {"ok", "integrity", "tables": {name: rows}}.
+    """
+    fd, plain = tempfile.mkstemp(suffix=".db")
+    os.close(fd)
+    try:
+        with gzip.open(path, "rb") as src, open(plain, "wb") as dst:
+            shutil.copyfileobj(src, dst, 1024 * 1024)
+        conn = sqlite3.connect(plain)
+        try:
+            integrity = conn.execute("PRAGMA integrity_check").fetchone()[0]
+            existing = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+            tables = {
+                table: conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+                for table in VERIFY_TABLES if table in existing
+            }
+        finally:
+            conn.close()
+    finally:
+        os.remove(plain)
+    return {"ok": integrity == "ok", "integrity": integrity, "tables": tables}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Резервные копии базы")
+    commands = parser.add_subparsers(dest="command")
+    verify = commands.add_parser("verify")
+    verify.add_argument("file", nargs="?")
+    args = parser.parse_args()
+
+    if args.command == "verify":
+        path = args.file or latest_backup()
+        if path is None:
+            print(f"No backups in {BACKUP_DIR}")
+            sys.exit(1)
+        report = verify_backup(path)
+        print(f"{path}: integrity {report['integrity']}")
+        for table, rows in report["tables"].items():
+            print(f"  {table}: {rows}")
+        sys.exit(0 if report["ok"] else 1)
+
+    for result in run_backup():
+        print(f"{result['file']}: {result['pages']} pages, {result['seconds']:.1f}s, "
+              f"{result['pages_per_sec']:.0f} pages/s, {result['bytes']} bytes")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,134 @@
+"""Each user's current booking, kept in the bot's memory.
+
+"Записаться" and "Моя запись" start by asking whether the user has a
+booking, and most of the users who ask have none. The cache keeps the answer
+per user: the booking row, or None for "no booking" (a negative entry),
+bounded by BOOKING_CACHE_SIZE users in LRU order.
+
+It only serves reads. Writes always go to the database (a cancel runs its
+DELETE even if the cache says there is nothing to delete) and then set the
+entry from what the database answered. Changes made elsewhere (admin
+cancellations from the web admin or the admin menu) arrive through the
+booking_events feed: the tail drops the user's entry unless it already
+matches the event. Entries live at most BOOKING_CACHE_TTL seconds, which
+bounds anything the feed does not carry (a hand-edited database), and a
+positive entry for a past day counts as a miss, because archival moves such
+bookings out without writing events.
+"""
+
+import asyncio
+import threading
+import time
+from collections import OrderedDict
+from datetime import date
+
+from cache_sync import CACHE_REQUESTS
+from config import BOOKING_CACHE_SIZE, BOOKING_CACHE_TTL
+from db import get_user_booking
+from events import EventTail
+from metrics import Gauge
+
+_NAME = "user_booking"
+
+
+class BookingCache:
+    def __init__(self, maxsize: int = BOOKING_CACHE_SIZE, ttl: float = BOOKING_CACHE_TTL):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: OrderedDict = OrderedDict()  # user_id -> (booking or None, expires_at)
+        self._lock = threading.Lock()
+        # Bumped by every invalidation; a load that overlapped one is not stored
+        self._epoch = 0
+        self.hits = 0
+        self.misses = 0
+        self._tail: EventTail | None = None
+        self._worker: asyncio.Task | None = None
+
+    def get(self, user_id: int):
+        """The user's booking (name, persons, phone, date, time), or None."""
+        with self._lock:
+            try:
+                booking, expires_at = self._data[user_id]
+            except KeyError:
+                pass
+            else:
+                if expires_at > time.monotonic() and (booking is None or booking["date"] >= date.today().isoformat()):
+                    self._data.move_to_end(user_id)
+                    self.hits += 1
+                    CACHE_REQUESTS.inc(_NAME, "hit")
+                    return booking
+            self.misses += 1
+            epoch = self._epoch
+        CACHE_REQUESTS.inc(_NAME, "miss")
+
+        row = get_user_booking(user_id)
+        booking = dict(row) if row is not None else None
+        with self._lock:
+            if epoch == self._epoch:
+                self._store(user_id, booking)
+        return booking
+
+    def has_booking(self, user_id: int) -> bool:
+        return self.get(user_id) is not None
+
+    def set(self, user_id: int, booking: dict | None):
+        """Record what the database answered to the bot's own write: the new booking,
+        or None after a cancellation."""
+        with self._lock:
+            self._store(user_id, booking)
+
+    def invalidate(self, user_id: int):
+        with self._lock:
+            self._epoch += 1
+            self._data.pop(user_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._epoch += 1
+            self._data.clear()
+
+    def _store(self, user_id: int, booking: dict | None):
+        self._data[user_id] = (booking, time.monotonic() + self.ttl)
+        self._data.move_to_end(user_id)
+        if len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def _apply_event(self, event):
+        user_id = event["telegram_user_id"]
+        with self._lock:
+            if user_id not in self._data:
+                return
+            booking = self._data[user_id][0]
+            # The bot's own writes come back through the feed too and are already applied
+            if event["kind"] == "cancelled" and booking is None:
+                return
+            if (event["kind"] == "booked" and booking is not None
+                    and (booking["date"], booking["time"]) == (event["date"], event["time"])):
+                return
+        self.invalidate(user_id)
+
+    def hit_ratio(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def start(self, interval: float = 1.0):
+        """Follow booking_events from now on; entries cached before are dropped."""
+        if self._worker is None or self._worker.done():
+            self.clear()
+            self._tail = EventTail(None, self._apply_event)
+            self._worker = asyncio.create_task(self._tail.run(interval), name="booking_cache")
+
+    async def stop(self):
+        if self._worker is None:
+            return
+        self._worker.cancel()
+        self._worker = None
+        self._tail.close()
+        self._tail = None
+
+
+booking_cache = BookingCache()
+
+Gauge("excursion_booking_cache_hit_ratio", "Share of booking lookups answered from the per-user cache",
+      booking_cache.hit_ratio)
+Gauge("excursion_booking_cache_entries", "Users in the per-user booking cache", lambda: len(booking_cache._data))
@@ -0,0 +1,134 @@
+import asyncio
+import logging
+
+from config import BOOKING_QUEUE_MAX, BOOKING_BATCH_MAX
+from db import create_bookings
+from metrics import Counter, Gauge, Histogram
+
+logger = logging.getLogger("excursion_bot")
+
+BOOKINGS_REJECTED = Counter("excursion_bookings_rejected_total", "Booking attempts rejected because the queue was full")
+BOOKING_BATCH_SIZE = Histogram(
+    "excursion_booking_batch_size", "Booking attempts confirmed per transaction",
+    buckets=(1, 2, 5, 10, 20, 50, 100, 200, 500),
+)
+
+
+class BookingQueueFull(Exception):
+    """Too many bookings are waiting; the user should try again a bit later."""
+
+
+# Queued by stop(): the worker confirms everything before it and exits
+_STOP = object()
+
+
+class BookingAdmission:
+    """Queues booking attempts and confirms them in micro-batches.
+
+    A single worker takes everything queued while the previous batch was
+    committing (up to `max_batch`) and confirms it in one write transaction,
+    so a flash crowd costs a few BEGIN IMMEDIATE's instead of hundreds of them
+    piling up on the busy timeout. Beyond `max_queue` waiting attempts new ones
+    are rejected right away.
+    """
+
+    def __init__(self, max_queue: int, max_batch: int):
+        self._queue: asyncio.Queue = asyncio.Queue(maxsize=max_queue)
+        self._max_batch = max_batch
+        self._worker: asyncio.Task | None = None
+        self._closing = False
+
+        self.rejected = 0
+        self.batches = 0
+        self.confirmed = 0
+        self.largest_batch = 0
+
+    def start(self):
+        self._closing = False
+        if self._worker is None or self._worker.done():
+            self._worker = asyncio.create_task(self._run(), name="booking_admission")
+
+    async def stop(self):
+        """Stop taking new attempts, let the worker confirm the queued ones and exit.
+        A batch already committing is never cancelled: its users get their result."""
+        self._closing = True
+        worker, self._worker = self._worker, None
+        if worker is not None:
+            if not worker.done():
+                await self._queue.put(_STOP)
+            try:
+                await worker
+            except Exception:
+                logger.exception("Booking worker failed")
+        # Only left if the worker died: answer them instead of leaving handlers waiting
+        while not self._queue.empty():
+            item = self._queue.get_nowait()
+            if item is not _STOP and not item[1].done():
+                item[1].set_exception(BookingQueueFull())
+
+    async def book(self, user_id: int, name: str, persons: int, day_id: int,
+                   time_slot_id: int, phone: str):
+        """Returns (success, date_str, time_str) like db.create_booking."""
+        if self._closing:
+            raise BookingQueueFull()
+        self.start()
+        future = asyncio.get_running_loop().create_future()
+        try:
+            self._queue.put_nowait(((user_id, name, persons, day_id, time_slot_id, phone), future))
+        except asyncio.QueueFull:
+            self.rejected += 1
+            BOOKINGS_REJECTED.inc()
+            raise BookingQueueFull() from None
+        return await future
+
+    async def _run(self):
+        while True:
+            item = await self._queue.get()
+            if item is _STOP:
+                return
+            batch = [item]
+            stopping = False
+            while len(batch) < self._max_batch and not self._queue.empty():
+                item = self._queue.get_nowait()
+                if item is _STOP:
+                    stopping = True
+                    break
+                batch.append(item)
+
+            await self._confirm(batch)
+            if stopping:
+                return
+
+    async def _confirm(self, batch: list):
+        try:
+            results = await asyncio.to_thread(create_bookings, [request for request, _ in batch])
+        except Exception as e:
+            logger.exception("Booking batch of %d failed", len(batch))
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        self.batches += 1
+        self.largest_batch = max(self.largest_batch, len(batch))
+        BOOKING_BATCH_SIZE.observe(len(batch))
+        for (_, future), result in zip(batch, results):
+            if result[0]:
+                self.confirmed += 1
+            if not future.done():
+                future.set_result(result)
+
+    def stats(self) -> dict:
+        return {
+            "queued": self._queue.qsize(),
+            "rejected": self.rejected,
+            "batches": self.batches,
+            "confirmed": self.confirmed,
+            "largest_batch": self.largest_batch,
+        }
+
+
+booking_admission = BookingAdmission(BOOKING_QUEUE_MAX, BOOKING_BATCH_MAX)
+
+Gauge("excursion_booking_queue_depth", "Booking attempts waiting for a transaction",
+      lambda: booking_admission.stats()["queued"])
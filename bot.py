@@ -1,3 +1,5 @@
+import math
+
 from telegram import (
     Update,
     ReplyKeyboardMarkup,
@@ -15,23 +17,37 @@ from telegram.ext import (
     filters,
 )
 
-from config import BOT_TOKEN
+from config import (
+    BOT_TOKEN,
+    BOT_METRICS_PORT,
+    UPDATE_CONCURRENCY,
+    SESSION_FLUSH_INTERVAL,
+    SEAT_HOLD_TTL,
+)
 from db import (
     init_db,
-    user_has_booking,
-    get_available_days,
     get_available_times,
-    get_user_booking,
-    create_booking,
     cancel_user_booking,
+    hold_seats,
+    release_seat_hold,
     upsert_subscriber,
     update_subscriber_phone,
     update_subscriber_status,
 )
-from helpers import format_day, decline_places, validate_phone, validate_name
+from helpers import validate_phone, validate_name
 from logger import setup_logging
+from metrics import timed, start_http_server
 from admin import admin_command, admin_callback
+from booking_cache import booking_cache
+from booking_queue import booking_admission, BookingQueueFull
+from persistence import SQLitePersistence
+from query_trace import set_source
+from render import PERSONS_KEYBOARD, days_keyboard, times_keyboard, confirmation_text, my_booking_text
+from schedule import available_days, ensure_day
+from watchdog import loop_watchdog
 from scheduler import setup_scheduler
+from session_store import Session
+from update_processor import PerUserUpdateProcessor
 
 logger = setup_logging()
 
@@ -46,9 +62,21 @@ MAIN_MENU = ReplyKeyboardMarkup(
     resize_keyboard=True,
 )
 
+# ===== сброс диалога записи =====
+# Shown rounded up, so a TTL under a minute is not "0 мин."
+SEAT_HOLD_MINUTES = math.ceil(SEAT_HOLD_TTL / 60)
+
+
+def reset_dialog(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Leave the booking dialog: release the seat hold, if any, and forget the answers."""
+    if "time_slot_id" in context.user_data:
+        release_seat_hold(update.effective_user.id)
+    context.user_data.clear()
+
 # ===== /start =====
+@timed("handler")
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    context.user_data.clear()
+    reset_dialog(update, context)
     user = update.effective_user
     upsert_subscriber(user.id, user.username, user.first_name, user.last_name)
     await update.message.reply_text(
@@ -58,9 +86,10 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     )
 
 # ===== старт записи =====
+@timed("handler")
 async def start_booking(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    context.user_data.clear()
-    if user_has_booking(update.effective_user.id):
+    reset_dialog(update, context)
+    if booking_cache.has_booking(update.effective_user.id):
         await update.message.reply_text(
             "❗ У вас уже есть активная запись.\n"
             "Отмените её, чтобы записаться снова.",
@@ -68,84 +97,81 @@ async def start_booking(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         return
 
-    keyboard = InlineKeyboardMarkup([
-        [
-            InlineKeyboardButton("1", callback_data="persons_1"),
-            InlineKeyboardButton("2", callback_data="persons_2"),
-            InlineKeyboardButton("3", callback_data="persons_3"),
-        ],
-    ])
     await update.message.reply_text(
         "👥 Сколько человек придёт на экскурсию?",
-        reply_markup=keyboard,
+        reply_markup=PERSONS_KEYBOARD,
     )
 
 # ===== выбор количества =====
+@timed("handler")
 async def persons_chosen(update: Update, context: ContextTypes.DEFAULT_TYPE):
     q = update.callback_query
     await q.answer()
 
+    # Also reached from an older message's keyboard, after a time was already held
+    reset_dialog(update, context)
     persons = int(q.data.split("_")[1])
     context.user_data["persons"] = persons
 
-    days = get_available_days(persons)
+    days = available_days(persons)
     if not days:
+        reset_dialog(update, context)
         await q.edit_message_text("❌ Сейчас нет доступных дат.")
         return
 
-    buttons = []
-    for d in days:
-        buttons.append([
-            InlineKeyboardButton(
-                f"{format_day(d['date'])} ({decline_places(d['remaining'])})",
-                callback_data=f"day_{d['id']}",
-            )
-        ])
     await q.edit_message_text(
         "📅 Выберите дату:\n\n"
         "ℹ️ Если бот не показывает время для записи — места закончились.",
-        reply_markup=InlineKeyboardMarkup(buttons),
+        reply_markup=days_keyboard(tuple((d["date"], d["remaining"]) for d in days)),
     )
 
 # ===== выбор даты =====
+@timed("handler")
 async def day_chosen(update: Update, context: ContextTypes.DEFAULT_TYPE):
     q = update.callback_query
     await q.answer()
 
-    day_id = int(q.data.replace("day_", ""))
-    context.user_data["day_id"] = day_id
+    # Days further ahead exist only as rules until someone picks them
+    day_id = ensure_day(q.data.replace("day_", ""))
     persons = context.user_data["persons"]
 
-    times = get_available_times(day_id, persons)
+    times = get_available_times(day_id, persons) if day_id is not None else []
     if not times:
+        reset_dialog(update, context)
         await q.edit_message_text("❌ На выбранную дату нет доступного времени.")
         return
 
-    buttons = []
-    for t in times:
-        buttons.append([
-            InlineKeyboardButton(
-                f"{t['time']} ({decline_places(t['remaining'])})",
-                callback_data=f"time_{t['id']}",
-            )
-        ])
+    context.user_data["day_id"] = day_id
     await q.edit_message_text(
         "🕒 Выберите время:\n\n"
         "ℹ️ Если бот не показывает время для записи — места закончились.",
-        reply_markup=InlineKeyboardMarkup(buttons),
+        reply_markup=times_keyboard(tuple((t["id"], t["time"], t["remaining"]) for t in times)),
     )
 
 # ===== выбор времени =====
+@timed("handler")
 async def time_chosen(update: Update, context: ContextTypes.DEFAULT_TYPE):
     q = update.callback_query
     await q.answer()
 
-    context.user_data["time_slot_id"] = int(q.data.replace("time_", ""))
+    time_slot_id = int(q.data.replace("time_", ""))
+    if not hold_seats(q.from_user.id, time_slot_id, context.user_data["persons"], SEAT_HOLD_TTL):
+        # A hold on a time chosen earlier is not replaced on failure, drop it too
+        context.user_data["time_slot_id"] = time_slot_id
+        reset_dialog(update, context)
+        await q.edit_message_text("❌ Это время только что заняли. Начните запись заново.")
+        return
+
+    context.user_data["time_slot_id"] = time_slot_id
     context.user_data["waiting_name"] = True
 
-    await q.edit_message_text("👤 Введите имя для бронирования:")
+    await q.edit_message_text(
+        "👤 Введите имя для бронирования:\n\n"
+        f"⏳ Места закреплены за вами на {SEAT_HOLD_MINUTES} мин."
+    )
 
 # ===== ввод имени =====
+@timed("handler")
 async def name_entered(update: Update, context: ContextTypes.DEFAULT_TYPE):
     name = update.message.text.strip()
     if not validate_name(name):
@@ -164,6 +190,7 @@ async def name_entered(update: Update, context: ContextTypes.DEFAULT_TYPE):
     )
 
 # ===== ввод телефона + бронирование =====
+@timed("handler")
 async def phone_entered(update: Update, context: ContextTypes.DEFAULT_TYPE):
     phone = validate_phone(update.message.text.strip())
     if not phone:
@@ -173,26 +200,36 @@ async def phone_entered(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         return
 
-    context.user_data["waiting_phone"] = False
-
     name = context.user_data["name"]
     persons = context.user_data["persons"]
     day_id = context.user_data["day_id"]
     time_slot_id = context.user_data["time_slot_id"]
     user_id = update.effective_user.id
 
-    success, day_date, slot_time = create_booking(
-        user_id, name, persons, day_id, time_slot_id, phone,
-    )
+    try:
+        success, day_date, slot_time = await booking_admission.book(
+            user_id, name, persons, day_id, time_slot_id, phone,
+        )
+    except BookingQueueFull:
+        # Keep waiting_phone so the user can simply resend the number
+        await update.message.reply_text(
+            "⏳ Сейчас очень много записей. Отправьте номер телефона ещё раз через минуту."
+        )
+        return
+
+    context.user_data["waiting_phone"] = False
 
     if not success:
-        context.user_data.clear()
+        # Maybe rejected because the user already has a booking the cache did not know about
+        booking_cache.invalidate(user_id)
+        reset_dialog(update, context)
         await update.message.reply_text(
             "❌ Это время только что заняли. Выберите другое.",
             reply_markup=MAIN_MENU,
         )
         return
 
+    booking_cache.set(user_id, {"name": name, "persons": persons, "phone": phone, "date": day_date, "time": slot_time})
     update_subscriber_phone(user_id, phone)
 
     logger.info(
@@ -202,17 +239,12 @@ async def phone_entered(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     context.user_data.clear()
     await update.message.reply_text(
-        "✅ Запись подтверждена!\n\n"
-        f"👤 {name}\n"
-        f"📞 {phone}\n"
-        f"👥 {'10+' if persons >= 10 else persons} человек\n"
-        f"📅 Дата: {format_day(day_date)}\n"
-        f"🕒 Время: {slot_time}\n\n"
-        "Кнопки «Как проехать» и «Важная информация» доступны в меню ⬇️",
+        confirmation_text(name, phone, persons, day_date, slot_time),
         reply_markup=MAIN_MENU,
     )
 
 # ===== единый роутер текстового ввода =====
+@timed("handler")
 async def text_input_router(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if context.user_data.get("waiting_name"):
         await name_entered(update, context)
@@ -220,8 +252,10 @@ async def text_input_router(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await phone_entered(update, context)
 
 # ===== моя запись =====
+@timed("handler")
 async def my_booking(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    booking = get_user_booking(update.effective_user.id)
+    reset_dialog(update, context)
+    booking = booking_cache.get(update.effective_user.id)
     if not booking:
         await update.message.reply_text(
             "📄 У вас нет активной записи.",
@@ -229,20 +263,19 @@ async def my_booking(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         return
 
-    phone_line = f"📞 Телефон: {booking['phone']}\n" if booking["phone"] else ""
     await update.message.reply_text(
-        "📄 Моя запись\n\n"
-        f"👤 Имя: {booking['name']}\n"
-        f"{phone_line}"
-        f"👥 Количество: {'10+' if booking['persons'] >= 10 else booking['persons']}\n"
-        f"📅 Дата: {format_day(booking['date'])}\n"
-        f"🕒 Время: {booking['time']}",
+        my_booking_text(booking["name"], booking["phone"], booking["persons"], booking["date"], booking["time"]),
         reply_markup=MAIN_MENU,
     )
 
 # ====== отмена записи ======
+@timed("handler")
 async def cancel_booking(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    deleted = cancel_user_booking(update.effective_user.id)
+    reset_dialog(update, context)
+    user_id = update.effective_user.id
+    # Always the real DELETE: a stale cache entry must not decide whether the booking stays
+    deleted = cancel_user_booking(user_id)
+    booking_cache.set(user_id, None)
     if not deleted:
         await update.message.reply_text(
             "ℹ️ У вас нет активной записи.",
@@ -250,7 +283,7 @@ async def cancel_booking(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         return
 
-    logger.info("Booking cancelled by user=%s", update.effective_user.id)
+    logger.info("Booking cancelled by user=%s", user_id)
     await update.message.reply_text(
         "❌ Ваша запись отменена.\nВы можете записаться снова.",
         reply_markup=MAIN_MENU,
@@ -258,18 +291,20 @@ async def cancel_booking(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 # ===== каталог =====
 CATALOG_URL = "https://drive.google.com/file/d/1vxViARDD9mcjXnqDJr2L31G6RzReoR3c/view?usp=sharing"
+CATALOG_KEYBOARD = InlineKeyboardMarkup([
+    [InlineKeyboardButton("📄 Открыть каталог (PDF)", url=CATALOG_URL)]
+])
 
+@timed("handler")
 async def send_catalog(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    keyboard = InlineKeyboardMarkup([
-        [InlineKeyboardButton("📄 Открыть каталог (PDF)", url=CATALOG_URL)]
-    ])
     await update.message.reply_text(
         "🌷 Актуальный каталог Верёвкин Хутор\n\n"
         "Нажмите кнопку ниже, чтобы открыть PDF:",
-        reply_markup=keyboard,
+        reply_markup=CATALOG_KEYBOARD,
     )
 
 # ===== важная информация =====
+@timed("handler")
 async def important_info(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text(
         "⚠️ Важная информация\n\n"
@@ -283,11 +318,12 @@ async def important_info(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 # ===== как проехать =====
 ROUTE_URL = "https://yandex.ru/maps/-/CPE3zSma"
+ROUTE_KEYBOARD = InlineKeyboardMarkup([
+    [InlineKeyboardButton("🗺 Яндекс Карты", url=ROUTE_URL)]
+])
 
+@timed("handler")
 async def send_route_info(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    keyboard = InlineKeyboardMarkup([
-        [InlineKeyboardButton("🗺 Яндекс Карты", url=ROUTE_URL)]
-    ])
     await update.message.reply_text(
         "📍 Как добраться\n\n"
         "Адрес:\n"
@@ -295,16 +331,17 @@ async def send_route_info(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "Московское ш., 11-й км, КрымТеплица\n\n"
         "🚗 Парковка — перед теплицей\n"
         "👋 Сбор группы — у входа в офис",
-        reply_markup=keyboard,
+        reply_markup=ROUTE_KEYBOARD,
     )
 
 # ===== о компании =====
 ABOUT_VIDEO_URL = "https://vkvideo.ru/playlist/-205051219_8/video-205051219_456240078?linked=1&t=31s"
+ABOUT_KEYBOARD = InlineKeyboardMarkup([
+    [InlineKeyboardButton("🎬 Смотреть видео", url=ABOUT_VIDEO_URL)]
+])
 
+@timed("handler")
 async def about_company(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    keyboard = InlineKeyboardMarkup([
-        [InlineKeyboardButton("🎬 Смотреть видео", url=ABOUT_VIDEO_URL)]
-    ])
     await update.message.reply_text(
         "🏢 О компании «Верёвкин Хутор»\n\n"
         "Бренд «Верёвкин Хутор» представлен на российском рынке более 6 лет.\n"
@@ -324,10 +361,11 @@ async def about_company(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "по запросу. В наших теплицах вы сможете наблюдать за ростом "
         "заказанных цветов.\n\n"
         "❄️ Возможность хранения срезанных цветов в наших холодильниках.",
-        reply_markup=keyboard,
+        reply_markup=ABOUT_KEYBOARD,
     )
 
 # ===== отслеживание блокировки/разблокировки бота =====
+@timed("handler")
 async def track_chat_member(update: Update, context: ContextTypes.DEFAULT_TYPE):
     result = update.my_chat_member
     if result is None:
@@ -339,18 +377,39 @@ async def track_chat_member(update: Update, context: ContextTypes.DEFAULT_TYPE):
     elif new_status == "kicked":
         update_subscriber_status(user_id, "left")
 
-# ====== post_init ======
+# ====== post_init / post_shutdown ======
 async def post_init(application):
     setup_scheduler(application)
-
-# ====== main ======
-def main():
-    init_db()
-
+    booking_admission.start()
+    booking_cache.start()
+    loop_watchdog.start()
+    if BOT_METRICS_PORT:
+        application.bot_data["metrics_server"] = await start_http_server(BOT_METRICS_PORT)
+
+
+async def post_shutdown(application):
+    loop_watchdog.stop()
+    await booking_admission.stop()
+    await booking_cache.stop()
+    server = application.bot_data.pop("metrics_server", None)
+    if server:
+        server.close()
+
+# ====== сборка приложения ======
+def build_application(bot=None) -> Application:
+    """Build the Application with all handlers. `bot` replaces the real Bot (see loadtest.py)."""
+    # A new Application sees the database as it is now, not what an earlier one cached
+    booking_cache.clear()
+    builder = Application.builder()
+    builder = builder.bot(bot) if bot is not None else builder.token(BOT_TOKEN)
+    processor = PerUserUpdateProcessor(UPDATE_CONCURRENCY)
     app = (
-        Application.builder()
-        .token(BOT_TOKEN)
+        builder
+        .context_types(ContextTypes(user_data=Session))
+        .concurrent_updates(processor)
+        .persistence(SQLitePersistence(update_interval=SESSION_FLUSH_INTERVAL, is_busy=processor.is_busy))
         .post_init(post_init)
+        .post_shutdown(post_shutdown)
         .build()
     )
 
@@ -373,9 +432,17 @@ def main():
     app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, text_input_router))
 
     app.add_handler(ChatMemberHandler(track_chat_member, ChatMemberHandler.MY_CHAT_MEMBER))
+    return app
+
+# ====== main ======
+def main():
+    set_source("bot")
+    init_db()
+    app = build_application()
 
     logger.info("Bot is running...")
-    app.run_polling(drop_pending_updates=True, allowed_updates=Update.ALL_TYPES)
+    # Dialog state survives restarts (see persistence.py), so updates queued during a deploy are kept
+    app.run_polling(drop_pending_updates=False, allowed_updates=Update.ALL_TYPES)
 
 
 if __name__ == "__main__":
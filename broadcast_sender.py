@@ -3,8 +3,7 @@ from __future__ import annotations
 import asyncio
 import logging
 from datetime import datetime
-
-import httpx
+from typing import TYPE_CHECKING
 
 from config import BOT_TOKEN
 from db import (
@@ -14,13 +13,26 @@ from db import (
     update_subscriber_status,
     _utc_now,
 )
+from metrics import timed
+
+if TYPE_CHECKING:
+    import httpx
 
 logger = logging.getLogger("excursion_bot")
 
 RETRY_DELAYS = [0.05, 0.5, 1.0]  # seconds
 SEND_DELAY = 0.05  # 50ms between messages (20/sec)
+NOTIFY_CONCURRENCY = 10
+NOTIFY_RATE = 25  # messages/sec, under Telegram's ~30/sec bot limit
+
+
+def _client() -> httpx.AsyncClient:
+    # httpx is imported on the first send, not when the process starts
+    import httpx
+    return httpx.AsyncClient(timeout=30)
 
 
+@timed("job")
 async def send_broadcast(broadcast_id: int):
     broadcast = get_broadcast_by_id(broadcast_id)
     if not broadcast:
@@ -55,7 +67,7 @@ async def send_broadcast(broadcast_id: int):
             }]]
         }
 
-    async with httpx.AsyncClient(timeout=30) as client:
+    async with _client() as client:
         for user_id in subscriber_ids:
             ok = await _send_to_user(client, broadcast, user_id, reply_markup)
             if ok:
@@ -74,14 +86,38 @@ async def send_broadcast(broadcast_id: int):
     logger.info("Broadcast #%s completed: %d/%d sent", broadcast_id, success, total)
 
 
+class _RateLimiter:
+    """Spaces request starts at least 1/rate seconds apart."""
+
+    def __init__(self, rate: float):
+        self.interval = 1 / rate
+        self._next = 0.0
+        self._lock = asyncio.Lock()
+
+    async def wait(self):
+        async with self._lock:
+            loop = asyncio.get_running_loop()
+            # Re-checked after the sleep: a 429 may have paused the limiter meanwhile
+            while (delay := self._next - loop.time()) > 0:
+                await asyncio.sleep(delay)
+            self._next = loop.time() + self.interval
+
+    def pause(self, seconds: float):
+        """Hold every request start back for `seconds` (Telegram's retry_after)."""
+        self._next = max(self._next, asyncio.get_running_loop().time() + seconds)
+
+
 async def _send_to_user(client: httpx.AsyncClient, broadcast, user_id: int,
-                        reply_markup: dict | None) -> bool:
+                        reply_markup: dict | None, limiter: _RateLimiter | None = None) -> bool:
+    """Send with retries. With a limiter every attempt, retries included, waits for its turn."""
     for attempt, delay in enumerate(RETRY_DELAYS):
         try:
+            if limiter is not None:
+                await limiter.wait()
             if broadcast["image_path"]:
-                ok, should_retry = await _send_photo(client, broadcast, user_id, reply_markup)
+                ok, should_retry = await _send_photo(client, broadcast, user_id, reply_markup, limiter)
             else:
-                ok, should_retry = await _send_message(client, broadcast, user_id, reply_markup)
+                ok, should_retry = await _send_message(client, broadcast, user_id, reply_markup, limiter)
 
             if ok:
                 return True
@@ -97,6 +133,23 @@ async def _send_to_user(client: httpx.AsyncClient, broadcast, user_id: int,
     return False
 
 
+@timed("job")
+async def send_notifications(messages: list[tuple[int, str]], progress: dict):
+    """Send (user_id, text) messages concurrently, rate-limited.
+    Counts progress["sent"] / progress["failed"] as it goes."""
+    semaphore = asyncio.Semaphore(NOTIFY_CONCURRENCY)
+    limiter = _RateLimiter(NOTIFY_RATE)
+
+    async def send_one(client: httpx.AsyncClient, user_id: int, text: str):
+        async with semaphore:
+            ok = await _send_to_user(client, {"text": text, "image_path": None}, user_id, None, limiter)
+        progress["sent" if ok else "failed"] += 1
+
+    async with _client() as client:
+        await asyncio.gather(*(send_one(client, user_id, text) for user_id, text in messages))
+
+
+@timed("job")
 async def send_test_message(text: str, image_path: str | None,
                             button_text: str | None, button_url: str | None,
                             user_id: int) -> tuple[bool, str]:
@@ -108,7 +161,7 @@ async def send_test_message(text: str, image_path: str | None,
         }
     broadcast = {"text": text, "image_path": image_path}
 
-    async with httpx.AsyncClient(timeout=30) as client:
+    async with _client() as client:
         try:
             if image_path:
                 ok, _ = await _send_photo(client, broadcast, user_id, reply_markup)
@@ -122,7 +175,7 @@ async def send_test_message(text: str, image_path: str | None,
 
 
 async def _send_message(client: httpx.AsyncClient, broadcast, user_id: int,
-                        reply_markup: dict | None) -> tuple[bool, bool]:
+                        reply_markup: dict | None, limiter: _RateLimiter | None = None) -> tuple[bool, bool]:
     payload = {"chat_id": user_id, "text": broadcast["text"]}
     if reply_markup:
         payload["reply_markup"] = reply_markup
@@ -131,11 +184,11 @@ async def _send_message(client: httpx.AsyncClient, broadcast, user_id: int,
         f"https://api.telegram.org/bot{BOT_TOKEN}/sendMessage",
         json=payload,
     )
-    return await _handle_response(resp, user_id)
+    return await _handle_response(resp, user_id, limiter)
 
 
 async def _send_photo(client: httpx.AsyncClient, broadcast, user_id: int,
-                      reply_markup: dict | None) -> tuple[bool, bool]:
+                      reply_markup: dict | None, limiter: _RateLimiter | None = None) -> tuple[bool, bool]:
     import json as json_mod
     import mimetypes
     import os
@@ -156,11 +209,12 @@ async def _send_photo(client: httpx.AsyncClient, broadcast, user_id: int,
             data=data,
             files={"photo": (filename, f, mime_type)},
         )
-    return await _handle_response(resp, user_id)
+    return await _handle_response(resp, user_id, limiter)
 
 
-async def _handle_response(resp: httpx.Response, user_id: int) -> tuple[bool, bool]:
-    """Returns (success, should_retry)."""
+async def _handle_response(resp: httpx.Response, user_id: int,
+                           limiter: _RateLimiter | None = None) -> tuple[bool, bool]:
+    """Returns (success, should_retry). A 429 pauses the whole limiter, not only this sender."""
     if resp.status_code == 200:
         result = resp.json()
         if result.get("ok"):
@@ -176,9 +230,12 @@ async def _handle_response(resp: httpx.Response, user_id: int) -> tuple[bool, bo
         try:
             retry_after = resp.json().get("parameters", {}).get("retry_after", 5)
             logger.warning("Rate limited for user %s, retry_after=%s", user_id, retry_after)
-            await asyncio.sleep(retry_after)
         except Exception:
-            await asyncio.sleep(5)
+            retry_after = 5
+        if limiter is not None:
+            limiter.pause(retry_after)
+        else:
+            await asyncio.sleep(retry_after)
         return False, True
 
     logger.warning("Telegram API error for user %s: %s %s", user_id, resp.status_code, resp.text[:200])
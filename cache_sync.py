@@ -0,0 +1,130 @@
+"""Cache invalidation shared by the bot and admin processes.
+
+Both processes write the same SQLite file. `PRAGMA data_version` on a
+connection changes whenever any *other* connection commits, in this process
+or another one. The watcher keeps one read-only connection for that and
+checks it before every cache lookup (a few microseconds). Most commits do not
+touch what the caches hold (sessions, subscribers, query stats, event
+offsets), so when data_version has moved the watcher also reads
+cache_version, which triggers bump on every change to the cached tables
+(migrations.CACHED_TABLES), and clears the caches only if that moved too.
+So an admin cancellation is visible to the bot's next availability lookup and
+vice versa, while repeated reads between such writes are served from memory.
+"""
+
+import functools
+import sqlite3
+import threading
+from datetime import datetime
+
+from config import DB_PATH
+from connection import connect
+from metrics import Counter
+
+CACHE_REQUESTS = Counter("excursion_cache_requests_total", "Cache lookups", ("cache", "result"))
+CACHE_INVALIDATIONS = Counter("excursion_cache_invalidations_total", "Cache clears after another connection committed")
+
+
+class DataVersionWatcher:
+    def __init__(self, path: str = DB_PATH):
+        self.path = path
+        self._conn: sqlite3.Connection | None = None
+        self._version: int | None = None
+        self._generation: int | None = None
+        self._lock = threading.Lock()
+        self._caches: list = []
+
+    def register(self, cache):
+        self._caches.append(cache)
+        return cache
+
+    def check(self) -> bool:
+        """Clear all caches if the database changed since the last check."""
+        with self._lock:
+            if self._conn is None:
+                self._conn = connect(self.path, check_same_thread=False)
+            version = self._conn.execute("PRAGMA data_version").fetchone()[0]
+            if version == self._version:
+                return False
+            first = self._version is None
+            self._version = version
+            try:
+                generation = self._conn.execute("SELECT version FROM cache_version").fetchone()[0]
+            except sqlite3.OperationalError:
+                generation = None  # not migrated yet: every commit counts
+            if generation is not None and generation == self._generation:
+                return False
+            self._generation = generation
+        if not first:
+            CACHE_INVALIDATIONS.inc()
+        for cache in self._caches:
+            cache.invalidate()
+        return True
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+                self._version = None
+                self._generation = None
+
+
+watcher = DataVersionWatcher()
+
+
+class SyncedCache:
+    """Dict cache of function results, cleared by the watcher."""
+
+    def __init__(self, name: str, maxsize: int = 1024):
+        self.name = name
+        self.maxsize = maxsize
+        self._data: dict = {}
+        self._lock = threading.Lock()
+        # Bumped by every invalidation; a load that overlapped one is not stored
+        self._epoch = 0
+        watcher.register(self)
+
+    def get(self, key, loader):
+        watcher.check()
+        with self._lock:
+            try:
+                value = self._data[key]
+            except KeyError:
+                epoch = self._epoch
+            else:
+                CACHE_REQUESTS.inc(self.name, "hit")
+                return value
+        CACHE_REQUESTS.inc(self.name, "miss")
+
+        value = loader()
+        with self._lock:
+            if epoch == self._epoch:
+                if len(self._data) >= self.maxsize:
+                    self._data.clear()
+                self._data[key] = value
+        return value
+
+    def invalidate(self):
+        with self._lock:
+            self._epoch += 1
+            self._data.clear()
+
+
+def synced_cache(func=None, *, per_minute: bool = False):
+    """Cache a db read until the next commit. `per_minute` adds the current
+    minute to the key, for results that also depend on the clock (past time
+    slots, expiring seat holds)."""
+
+    def decorator(func):
+        cache = SyncedCache(func.__name__)
+
+        @functools.wraps(func)
+        def wrapper(*args):
+            key = (datetime.now().strftime("%Y-%m-%d %H:%M"), args) if per_minute else args
+            return cache.get(key, lambda: func(*args))
+
+        wrapper.cache = cache
+        return wrapper
+
+    return decorator(func) if func is not None else decorator
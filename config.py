@@ -5,3 +5,28 @@ ADMIN_IDS = [int(x.strip()) for x in os.getenv("ADMIN_IDS", "").split(",") if x.
 ADMIN_PASSWORD = os.getenv("ADMIN_PASSWORD", "admin")
 DB_PATH = os.getenv("DB_PATH", "excursions.db")
 BROADCAST_UPLOAD_DIR = os.path.join(os.path.dirname(os.path.abspath(DB_PATH)), "broadcasts")
+UPDATE_CONCURRENCY = int(os.getenv("UPDATE_CONCURRENCY", "64"))
+SESSION_FLUSH_INTERVAL = float(os.getenv("SESSION_FLUSH_INTERVAL", "10"))
+SESSION_TTL = int(os.getenv("SESSION_TTL", "1800"))
+SESSION_MAX = int(os.getenv("SESSION_MAX", "20000"))
+SEAT_HOLD_TTL = int(os.getenv("SEAT_HOLD_TTL", "600"))
+BOOKING_QUEUE_MAX = int(os.getenv("BOOKING_QUEUE_MAX", "500"))
+BOOKING_BATCH_MAX = int(os.getenv("BOOKING_BATCH_MAX", "100"))
+BOT_METRICS_PORT = int(os.getenv("BOT_METRICS_PORT", "9101"))
+SLOW_QUERY_MS = float(os.getenv("SLOW_QUERY_MS", "100"))
+QUERY_TOP_N = int(os.getenv("QUERY_TOP_N", "20"))
+LOOP_LAG_THRESHOLD = float(os.getenv("LOOP_LAG_THRESHOLD", "0.25"))
+SCHEDULE_HORIZON_DAYS = int(os.getenv("SCHEDULE_HORIZON_DAYS", "14"))
+BOOKING_WINDOW_DAYS = int(os.getenv("BOOKING_WINDOW_DAYS", "60"))
+ARCHIVE_DB_PATH = os.getenv("ARCHIVE_DB_PATH", os.path.join(os.path.dirname(os.path.abspath(DB_PATH)), "excursions-archive.db"))
+BROADCAST_ARCHIVE_DAYS = int(os.getenv("BROADCAST_ARCHIVE_DAYS", "90"))
+BACKUP_DIR = os.getenv("BACKUP_DIR", os.path.join(os.path.dirname(os.path.abspath(DB_PATH)), "backups"))
+BACKUP_KEEP = int(os.getenv("BACKUP_KEEP", "7"))
+BACKUP_PAGES = int(os.getenv("BACKUP_PAGES", "256"))
+BACKUP_STEP_SLEEP = float(os.getenv("BACKUP_STEP_SLEEP", "0.02"))
+WAL_AUTOCHECKPOINT = int(os.getenv("WAL_AUTOCHECKPOINT", "10000"))
+WAL_CHECK_INTERVAL = int(os.getenv("WAL_CHECK_INTERVAL", "30"))
+WAL_TRUNCATE_MB = float(os.getenv("WAL_TRUNCATE_MB", "16"))
+BROADCAST_IMAGE_KEEP_DAYS = int(os.getenv("BROADCAST_IMAGE_KEEP_DAYS", "30"))
+BOOKING_CACHE_SIZE = int(os.getenv("BOOKING_CACHE_SIZE", "50000"))
+BOOKING_CACHE_TTL = float(os.getenv("BOOKING_CACHE_TTL", "600"))
@@ -0,0 +1,22 @@
+"""Opening SQLite connections to the bot's database files.
+
+Every connection that may write, in any module, is opened here, so they all
+run with the same busy timeout and the same autocheckpoint threshold: with
+SQLite's default of 1000 pages a single connection opened elsewhere (stats
+flush, backup, a CLI tool) would checkpoint on its own commits and pay for
+the maintenance.py checkpoints itself.
+"""
+
+import sqlite3
+
+from config import DB_PATH, WAL_AUTOCHECKPOINT
+
+BUSY_TIMEOUT = 30  # seconds
+
+
+def connect(path: str = DB_PATH, **kwargs) -> sqlite3.Connection:
+    """sqlite3.connect() with the shared PRAGMAs; kwargs go to sqlite3.connect."""
+    conn = sqlite3.connect(path, timeout=BUSY_TIMEOUT, **kwargs)
+    # A safety net only: checkpoints are run by maintenance.py off the write path
+    conn.execute(f"PRAGMA wal_autocheckpoint = {WAL_AUTOCHECKPOINT}")
+    return conn
@@ -1,107 +1,194 @@
 from __future__ import annotations
 
+import re
 import sqlite3
 from contextlib import contextmanager
 from datetime import datetime, timezone, timedelta
 
+from cache_sync import synced_cache
 from config import DB_PATH
+from connection import connect
+from metrics import timed
+from query_trace import TracedConnection
 
 
-@contextmanager
-def get_db():
-    conn = sqlite3.connect(DB_PATH, timeout=30)
+def _connect(check_same_thread: bool = True) -> sqlite3.Connection:
+    conn = connect(DB_PATH, factory=TracedConnection, check_same_thread=check_same_thread)
     conn.row_factory = sqlite3.Row
     conn.execute("PRAGMA foreign_keys = ON")
     conn.execute("PRAGMA journal_mode = WAL")
+    return conn
+
+
+@contextmanager
+def get_db():
+    conn = _connect()
     try:
         yield conn
     finally:
         conn.close()
 
 
+@timed("db")
 def init_db():
+    """Bring the schema up to date; a no-op when it already is (see migrations.py)."""
+    from migrations import migrate
+    migrate()
+
+
+# ── Schedule rules ──
+
+@timed("db")
+@synced_cache
+def get_schedule_rules():
     with get_db() as conn:
-        cur = conn.cursor()
-        cur.execute("""
-            CREATE TABLE IF NOT EXISTS days (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                date TEXT NOT NULL UNIQUE,
-                capacity_day INTEGER NOT NULL
-            )
-        """)
-        cur.execute("""
-            CREATE TABLE IF NOT EXISTS time_slots (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                day_id INTEGER NOT NULL,
-                time TEXT NOT NULL,
-                capacity_time INTEGER NOT NULL,
-                FOREIGN KEY (day_id) REFERENCES days(id)
-            )
-        """)
-        cur.execute("""
-            CREATE TABLE IF NOT EXISTS bookings (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                telegram_user_id INTEGER NOT NULL,
-                name TEXT NOT NULL,
-                persons INTEGER NOT NULL,
-                day_id INTEGER NOT NULL,
-                time_slot_id INTEGER NOT NULL,
-                created_at TEXT NOT NULL,
-                reminder_sent INTEGER DEFAULT 0,
-                phone TEXT,
-                FOREIGN KEY (day_id) REFERENCES days(id),
-                FOREIGN KEY (time_slot_id) REFERENCES time_slots(id)
-            )
-        """)
-        cur.execute("""
-            CREATE UNIQUE INDEX IF NOT EXISTS idx_bookings_user
-            ON bookings(telegram_user_id)
-        """)
-        cur.execute("""
-            CREATE INDEX IF NOT EXISTS idx_bookings_day_id
-            ON bookings(day_id)
-        """)
-        cur.execute("""
-            CREATE INDEX IF NOT EXISTS idx_bookings_time_slot_id
-            ON bookings(time_slot_id)
-        """)
-        cur.execute("""
-            CREATE TABLE IF NOT EXISTS subscribers (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                telegram_user_id INTEGER NOT NULL UNIQUE,
-                username TEXT,
-                first_name TEXT,
-                last_name TEXT,
-                phone TEXT,
-                status TEXT NOT NULL DEFAULT 'active',
-                created_at TEXT NOT NULL,
-                updated_at TEXT NOT NULL
-            )
-        """)
-        cur.execute("""
-            CREATE TABLE IF NOT EXISTS broadcasts (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                text TEXT NOT NULL,
-                image_path TEXT,
-                button_text TEXT,
-                button_url TEXT,
-                status TEXT NOT NULL DEFAULT 'scheduled',
-                scheduled_at TEXT,
-                sent_at TEXT,
-                completed_at TEXT,
-                total INTEGER DEFAULT 0,
-                success INTEGER DEFAULT 0,
-                failed INTEGER DEFAULT 0,
-                created_at TEXT NOT NULL
+        return conn.execute("SELECT * FROM schedule_rules ORDER BY id").fetchall()
+
+
+@timed("db")
+def add_schedule_rule(kind: str, date_from: str, date_to: str | None = None, weekdays: str | None = None,
+                      times: str | None = None, capacity: int | None = None, note: str | None = None) -> int:
+    with get_db() as conn:
+        rule_id = conn.execute("""
+            INSERT INTO schedule_rules (kind, date_from, date_to, weekdays, times, capacity, note, created_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, datetime('now'))
+        """, (kind, date_from, date_to, weekdays, times, capacity, note)).lastrowid
+        conn.commit()
+        return rule_id
+
+
+@timed("db")
+def delete_schedule_rule(rule_id: int) -> bool:
+    with get_db() as conn:
+        deleted = conn.execute("DELETE FROM schedule_rules WHERE id = ?", (rule_id,)).rowcount
+        conn.commit()
+        return deleted > 0
+
+
+@timed("db")
+def get_day_id(date_str: str) -> int | None:
+    with get_db() as conn:
+        row = conn.execute("SELECT id FROM days WHERE date = ?", (date_str,)).fetchone()
+        return row["id"] if row else None
+
+
+@timed("db")
+@synced_cache
+def get_day_dates(from_date: str) -> list[str]:
+    with get_db() as conn:
+        return [row["date"] for row in conn.execute("SELECT date FROM days WHERE date >= ?", (from_date,))]
+
+
+@timed("db")
+def create_day(date_str: str, times: dict[str, int]) -> int:
+    """Insert a day with its slots unless it exists. Returns the day id."""
+    conn = _connect()
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        row = conn.execute(
+            "INSERT INTO days (date, capacity_day) VALUES (?, ?) ON CONFLICT (date) DO NOTHING RETURNING id",
+            (date_str, sum(times.values())),
+        ).fetchone()
+        if row is None:
+            # Created concurrently (the other process, or the horizon job)
+            day_id = conn.execute("SELECT id FROM days WHERE date = ?", (date_str,)).fetchone()["id"]
+        else:
+            day_id = row["id"]
+            conn.executemany(
+                "INSERT INTO time_slots (day_id, time, capacity_time) VALUES (?, ?, ?)",
+                [(day_id, slot_time, capacity) for slot_time, capacity in sorted(times.items())],
             )
-        """)
-        # Drop legacy table if exists
-        cur.execute("DROP TABLE IF EXISTS slots")
         conn.commit()
+        return day_id
+    finally:
+        conn.close()
+
+
+# ── Search ──
+
+def _digits(expr: str) -> str:
+    """SQL expression: the phone in `expr` without separators, so "999 12" finds "+7 (999) 123-45-67"."""
+    for char in (" ", "-", "(", ")", "+"):
+        expr = f"replace({expr}, '{char}', '')"
+    return f"COALESCE({expr}, '')"
+
+
+# table -> (fts columns, source expressions; {row} is "new." in triggers)
+SEARCH_INDEXES = {
+    "subscribers": (
+        ("first_name", "last_name", "username", "phone", "phone_digits"),
+        ("{row}first_name", "{row}last_name", "{row}username", "{row}phone", _digits("{row}phone")),
+    ),
+    "bookings": (
+        ("name", "phone", "phone_digits"),
+        ("{row}name", "{row}phone", _digits("{row}phone")),
+    ),
+}
+
+
+_PHONE_FRAGMENT = re.compile(r"[\d\s()+-]*\d{3}[\d\s()+-]*")
+
+
+def _match_query(text: str) -> str | None:
+    """FTS5 query matching every word as a substring; None if no word is
+    long enough for the trigram index (3+ characters)."""
+    if _PHONE_FRAGMENT.fullmatch(text.strip()):
+        words = ["".join(ch for ch in text if ch.isdigit())]  # "999 12-3" -> "999123"
+    else:
+        words = text.split()
+    words = ['"' + word.replace('"', '""') + '"' for word in words if len(word) >= 3]
+    return " AND ".join(words) or None
+
+
+@timed("db")
+def search_subscribers(text: str, limit: int = 50, offset: int = 0):
+    """Returns (rows, total) of subscribers matching every word of `text`, newest
+    first; total is None if the text is too short to search."""
+    query = _match_query(text)
+    if query is None:
+        return [], None
+    with get_db() as conn:
+        total = conn.execute(
+            "SELECT COUNT(*) FROM subscribers_fts WHERE subscribers_fts MATCH ?", (query,)
+        ).fetchone()[0]
+        rows = conn.execute("""
+            SELECT s.*
+            FROM subscribers_fts f
+            JOIN subscribers s ON s.id = f.rowid
+            WHERE subscribers_fts MATCH ?
+            ORDER BY f.rowid DESC
+            LIMIT ? OFFSET ?
+        """, (query, limit, offset)).fetchall()
+        return rows, total
+
+
+@timed("db")
+def search_bookings(text: str, limit: int = 50, offset: int = 0):
+    """Returns (rows, total) of current bookings matching every word of `text`, newest
+    first; total is None if the text is too short to search."""
+    query = _match_query(text)
+    if query is None:
+        return [], None
+    with get_db() as conn:
+        total = conn.execute(
+            "SELECT COUNT(*) FROM bookings_fts WHERE bookings_fts MATCH ?", (query,)
+        ).fetchone()[0]
+        rows = conn.execute("""
+            SELECT b.id, b.telegram_user_id, b.name, b.phone, b.persons, d.date, ts.time
+            FROM bookings_fts f
+            JOIN bookings b ON b.id = f.rowid
+            JOIN days d ON d.id = b.day_id
+            JOIN time_slots ts ON ts.id = b.time_slot_id
+            WHERE bookings_fts MATCH ?
+            ORDER BY f.rowid DESC
+            LIMIT ? OFFSET ?
+        """, (query, limit, offset)).fetchall()
+        return rows, total
 
 
 # ── Booking queries ──
 
+@timed("db")
 def user_has_booking(user_id: int) -> bool:
     with get_db() as conn:
         row = conn.execute(
@@ -111,22 +198,31 @@ def user_has_booking(user_id: int) -> bool:
         return row is not None
 
 
+# Seats taken per slot: confirmed bookings plus unexpired holds
+TAKEN_SEATS = """
+    SELECT time_slot_id, SUM(persons) AS cnt FROM (
+        SELECT time_slot_id, persons FROM bookings
+        UNION ALL
+        SELECT time_slot_id, persons FROM seat_holds WHERE expires_at > datetime('now')
+    ) GROUP BY time_slot_id
+"""
+
+
+@timed("db")
+@synced_cache(per_minute=True)
 def get_available_days(persons: int):
     now = datetime.now()
     today = now.strftime("%Y-%m-%d")
     current_time = now.strftime("%H:%M")
     with get_db() as conn:
-        return conn.execute("""
+        return conn.execute(f"""
             SELECT
                 d.id,
                 d.date,
                 COALESCE((
-                    SELECT SUM(MAX(ts.capacity_time - COALESCE(booked.cnt, 0), 0))
+                    SELECT SUM(MAX(ts.capacity_time - COALESCE(taken.cnt, 0), 0))
                     FROM time_slots ts
-                    LEFT JOIN (
-                        SELECT time_slot_id, SUM(persons) AS cnt
-                        FROM bookings GROUP BY time_slot_id
-                    ) booked ON booked.time_slot_id = ts.id
+                    LEFT JOIN ({TAKEN_SEATS}) taken ON taken.time_slot_id = ts.id
                     WHERE ts.day_id = d.id
                       AND (d.date > ? OR ts.time > ?)
                 ), 0) AS remaining
@@ -134,39 +230,40 @@ def get_available_days(persons: int):
             WHERE d.date >= ?
               AND EXISTS (
                 SELECT 1 FROM time_slots ts
-                LEFT JOIN bookings b2 ON b2.time_slot_id = ts.id
+                LEFT JOIN ({TAKEN_SEATS}) taken2 ON taken2.time_slot_id = ts.id
                 WHERE ts.day_id = d.id
                   AND (d.date > ? OR ts.time > ?)
-                GROUP BY ts.id
-                HAVING ts.capacity_time - COALESCE(SUM(b2.persons), 0) >= ?
+                  AND ts.capacity_time - COALESCE(taken2.cnt, 0) >= ?
               )
             ORDER BY d.date
         """, (today, current_time, today, today, current_time, persons)).fetchall()
 
 
+@timed("db")
+@synced_cache(per_minute=True)
 def get_available_times(day_id: int, persons: int):
     now = datetime.now()
     today = now.strftime("%Y-%m-%d")
     current_time = now.strftime("%H:%M")
 
     with get_db() as conn:
-        return conn.execute("""
+        return conn.execute(f"""
             SELECT
                 ts.id,
                 ts.time,
-                ts.capacity_time - COALESCE(SUM(b.persons), 0) AS remaining,
+                ts.capacity_time - COALESCE(taken.cnt, 0) AS remaining,
                 d.date AS day_date
             FROM time_slots ts
             JOIN days d ON d.id = ts.day_id
-            LEFT JOIN bookings b ON b.time_slot_id = ts.id
+            LEFT JOIN ({TAKEN_SEATS}) taken ON taken.time_slot_id = ts.id
             WHERE ts.day_id = ?
-            GROUP BY ts.id
-            HAVING remaining >= ?
-               AND (d.date > ? OR (d.date = ? AND ts.time > ?))
+              AND ts.capacity_time - COALESCE(taken.cnt, 0) >= ?
+              AND (d.date > ? OR (d.date = ? AND ts.time > ?))
             ORDER BY ts.time
         """, (day_id, persons, today, today, current_time)).fetchall()
 
 
+@timed("db")
 def get_user_booking(user_id: int):
     with get_db() as conn:
         return conn.execute("""
@@ -178,52 +275,204 @@ def get_user_booking(user_id: int):
         """, (user_id,)).fetchone()
 
 
+def _slot_remaining(conn, time_slot_id: int, user_id: int) -> int:
+    """Free seats in a slot, not counting the user's own hold."""
+    row = conn.execute("""
+        SELECT ts.capacity_time
+               - COALESCE((SELECT SUM(persons) FROM bookings WHERE time_slot_id = ts.id), 0)
+               - COALESCE((SELECT SUM(persons) FROM seat_holds
+                           WHERE time_slot_id = ts.id AND telegram_user_id != ?
+                             AND expires_at > datetime('now')), 0) AS remaining
+        FROM time_slots ts
+        WHERE ts.id = ?
+    """, (user_id, time_slot_id)).fetchone()
+    return row["remaining"] if row and row["remaining"] is not None else 0
+
+
+def _apply_stats(conn, changes: list[tuple[int, int, int, int]]):
+    """Add (time_slot_id, booked_delta, bookings_delta, cancellations_delta)
+    to slot_stats and day_stats, in the caller's transaction."""
+    conn.executemany("""
+        INSERT INTO slot_stats (date, time, capacity, booked, bookings, cancellations, updated_at)
+        SELECT d.date, ts.time, ts.capacity_time, ?2, ?3, ?4, datetime('now')
+        FROM time_slots ts
+        JOIN days d ON d.id = ts.day_id
+        WHERE ts.id = ?1
+        ON CONFLICT (date, time) DO UPDATE SET
+            capacity = excluded.capacity,
+            booked = booked + excluded.booked,
+            bookings = bookings + excluded.bookings,
+            cancellations = cancellations + excluded.cancellations,
+            updated_at = excluded.updated_at
+    """, changes)
+    conn.executemany("""
+        INSERT INTO day_stats (date, capacity, booked, bookings, cancellations, updated_at)
+        SELECT d.date, d.capacity_day, ?2, ?3, ?4, datetime('now')
+        FROM time_slots ts
+        JOIN days d ON d.id = ts.day_id
+        WHERE ts.id = ?1
+        ON CONFLICT (date) DO UPDATE SET
+            capacity = excluded.capacity,
+            booked = booked + excluded.booked,
+            bookings = bookings + excluded.bookings,
+            cancellations = cancellations + excluded.cancellations,
+            updated_at = excluded.updated_at
+    """, changes)
+
+
+def _append_events(conn, kind: str, rows: list):
+    """Append booking_events for (booking_id, telegram_user_id, persons, time_slot_id)
+    rows, in the caller's transaction."""
+    conn.executemany("""
+        INSERT INTO booking_events
+            (kind, booking_id, telegram_user_id, persons, time_slot_id, date, time, created_at)
+        SELECT ?1, ?2, ?3, ?4, ?5, d.date, ts.time, datetime('now')
+        FROM (SELECT 1)
+        LEFT JOIN time_slots ts ON ts.id = ?5
+        LEFT JOIN days d ON d.id = ts.day_id
+    """, [(kind, *row) for row in rows])
+
+
+@timed("db")
 def create_booking(user_id: int, name: str, persons: int, day_id: int, time_slot_id: int, phone: str):
-    """Insert booking inside BEGIN IMMEDIATE transaction. Returns (success, date_str, time_str)."""
-    conn = sqlite3.connect(DB_PATH, timeout=30)
-    conn.row_factory = sqlite3.Row
-    conn.execute("PRAGMA foreign_keys = ON")
-    conn.execute("PRAGMA journal_mode = WAL")
+    """Insert a single booking. Returns (success, date_str, time_str)."""
+    return create_bookings([(user_id, name, persons, day_id, time_slot_id, phone)])[0]
+
+
+@timed("db")
+def create_bookings(requests: list[tuple]):
+    """Confirm a batch of (user_id, name, persons, day_id, time_slot_id, phone) requests
+    in one BEGIN IMMEDIATE transaction. Each request is capacity-checked in order
+    against the seats left by the previous ones and converts the user's seat hold.
+    Returns a (success, date_str, time_str) tuple per request."""
+    conn = _connect()
     try:
         conn.execute("BEGIN IMMEDIATE")
-        row = conn.execute("""
-            SELECT ts.capacity_time - COALESCE(SUM(b.persons), 0) AS remaining
+        slot_ids = sorted({r[4] for r in requests})
+        user_ids = sorted({r[0] for r in requests})
+        slot_marks = ",".join("?" * len(slot_ids))
+        user_marks = ",".join("?" * len(user_ids))
+
+        # Free seats per slot with every active hold subtracted; a user's own hold is added back below
+        free = {row["id"]: row["free"] for row in conn.execute(f"""
+            SELECT ts.id,
+                   ts.capacity_time
+                   - COALESCE((SELECT SUM(persons) FROM bookings WHERE time_slot_id = ts.id), 0)
+                   - COALESCE((SELECT SUM(persons) FROM seat_holds
+                               WHERE time_slot_id = ts.id AND expires_at > datetime('now')), 0) AS free
             FROM time_slots ts
-            LEFT JOIN bookings b ON b.time_slot_id = ts.id
-            WHERE ts.id = ?
-            GROUP BY ts.id
-        """, (time_slot_id,)).fetchone()
-        remaining = row["remaining"] if row and row["remaining"] is not None else 0
-
-        if remaining < persons:
+            WHERE ts.id IN ({slot_marks})
+        """, slot_ids)}
+        holds = {(row["telegram_user_id"], row["time_slot_id"]): row["persons"] for row in conn.execute(f"""
+            SELECT telegram_user_id, time_slot_id, persons FROM seat_holds
+            WHERE telegram_user_id IN ({user_marks}) AND expires_at > datetime('now')
+        """, user_ids)}
+        booked_users = {row["telegram_user_id"] for row in conn.execute(
+            f"SELECT telegram_user_id FROM bookings WHERE telegram_user_id IN ({user_marks})", user_ids,
+        )}
+
+        accepted = []
+        results = []
+        for user_id, name, persons, day_id, time_slot_id, phone in requests:
+            own_hold = holds.get((user_id, time_slot_id), 0)
+            if user_id in booked_users or free.get(time_slot_id, 0) + own_hold < persons:
+                results.append(False)
+                continue
+            free[time_slot_id] += own_hold - persons
+            booked_users.add(user_id)
+            accepted.append((user_id, name, persons, day_id, time_slot_id, phone))
+            results.append(True)
+
+        if not accepted:
             conn.rollback()
-            return False, None, None
+            return [(False, None, None)] * len(requests)
 
-        conn.execute("""
+        conn.executemany("""
             INSERT INTO bookings
                 (telegram_user_id, name, persons, day_id, time_slot_id, phone, created_at)
             VALUES (?, ?, ?, ?, ?, ?, datetime('now'))
-        """, (user_id, name, persons, day_id, time_slot_id, phone))
+        """, accepted)
+        conn.executemany(
+            "DELETE FROM seat_holds WHERE telegram_user_id = ?",
+            [(r[0],) for r in accepted],
+        )
+        _apply_stats(conn, [(r[4], r[2], 1, 0) for r in accepted])
+        accepted_users = [r[0] for r in accepted]
+        _append_events(conn, "booked", conn.execute(f"""
+            SELECT id, telegram_user_id, persons, time_slot_id FROM bookings
+            WHERE telegram_user_id IN ({",".join("?" * len(accepted_users))})
+        """, accepted_users).fetchall())
         conn.commit()
 
-        day_date = conn.execute("SELECT date FROM days WHERE id = ?", (day_id,)).fetchone()["date"]
-        slot_time = conn.execute("SELECT time FROM time_slots WHERE id = ?", (time_slot_id,)).fetchone()["time"]
-        return True, day_date, slot_time
+        slots = {row["id"]: (row["date"], row["time"]) for row in conn.execute(f"""
+            SELECT ts.id, ts.time, d.date
+            FROM time_slots ts
+            JOIN days d ON d.id = ts.day_id
+            WHERE ts.id IN ({slot_marks})
+        """, slot_ids)}
+        return [
+            (True, *slots[r[4]]) if ok else (False, None, None)
+            for r, ok in zip(requests, results)
+        ]
     finally:
         conn.close()
 
 
+@timed("db")
 def cancel_user_booking(user_id: int) -> bool:
     with get_db() as conn:
         deleted = conn.execute(
-            "DELETE FROM bookings WHERE telegram_user_id = ?", (user_id,)
+            "DELETE FROM bookings WHERE telegram_user_id = ? "
+            "RETURNING id, telegram_user_id, persons, time_slot_id", (user_id,)
+        ).fetchall()
+        _apply_stats(conn, [(row["time_slot_id"], -row["persons"], -1, 1) for row in deleted])
+        _append_events(conn, "cancelled", deleted)
+        conn.commit()
+        return bool(deleted)
+
+
+# ── Seat holds ──
+
+@timed("db")
+def hold_seats(user_id: int, time_slot_id: int, persons: int, ttl_seconds: int) -> bool:
+    """Reserve seats for the user until the booking is confirmed or the hold expires.
+    Replaces the user's previous hold. Returns False if the slot has no room."""
+    conn = _connect()
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        if _slot_remaining(conn, time_slot_id, user_id) < persons:
+            conn.rollback()
+            return False
+        conn.execute("""
+            INSERT OR REPLACE INTO seat_holds (telegram_user_id, time_slot_id, persons, expires_at)
+            VALUES (?, ?, ?, datetime('now', ?))
+        """, (user_id, time_slot_id, persons, f"+{ttl_seconds} seconds"))
+        conn.commit()
+        return True
+    finally:
+        conn.close()
+
+
+@timed("db")
+def release_seat_hold(user_id: int):
+    with get_db() as conn:
+        conn.execute("DELETE FROM seat_holds WHERE telegram_user_id = ?", (user_id,))
+        conn.commit()
+
+
+@timed("db")
+def delete_expired_holds() -> int:
+    with get_db() as conn:
+        deleted = conn.execute(
+            "DELETE FROM seat_holds WHERE expires_at <= datetime('now')"
         ).rowcount
         conn.commit()
-        return deleted > 0
+        return deleted
 
 
 # ── Admin queries ──
 
+@timed("db")
 def get_all_bookings():
     with get_db() as conn:
         return conn.execute("""
@@ -236,11 +485,12 @@ def get_all_bookings():
         """).fetchall()
 
 
+@timed("db")
 def get_bookings_by_date(date_str: str):
     with get_db() as conn:
         return conn.execute("""
             SELECT b.id, b.telegram_user_id, b.name, b.phone, b.persons,
-                   d.date, ts.time, b.created_at
+                   b.time_slot_id, d.date, ts.time, b.created_at
             FROM bookings b
             JOIN days d ON d.id = b.day_id
             JOIN time_slots ts ON ts.id = b.time_slot_id
@@ -249,6 +499,7 @@ def get_bookings_by_date(date_str: str):
         """, (date_str,)).fetchall()
 
 
+@timed("db")
 def get_booking_by_id(booking_id: int):
     with get_db() as conn:
         return conn.execute("""
@@ -261,30 +512,139 @@ def get_booking_by_id(booking_id: int):
         """, (booking_id,)).fetchone()
 
 
+@timed("db")
 def cancel_booking_by_id(booking_id: int) -> bool:
     with get_db() as conn:
-        deleted = conn.execute("DELETE FROM bookings WHERE id = ?", (booking_id,)).rowcount
+        deleted = conn.execute(
+            "DELETE FROM bookings WHERE id = ? "
+            "RETURNING id, telegram_user_id, persons, time_slot_id", (booking_id,)
+        ).fetchall()
+        _apply_stats(conn, [(row["time_slot_id"], -row["persons"], -1, 1) for row in deleted])
+        _append_events(conn, "cancelled", deleted)
         conn.commit()
-        return deleted > 0
+        return bool(deleted)
+
+
+@timed("db")
+def cancel_bookings(date_str: str | None = None, time_slot_id: int | None = None) -> list[dict]:
+    """Cancel every booking of a date or of one slot in a single transaction.
+    Returns the cancelled bookings with their date and time, for notifications."""
+    if time_slot_id is not None:
+        where, params = "time_slot_id = ?", (time_slot_id,)
+    else:
+        where, params = "day_id IN (SELECT id FROM days WHERE date = ?)", (date_str,)
+    conn = _connect()
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        deleted = conn.execute(
+            f"DELETE FROM bookings WHERE {where} "
+            "RETURNING id, telegram_user_id, persons, time_slot_id",
+            params,
+        ).fetchall()
+        if not deleted:
+            conn.rollback()
+            return []
+        _apply_stats(conn, [(row["time_slot_id"], -row["persons"], -1, 1) for row in deleted])
+        _append_events(conn, "cancelled", deleted)
+        slot_ids = sorted({row["time_slot_id"] for row in deleted})
+        slots = {row["id"]: (row["date"], row["time"]) for row in conn.execute(f"""
+            SELECT ts.id, ts.time, d.date
+            FROM time_slots ts
+            JOIN days d ON d.id = ts.day_id
+            WHERE ts.id IN ({",".join("?" * len(slot_ids))})
+        """, slot_ids)}
+        conn.commit()
+        return [
+            {
+                "id": row["id"],
+                "telegram_user_id": row["telegram_user_id"],
+                "persons": row["persons"],
+                "date": slots[row["time_slot_id"]][0],
+                "time": slots[row["time_slot_id"]][1],
+            }
+            for row in deleted
+        ]
+    finally:
+        conn.close()
 
 
+@timed("db")
+@synced_cache(per_minute=True)
 def get_stats():
-    """Return list of (date, booked, capacity) for future dates."""
+    """Return list of (date, booked, capacity) for future dates, from day_stats."""
     today = datetime.now().strftime("%Y-%m-%d")
     with get_db() as conn:
         return conn.execute("""
             SELECT d.date, d.capacity_day,
-                   COALESCE(SUM(b.persons), 0) AS booked
+                   COALESCE(s.booked, 0) AS booked,
+                   COALESCE(s.bookings, 0) AS bookings,
+                   COALESCE(s.cancellations, 0) AS cancellations
             FROM days d
-            LEFT JOIN bookings b ON b.day_id = d.id
+            LEFT JOIN day_stats s ON s.date = d.date
             WHERE d.date >= ?
-            GROUP BY d.id
             ORDER BY d.date
         """, (today,)).fetchall()
 
 
+@timed("db")
+def get_stats_history(from_date: str, to_date: str):
+    """day_stats rows between two dates, including days no longer in the schedule."""
+    with get_db() as conn:
+        return conn.execute("""
+            SELECT date, capacity, booked, bookings, cancellations
+            FROM day_stats
+            WHERE date BETWEEN ? AND ?
+            ORDER BY date
+        """, (from_date, to_date)).fetchall()
+
+
+@timed("db")
+def rebuild_stats():
+    """Recompute booked/bookings/capacity of every scheduled day and slot from
+    bookings. Cancellations cannot be recomputed and are kept; rows of dates
+    that are no longer scheduled are left alone."""
+    conn = _connect()
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        _rebuild_stats(conn)
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def _rebuild_stats(conn):
+    conn.execute("""
+        INSERT INTO slot_stats (date, time, capacity, booked, bookings, updated_at)
+        SELECT d.date, ts.time, ts.capacity_time,
+               COALESCE(SUM(b.persons), 0), COUNT(b.id), datetime('now')
+        FROM time_slots ts
+        JOIN days d ON d.id = ts.day_id
+        LEFT JOIN bookings b ON b.time_slot_id = ts.id
+        GROUP BY ts.id
+        ON CONFLICT (date, time) DO UPDATE SET
+            capacity = excluded.capacity,
+            booked = excluded.booked,
+            bookings = excluded.bookings,
+            updated_at = excluded.updated_at
+    """)
+    conn.execute("""
+        INSERT INTO day_stats (date, capacity, booked, bookings, updated_at)
+        SELECT d.date, d.capacity_day,
+               COALESCE(SUM(b.persons), 0), COUNT(b.id), datetime('now')
+        FROM days d
+        LEFT JOIN bookings b ON b.day_id = d.id
+        GROUP BY d.id
+        ON CONFLICT (date) DO UPDATE SET
+            capacity = excluded.capacity,
+            booked = excluded.booked,
+            bookings = excluded.bookings,
+            updated_at = excluded.updated_at
+    """)
+
+
 # ── Reminder queries ──
 
+@timed("db")
 def get_pending_reminders(from_dt: str, to_dt: str):
     with get_db() as conn:
         return conn.execute("""
@@ -297,6 +657,7 @@ def get_pending_reminders(from_dt: str, to_dt: str):
         """, (from_dt, to_dt)).fetchall()
 
 
+@timed("db")
 def mark_reminder_sent(booking_id: int):
     with get_db() as conn:
         conn.execute("UPDATE bookings SET reminder_sent = 1 WHERE id = ?", (booking_id,))
@@ -305,6 +666,7 @@ def mark_reminder_sent(booking_id: int):
 
 # ── Subscriber queries ──
 
+@timed("db")
 def upsert_subscriber(user_id: int, username: str | None, first_name: str | None, last_name: str | None):
     now = datetime.now().isoformat()
     with get_db() as conn:
@@ -321,6 +683,7 @@ def upsert_subscriber(user_id: int, username: str | None, first_name: str | None
         conn.commit()
 
 
+@timed("db")
 def update_subscriber_phone(user_id: int, phone: str):
     now = datetime.now().isoformat()
     with get_db() as conn:
@@ -331,6 +694,7 @@ def update_subscriber_phone(user_id: int, phone: str):
         conn.commit()
 
 
+@timed("db")
 def update_subscriber_status(user_id: int, status: str):
     now = datetime.now().isoformat()
     with get_db() as conn:
@@ -341,6 +705,89 @@ def update_subscriber_status(user_id: int, status: str):
         conn.commit()
 
 
+# ── Session queries ──
+
+@timed("db")
+def get_user_session(user_id: int) -> str | None:
+    with get_db() as conn:
+        row = conn.execute(
+            "SELECT data FROM user_sessions WHERE telegram_user_id = ?", (user_id,)
+        ).fetchone()
+        return row["data"] if row else None
+
+
+@timed("db")
+def save_user_sessions(upserts: list[tuple[int, str]], deletes: list[int]):
+    """Write a batch of serialized sessions in one transaction."""
+    now = datetime.now().isoformat()
+    with get_db() as conn:
+        conn.executemany("""
+            INSERT INTO user_sessions (telegram_user_id, data, updated_at)
+            VALUES (?, ?, ?)
+            ON CONFLICT(telegram_user_id) DO UPDATE SET
+                data = excluded.data,
+                updated_at = excluded.updated_at
+        """, [(user_id, data, now) for user_id, data in upserts])
+        conn.executemany(
+            "DELETE FROM user_sessions WHERE telegram_user_id = ?",
+            [(user_id,) for user_id in deletes],
+        )
+        conn.commit()
+
+
+# ── Booking events ──
+
+@timed("db")
+def get_booking_events(after_seq: int, limit: int = 500):
+    with get_db() as conn:
+        return conn.execute("""
+            SELECT seq, kind, booking_id, telegram_user_id, persons, time_slot_id, date, time, created_at
+            FROM booking_events
+            WHERE seq > ?
+            ORDER BY seq
+            LIMIT ?
+        """, (after_seq, limit)).fetchall()
+
+
+@timed("db")
+def get_last_event_seq() -> int:
+    with get_db() as conn:
+        row = conn.execute("SELECT MAX(seq) FROM booking_events").fetchone()
+        return row[0] or 0
+
+
+@timed("db")
+def get_event_offset(consumer: str) -> int | None:
+    with get_db() as conn:
+        row = conn.execute("SELECT seq FROM event_offsets WHERE consumer = ?", (consumer,)).fetchone()
+        return row["seq"] if row else None
+
+
+@timed("db")
+def save_event_offset(consumer: str, seq: int):
+    with get_db() as conn:
+        conn.execute("""
+            INSERT INTO event_offsets (consumer, seq, updated_at)
+            VALUES (?, ?, datetime('now'))
+            ON CONFLICT (consumer) DO UPDATE SET seq = excluded.seq, updated_at = excluded.updated_at
+        """, (consumer, seq))
+        conn.commit()
+
+
+# ── Query stats ──
+
+@timed("db")
+def get_query_stats(limit: int):
+    with get_db() as conn:
+        return conn.execute("""
+            SELECT source, fingerprint, calls, total_ms, max_ms, rows, slow_calls, plan, updated_at,
+                   total_ms / calls AS avg_ms
+            FROM query_stats
+            ORDER BY total_ms DESC
+            LIMIT ?
+        """, (limit,)).fetchall()
+
+
 # ── Broadcast queries ──
 
 MSK = timezone(timedelta(hours=3))
@@ -365,6 +812,7 @@ def _utc_to_msk(utc_str: str) -> str:
     return dt.astimezone(MSK).strftime("%Y-%m-%d %H:%M")
 
 
+@timed("db")
 def create_broadcast(text: str, image_path: str | None, button_text: str | None,
                      button_url: str | None, scheduled_at_msk: str | None) -> int:
     now = _utc_now()
@@ -379,11 +827,13 @@ def create_broadcast(text: str, image_path: str | None, button_text: str | None,
         return cur.lastrowid
 
 
+@timed("db")
 def get_broadcast_by_id(broadcast_id: int):
     with get_db() as conn:
         return conn.execute("SELECT * FROM broadcasts WHERE id = ?", (broadcast_id,)).fetchone()
 
 
+@timed("db")
 def claim_pending_broadcasts():
     """Atomically find and claim scheduled broadcasts ready to send.
     Changes status from 'scheduled' to 'sending' to prevent duplicates."""
@@ -409,6 +859,7 @@ def claim_pending_broadcasts():
         return []
 
 
+@timed("db")
 def update_broadcast_status(broadcast_id: int, **kwargs):
     if not kwargs:
         return
@@ -419,6 +870,7 @@ def update_broadcast_status(broadcast_id: int, **kwargs):
         conn.commit()
 
 
+@timed("db")
 def get_broadcast_history():
     with get_db() as conn:
         return conn.execute(
@@ -426,6 +878,21 @@ def get_broadcast_history():
         ).fetchall()
 
 
+@timed("db")
+def get_broadcast_image_refs(since_utc: str) -> dict[str, int]:
+    """image_path -> number of broadcasts using it that are not finished yet or
+    were created since `since_utc`."""
+    with get_db() as conn:
+        rows = conn.execute("""
+            SELECT image_path, COUNT(*) AS refs FROM broadcasts
+            WHERE image_path IS NOT NULL
+              AND (status IN ('pending', 'scheduled', 'sending') OR created_at >= ?)
+            GROUP BY image_path
+        """, (since_utc,)).fetchall()
+        return {r["image_path"]: r["refs"] for r in rows}
+
+
+@timed("db")
 def get_active_subscriber_ids():
     with get_db() as conn:
         rows = conn.execute(
@@ -434,6 +901,7 @@ def get_active_subscriber_ids():
         return [r["telegram_user_id"] for r in rows]
 
 
+@timed("db")
 def get_subscribers(filter_type: str = "all"):
     with get_db() as conn:
         if filter_type == "active":
@@ -448,3 +916,68 @@ def get_subscribers(filter_type: str = "all"):
             return conn.execute(
                 "SELECT * FROM subscribers ORDER BY created_at DESC"
             ).fetchall()
+
+
+# ── Exports ──
+
+EXPORT_PAGE_SIZE = 1000
+
+
+def _iter_rows(sql: str, params: tuple, conn: sqlite3.Connection | None = None):
+    """Yield rows page by page from one open cursor, then close the connection.
+    It may be used from several threads: StreamingResponse pulls each page in
+    the threadpool."""
+    conn = conn or _connect(check_same_thread=False)
+    try:
+        cur = conn.execute(sql, params)
+        while True:
+            rows = cur.fetchmany(EXPORT_PAGE_SIZE)
+            if not rows:
+                break
+            yield from rows
+    finally:
+        conn.close()
+
+
+def iter_bookings(date_from: str | None = None, date_to: str | None = None, status: str = "active"):
+    """Bookings in a date range. status: active (current bookings), cancelled
+    (from booking_events, without name/phone) or all."""
+    date_from = date_from or "0000-00-00"
+    date_to = date_to or "9999-99-99"
+    active = """
+        SELECT b.id, d.date, ts.time, b.name, b.phone, b.persons, b.telegram_user_id,
+               b.created_at, 'active' AS status
+        FROM bookings b
+        JOIN days d ON d.id = b.day_id
+        JOIN time_slots ts ON ts.id = b.time_slot_id
+        WHERE d.date BETWEEN :date_from AND :date_to
+    """
+    cancelled = """
+        SELECT e.booking_id, e.date, e.time, NULL, NULL, e.persons, e.telegram_user_id,
+               e.created_at, 'cancelled'
+        FROM booking_events e
+        WHERE e.kind = 'cancelled' AND e.date BETWEEN :date_from AND :date_to
+    """
+    if status == "cancelled":
+        sql = cancelled
+    elif status == "all":
+        sql = f"{active} UNION ALL {cancelled}"
+    else:
+        sql = active
+    return _iter_rows(sql + " ORDER BY 2, 3, 8", {"date_from": date_from, "date_to": date_to})
+
+
+def iter_subscribers(filter_type: str = "all", date_from: str | None = None, date_to: str | None = None):
+    """Subscribers who joined in a date range. filter_type: all / active / left / with_phone."""
+    conditions = {
+        "active": "status = 'active'",
+        "left": "status = 'left'",
+        "with_phone": "phone IS NOT NULL AND phone != ''",
+    }
+    where = conditions.get(filter_type, "1")
+    return _iter_rows(f"""
+        SELECT telegram_user_id, username, first_name, last_name, phone, status, created_at, updated_at
+        FROM subscribers
+        WHERE {where} AND substr(created_at, 1, 10) BETWEEN ? AND ?
+        ORDER BY id
+    """, (date_from or "0000-00-00", date_to or "9999-99-99"))
@@ -1,15 +1,27 @@
-"""Reset and populate the excursion schedule (days + time_slots).
+"""Manage the excursion schedule rules (schedule_rules).
+
+Days and time slots are created from the rules: for the next
+SCHEDULE_HORIZON_DAYS days by the bot's scheduler (and right after every
+change made here), further ahead when someone picks the day. Changes are
+applied as a diff (see schedule.py): booked slots are never removed or
+shrunk, and it is safe to run against the live bot.
 
 Usage:
-    python db_set_schedule.py
+    python db_set_schedule.py seed                  # default weekly rules (below)
+    python db_set_schedule.py list
+    python db_set_schedule.py close 2026-05-09 [2026-05-11] [--note "Праздник"]
+    python db_set_schedule.py override 2026-06-12 "11:00,15:00" 40 [2026-06-12]
+    python db_set_schedule.py delete <rule_id>
+    python db_set_schedule.py sync [--dry-run]      # re-apply the rules to the rows
     # or inside Docker:
-    docker compose exec bot python db_set_schedule.py
+    docker compose exec bot python db_set_schedule.py list
 """
 
-import sqlite3
-from datetime import date, timedelta
+import argparse
+from datetime import date
 
-from config import DB_PATH
+from db import init_db, get_schedule_rules, add_schedule_rule, delete_schedule_rule
+from schedule import materialize_horizon
 
 CAPACITY_PER_EXCURSION = 30
 
@@ -20,82 +32,91 @@ FRIDAY_TIMES = ["09:00", "15:00"]
 # Выходные (сб–вс): 09:00 и 15:00
 WEEKEND_TIMES = ["09:00", "15:00"]
 
-
-def daterange(start_ymd: str, end_ymd: str):
-    y1, m1, d1 = map(int, start_ymd.split("-"))
-    y2, m2, d2 = map(int, end_ymd.split("-"))
-    start = date(y1, m1, d1)
-    end = date(y2, m2, d2)
-    cur = start
-    while cur <= end:
-        yield cur.isoformat()
-        cur += timedelta(days=1)
+# weekday numbers as in date.weekday(): 0 = Пн
+DEFAULT_RULES = [
+    ("0,1,2,3", WEEKDAY_TIMES),
+    ("4", FRIDAY_TIMES),
+    ("5,6", WEEKEND_TIMES),
+]
+
+
+def seed():
+    """Replace the weekly rules with the defaults; overrides and closed days stay."""
+    for rule in get_schedule_rules():
+        if rule["kind"] == "weekly":
+            delete_schedule_rule(rule["id"])
+    today = date.today().isoformat()
+    for weekdays, times in DEFAULT_RULES:
+        add_schedule_rule("weekly", today, weekdays=weekdays, times=",".join(times),
+                          capacity=CAPACITY_PER_EXCURSION)
+
+
+def print_rules():
+    rules = get_schedule_rules()
+    if not rules:
+        print("Правил нет — расписание задаётся только строками days/time_slots")
+    for r in rules:
+        parts = [f"{r['date_from']} — {r['date_to'] or '…'}"]
+        if r["weekdays"]:
+            parts.append(f"дни недели {r['weekdays']}")
+        if r["kind"] != "closed":
+            parts.append(f"{r['times']} по {r['capacity']} мест")
+        note = f" ({r['note']})" if r["note"] else ""
+        print(f"#{r['id']} {r['kind']}: {', '.join(parts)}{note}")
+
+
+def print_plan(plan: dict | None, dry_run: bool):
+    if plan is None:
+        return
+    print(("План" if dry_run else "Готово") + ":")
+    print(f"  новых дней: {len(plan['new_days'])}")
+    print(f"  новых слотов в существующих днях: {len(plan['new_slots'])}")
+    print(f"  изменений вместимости: {len(plan['capacity'])}")
+    print(f"  удалённых слотов: {len(plan['remove_slots'])}")
+    for conflict in plan["conflicts"]:
+        print(f"  пропущено: {conflict}")
 
 
 def main():
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-
-    # Ensure tables exist
-    cursor.execute("""
-    CREATE TABLE IF NOT EXISTS days (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        date TEXT NOT NULL UNIQUE,
-        capacity_day INTEGER NOT NULL
-    )
-    """)
-    cursor.execute("""
-    CREATE TABLE IF NOT EXISTS time_slots (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        day_id INTEGER NOT NULL,
-        time TEXT NOT NULL,
-        capacity_time INTEGER NOT NULL,
-        FOREIGN KEY (day_id) REFERENCES days(id)
-    )
-    """)
-
-    # Clear current schedule (days/time_slots only)
-    cursor.execute("DELETE FROM time_slots")
-    cursor.execute("DELETE FROM days")
-    conn.commit()
-
-    # Schedule rules: будни — 15:00, выходные — 09:00 и 15:00
-    schedule_rules = []
-    for ymd in daterange("2026-02-16", "2026-03-03"):
-        d = date.fromisoformat(ymd)
-        if d.weekday() >= 5:
-            times = WEEKEND_TIMES
-        elif d.weekday() == 4:
-            times = FRIDAY_TIMES
-        else:
-            times = WEEKDAY_TIMES
-        schedule_rules.append((ymd, times))
-
-    # Insert days + time_slots
-    for ymd, times in schedule_rules:
-        capacity_day = CAPACITY_PER_EXCURSION * len(times)
-        cursor.execute(
-            "INSERT INTO days (date, capacity_day) VALUES (?, ?)",
-            (ymd, capacity_day),
-        )
-        day_id = cursor.lastrowid
-        for t in times:
-            cursor.execute(
-                "INSERT INTO time_slots (day_id, time, capacity_time) VALUES (?, ?, ?)",
-                (day_id, t, CAPACITY_PER_EXCURSION),
-            )
-
-    conn.commit()
-
-    cursor.execute("SELECT COUNT(*) FROM days")
-    days_count = cursor.fetchone()[0]
-    cursor.execute("SELECT COUNT(*) FROM time_slots")
-    slots_count = cursor.fetchone()[0]
-
-    conn.close()
-
-    print(f"Готово: дней = {days_count}, временных слотов = {slots_count}")
-    print(f"Вместимость: {CAPACITY_PER_EXCURSION} мест на каждый слот времени")
+    parser = argparse.ArgumentParser(description="Правила расписания экскурсий")
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("seed")
+    commands.add_parser("list")
+    close = commands.add_parser("close")
+    close.add_argument("date_from")
+    close.add_argument("date_to", nargs="?")
+    close.add_argument("--note")
+    override = commands.add_parser("override")
+    override.add_argument("date_from")
+    override.add_argument("times")
+    override.add_argument("capacity", type=int)
+    override.add_argument("date_to", nargs="?")
+    override.add_argument("--note")
+    delete = commands.add_parser("delete")
+    delete.add_argument("rule_id", type=int)
+    sync = commands.add_parser("sync")
+    sync.add_argument("--dry-run", action="store_true")
+    args = parser.parse_args()
+
+    init_db()
+    if args.command == "list":
+        print_rules()
+        return
+    if args.command == "seed":
+        seed()
+    elif args.command == "close":
+        add_schedule_rule("closed", args.date_from, args.date_to or args.date_from, note=args.note)
+    elif args.command == "override":
+        add_schedule_rule("override", args.date_from, args.date_to or args.date_from,
+                          times=args.times, capacity=args.capacity, note=args.note)
+    elif args.command == "delete":
+        if not delete_schedule_rule(args.rule_id):
+            print(f"Правило #{args.rule_id} не найдено")
+            return
+
+    dry_run = getattr(args, "dry_run", False)
+    print_rules()
+    print_plan(materialize_horizon(dry_run=dry_run), dry_run)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,82 @@
+"""Consumers of the booking_events change feed.
+
+Every write to bookings appends an event in the same transaction, so a
+consumer that applies events in seq order after its last seen offset never
+misses or double-applies a change:
+
+    tail = EventTail("reminders", handle_event)   # offset persisted in event_offsets
+    tail.poll()                                   # apply whatever is new
+
+In-process caches that rebuild on restart anyway pass consumer=None: the
+offset then lives in memory and starts at the current end of the feed.
+"""
+
+import asyncio
+import logging
+
+from db import get_booking_events, get_last_event_seq, get_event_offset, save_event_offset
+from metrics import Gauge
+
+logger = logging.getLogger("excursion_bot")
+
+_tails: list["EventTail"] = []
+
+Gauge("excursion_event_consumer_lag", "Events not yet applied by the slowest consumer in this process",
+      lambda: max((get_last_event_seq() - tail.offset for tail in _tails), default=0))
+
+
+class EventTail:
+    def __init__(self, consumer: str | None, handler, batch: int = 500):
+        self.consumer = consumer
+        self.handler = handler  # called with each sqlite3.Row of booking_events
+        self.batch = batch
+        self._saved: int | None = None  # offset last written to event_offsets
+        self.offset = self._load_offset()
+        _tails.append(self)
+
+    def _load_offset(self) -> int:
+        if self.consumer is not None:
+            stored = get_event_offset(self.consumer)
+            if stored is not None:
+                self._saved = stored
+                return stored
+        # New consumer: start from now, the current state is read from the tables
+        return get_last_event_seq()
+
+    def poll(self) -> int:
+        """Apply all events after the offset. Returns the number applied."""
+        applied = 0
+        while True:
+            events = get_booking_events(self.offset, self.batch)
+            for event in events:
+                try:
+                    self.handler(event)
+                except Exception:
+                    # Keep the offset before the failed event, retry on the next poll
+                    logger.exception("Event consumer %s failed on seq=%s", self.consumer, event["seq"])
+                    self._commit()
+                    return applied
+                self.offset = event["seq"]
+                applied += 1
+            self._commit()
+            if len(events) < self.batch:
+                return applied
+
+    def _commit(self):
+        # A write per poll even when idle would keep the WAL busy for nothing
+        if self.consumer is not None and self.offset != self._saved:
+            save_event_offset(self.consumer, self.offset)
+            self._saved = self.offset
+
+    async def run(self, interval: float = 1.0):
+        """Poll forever in a thread, every `interval` seconds."""
+        while True:
+            try:
+                await asyncio.to_thread(self.poll)
+            except Exception as e:
+                logger.error("Event consumer %s poll failed: %s", self.consumer, e)
+            await asyncio.sleep(interval)
+
+    def close(self):
+        if self in _tails:
+            _tails.remove(self)
@@ -1,5 +1,6 @@
 import re
 from datetime import datetime
+from functools import lru_cache
 from typing import Optional
 
 MONTHS = {
@@ -9,12 +10,13 @@ MONTHS = {
 }
 
 
+@lru_cache(maxsize=1024)
 def format_day(date_str: str) -> str:
     dt = datetime.strptime(date_str, "%Y-%m-%d")
     return f"{dt.day} {MONTHS[dt.month]}"
 
 
-def decline_places(n: int) -> str:
+def _decline_places(n: int) -> str:
     if 11 <= n % 100 <= 14:
         return f"{n} мест"
     if n % 10 == 1:
@@ -24,6 +26,14 @@ def decline_places(n: int) -> str:
     return f"{n} мест"
 
 
+# Remaining seats are almost always below this; larger numbers are declined on the fly
+_PLACES = tuple(_decline_places(n) for n in range(1000))
+
+
+def decline_places(n: int) -> str:
+    return _PLACES[n] if 0 <= n < len(_PLACES) else _decline_places(n)
+
+
 def validate_phone(raw: str) -> Optional[str]:
     """Normalize phone to +7XXXXXXXXXX format. Returns None if invalid."""
     digits = re.sub(r"\D", "", raw)
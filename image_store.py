@@ -0,0 +1,101 @@
+"""Broadcast images, stored once per content.
+
+An upload is named by the sha256 of its bytes and kept under two levels of
+shard directories (ab/cd/abcd….jpg), so the same picture sent in several
+broadcasts and test messages is resized and stored once, and no directory
+grows past a few hundred entries. collect_garbage() counts, for every file,
+the broadcasts that still need it (unfinished ones and those created in the
+last BROADCAST_IMAGE_KEEP_DAYS days) and deletes files nobody refers to.
+"""
+
+import hashlib
+import io
+import logging
+import os
+import time
+from datetime import datetime, timedelta, timezone
+
+from config import BROADCAST_UPLOAD_DIR, BROADCAST_IMAGE_KEEP_DAYS
+from db import get_broadcast_image_refs
+from metrics import Counter, Gauge, timed
+
+logger = logging.getLogger("excursion_bot")
+
+IMAGES_STORED = Counter("excursion_images_stored_total", "Uploaded broadcast images", ("result",))
+IMAGES_REMOVED = Counter("excursion_images_removed_total", "Broadcast images deleted by the garbage collector")
+IMAGE_FILES = Gauge("excursion_image_files", "Files in the broadcast image store")
+IMAGE_BYTES = Gauge("excursion_image_bytes", "Disk space used by the broadcast image store")
+
+# Telegram limit: width+height <= 10000, each side <= 5000
+MAX_SIDE = 2000
+# Files younger than this are never collected: the broadcast using it may not be saved yet
+GRACE_SECONDS = 3600
+
+
+def _path(digest: str) -> str:
+    return os.path.join(BROADCAST_UPLOAD_DIR, digest[:2], digest[2:4], f"{digest}.jpg")
+
+
+def _to_jpeg(content: bytes) -> bytes:
+    from PIL import Image
+
+    img = Image.open(io.BytesIO(content))
+    if img.mode in ("RGBA", "P"):
+        img = img.convert("RGB")
+    if img.width > MAX_SIDE or img.height > MAX_SIDE:
+        img.thumbnail((MAX_SIDE, MAX_SIDE), Image.LANCZOS)
+    out = io.BytesIO()
+    img.save(out, "JPEG", quality=90)
+    return out.getvalue()
+
+
+def save_image(content: bytes) -> str:
+    """Store an uploaded image (resized to fit Telegram) and return its path.
+    CPU-bound: call it from a thread."""
+    path = _path(hashlib.sha256(content).hexdigest())
+    if os.path.exists(path):
+        # Fresh mtime keeps it out of a collection that is running right now
+        os.utime(path)
+        IMAGES_STORED.inc("duplicate")
+        return path
+
+    data = _to_jpeg(content)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(data)
+    os.replace(tmp, path)
+    IMAGES_STORED.inc("new")
+    return path
+
+
+@timed("job")
+def collect_garbage() -> int:
+    """Delete image files no pending or recent broadcast refers to. Returns the number deleted."""
+    since = (datetime.now(timezone.utc) - timedelta(days=BROADCAST_IMAGE_KEEP_DAYS)).strftime("%Y-%m-%d %H:%M:%S")
+    refs = {os.path.abspath(path) for path in get_broadcast_image_refs(since)}
+    cutoff = time.time() - GRACE_SECONDS
+
+    removed = files = size = 0
+    # Also walks the flat uuid-named files saved before the store was sharded
+    for root, _, names in os.walk(BROADCAST_UPLOAD_DIR):
+        for name in names:
+            path = os.path.abspath(os.path.join(root, name))
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            if path not in refs and stat.st_mtime < cutoff:
+                if os.stat(path).st_mtime >= cutoff:  # re-uploaded meanwhile
+                    continue
+                os.remove(path)
+                removed += 1
+                continue
+            files += 1
+            size += stat.st_size
+
+    IMAGE_FILES.set(files)
+    IMAGE_BYTES.set(size)
+    IMAGES_REMOVED.inc(amount=removed)
+    logger.info("Image store: %d files (%d bytes), %d removed", files, size, removed)
+    return removed
@@ -0,0 +1,283 @@
+"""Load test: drive simulated users through the real bot Application.
+
+Every virtual user goes start → persons → day → time → name → phone →
+my booking → (sometimes) cancel. Updates are fed into the Application built
+by bot.build_application(); outgoing Bot API calls are answered by a fake
+bot with simulated latency. Uses its own temporary database.
+
+Usage:
+    python loadtest.py                       # 10, 100 and 1000 users
+    python loadtest.py --users 50 --latency 0.1 --capacity 10
+    python loadtest.py --db test.db --reset  # reuse a file; wipes its bookings and schedule
+"""
+
+import argparse
+import asyncio
+import logging
+import os
+import random
+import tempfile
+import time
+from collections import defaultdict
+from datetime import date, timedelta
+
+
+def percentile(values: list[float], pct: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+class ApiRecorder:
+    """Outgoing Bot API calls seen by the fake bot, and virtual users waiting for a reply."""
+
+    def __init__(self, latency: float):
+        self.latency = latency
+        self.calls = defaultdict(int)
+        self.waiters: dict[int, asyncio.Future] = {}
+        self.message_id = 0
+
+
+def make_fake_bot(recorder: ApiRecorder):
+    from telegram.ext import ExtBot
+
+    class FakeBot(ExtBot):
+        """Answers Bot API calls locally and hands each reply to the waiting virtual user."""
+
+        async def _do_post(self, endpoint, data, **kwargs):
+            recorder.calls[endpoint] += 1
+            if endpoint == "getMe":
+                return {"id": 123456, "is_bot": True, "first_name": "LoadTest", "username": "loadtest_bot"}
+            await asyncio.sleep(recorder.latency * random.uniform(0.5, 1.5))
+            if endpoint not in ("sendMessage", "editMessageText"):
+                return True
+
+            chat_id = int(data["chat_id"]) if "chat_id" in data else None
+            recorder.message_id += 1
+            message = {
+                "message_id": data.get("message_id", recorder.message_id),
+                "date": int(time.time()),
+                "chat": {"id": chat_id or 0, "type": "private"},
+                "text": data.get("text", ""),
+            }
+            waiter = recorder.waiters.pop(chat_id, None)
+            if waiter and not waiter.done():
+                waiter.set_result((data.get("text", ""), data.get("reply_markup")))
+            return message
+
+    return FakeBot(token="123456:LOADTEST")
+
+
+class VirtualUser:
+    def __init__(self, user_id: int, app, recorder: ApiRecorder, stats, cancel_ratio: float):
+        self.user_id = user_id
+        self.app = app
+        self.recorder = recorder
+        self.stats = stats
+        self.cancel_ratio = cancel_ratio
+        self._seq = 0
+
+    def _user(self):
+        return {"id": self.user_id, "is_bot": False, "first_name": f"User{self.user_id}"}
+
+    def _next_id(self) -> int:
+        self._seq += 1
+        return self.user_id * 100 + self._seq
+
+    async def _send(self, step: str, payload: dict):
+        from telegram import Update
+
+        waiter = asyncio.get_running_loop().create_future()
+        self.recorder.waiters[self.user_id] = waiter
+        update = Update.de_json({"update_id": self._next_id(), **payload}, self.app.bot)
+        started = time.perf_counter()
+        await self.app.update_queue.put(update)
+        try:
+            text, markup = await asyncio.wait_for(waiter, timeout=60)
+        except asyncio.TimeoutError:
+            self.stats["outcomes"]["timeout"] += 1
+            return None, None
+        self.stats["latency"][step].append(time.perf_counter() - started)
+        self.stats["updates"] += 1
+        return text, markup
+
+    async def text(self, step: str, text: str):
+        entities = [{"type": "bot_command", "offset": 0, "length": len(text)}] if text.startswith("/") else []
+        return await self._send(step, {"message": {
+            "message_id": self._next_id(),
+            "date": int(time.time()),
+            "chat": {"id": self.user_id, "type": "private"},
+            "from": self._user(),
+            "text": text,
+            "entities": entities,
+        }})
+
+    async def press(self, step: str, data: str):
+        return await self._send(step, {"callback_query": {
+            "id": str(self._next_id()),
+            "from": self._user(),
+            "chat_instance": str(self.user_id),
+            "data": data,
+            "message": {
+                "message_id": 1,
+                "date": int(time.time()),
+                "chat": {"id": self.user_id, "type": "private"},
+                "text": "",
+            },
+        }})
+
+    @staticmethod
+    def _choices(markup, prefix: str) -> list[str]:
+        from telegram import InlineKeyboardMarkup
+
+        # Steps that end the dialog answer with the main menu, a reply keyboard without callbacks
+        if not isinstance(markup, InlineKeyboardMarkup):
+            return []
+        return [
+            button.callback_data
+            for row in markup.inline_keyboard for button in row
+            if button.callback_data and button.callback_data.startswith(prefix)
+        ]
+
+    async def run(self):
+        outcomes = self.stats["outcomes"]
+        await self.text("start", "/start")
+        text, markup = await self.text("start_booking", "✅ Записаться на экскурсию")
+        if not self._choices(markup, "persons_"):
+            outcomes["already_booked"] += 1
+            return
+
+        text, markup = await self.press("persons_chosen", f"persons_{random.randint(1, 3)}")
+        days = self._choices(markup, "day_")
+        if not days:
+            outcomes["no_dates"] += 1
+            return
+
+        text, markup = await self.press("day_chosen", random.choice(days))
+        times = self._choices(markup, "time_")
+        if not times:
+            outcomes["no_times"] += 1
+            return
+
+        text, markup = await self.press("time_chosen", random.choice(times))
+        if not text or "Введите имя" not in text:
+            outcomes["slot_taken_at_hold"] += 1
+            return
+
+        await self.text("name_entered", f"Гость {self.user_id}")
+        text, markup = await self.text("phone_entered", f"+7900{self.user_id % 10_000_000:07d}")
+        if not text:
+            return
+        if "подтверждена" in text:
+            outcomes["booked"] += 1
+        elif "заняли" in text:
+            outcomes["slot_taken"] += 1
+        else:
+            outcomes["queue_full"] += 1
+            return
+
+        await self.text("my_booking", "📄 Моя запись")
+        if random.random() < self.cancel_ratio:
+            await self.text("cancel_booking", "❌ Отменить запись")
+
+
+def seed_schedule(days: int, capacity: int):
+    """Fresh tables and one weekly rule: 09:00 and 15:00 every day for `days` days.
+    Days are created lazily as virtual users pick them, like in production.
+    Wipes bookings and the schedule: main() only allows it on a new or --reset database."""
+    from booking_cache import booking_cache
+    from db import get_db
+
+    # Bookings are wiped below; entries cached by the previous level would still show them
+    booking_cache.clear()
+    with get_db() as conn:
+        for table in ("bookings", "seat_holds", "user_sessions", "booking_events", "event_offsets",
+                      "day_stats", "slot_stats", "time_slots", "days", "schedule_rules"):
+            conn.execute(f"DELETE FROM {table}")
+        conn.execute("""
+            INSERT INTO schedule_rules (kind, date_from, date_to, times, capacity, created_at)
+            VALUES ('weekly', ?, ?, '09:00,15:00', ?, datetime('now'))
+        """, (
+            (date.today() + timedelta(days=1)).isoformat(),
+            (date.today() + timedelta(days=days)).isoformat(),
+            capacity,
+        ))
+        conn.commit()
+
+
+async def run_level(users: int, args) -> dict:
+    from bot import build_application
+
+    seed_schedule(args.days, args.capacity)
+    recorder = ApiRecorder(args.latency)
+    app = build_application(bot=make_fake_bot(recorder))
+    stats = {"latency": defaultdict(list), "outcomes": defaultdict(int), "updates": 0}
+
+    await app.initialize()
+    await app.start()
+    started = time.perf_counter()
+    vus = [VirtualUser(1_000_000 + i, app, recorder, stats, args.cancel_ratio) for i in range(users)]
+    await asyncio.gather(*(vu.run() for vu in vus))
+    elapsed = time.perf_counter() - started
+    await app.stop()
+    await app.shutdown()
+
+    stats["elapsed"] = elapsed
+    stats["api_calls"] = dict(recorder.calls)
+    return stats
+
+
+def report(users: int, stats: dict):
+    elapsed = stats["elapsed"]
+    print(f"\n=== {users} virtual users: {elapsed:.1f}s, "
+          f"{stats['updates']} updates, {stats['updates'] / elapsed:.1f} updates/sec ===")
+    print(f"{'handler':<16}{'n':>6}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+    for step, values in stats["latency"].items():
+        print(f"{step:<16}{len(values):>6}"
+              f"{percentile(values, 50) * 1000:>10.1f}{percentile(values, 95) * 1000:>10.1f}"
+              f"{percentile(values, 99) * 1000:>10.1f}{max(values) * 1000:>10.1f}")
+
+    outcomes = stats["outcomes"]
+    attempts = outcomes["booked"] + outcomes["slot_taken"] + outcomes["queue_full"]
+    print("outcomes: " + ", ".join(f"{k}={v}" for k, v in sorted(outcomes.items())))
+    if attempts:
+        print(f"bookings: {outcomes['booked'] / attempts:.0%} confirmed, "
+              f"{outcomes['slot_taken'] / attempts:.0%} slot taken, "
+              f"{outcomes['queue_full'] / attempts:.0%} rejected as busy")
+
+
+async def run_levels(args):
+    # One event loop for all levels: the booking admission queue is bound to it
+    for users in args.users:
+        stats = await run_level(users, args)
+        report(users, stats)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, nargs="+", default=[10, 100, 1000])
+    parser.add_argument("--latency", type=float, default=0.05, help="simulated Bot API latency, seconds")
+    parser.add_argument("--days", type=int, default=3, help="days in the test schedule")
+    parser.add_argument("--capacity", type=int, default=30, help="seats per time slot")
+    parser.add_argument("--cancel-ratio", type=float, default=0.3, help="share of users who cancel at the end")
+    parser.add_argument("--db", default=None, help="database file (default: a temporary one)")
+    parser.add_argument("--reset", action="store_true",
+                        help="allow --db to point to an existing database; its bookings and schedule are deleted")
+    args = parser.parse_args()
+    if args.db and os.path.exists(args.db) and not args.reset:
+        parser.error(f"{args.db} exists and the load test deletes its bookings and schedule; "
+                     "pass --reset to do that anyway")
+
+    # Must be set before config/db are imported
+    os.environ["DB_PATH"] = args.db or os.path.join(tempfile.mkdtemp(prefix="loadtest-"), "excursions.db")
+    from db import init_db
+
+    init_db()
+    logging.getLogger("excursion_bot").setLevel(logging.WARNING)
+
+    asyncio.run(run_levels(args))
+
+
+if __name__ == "__main__":
+    main()
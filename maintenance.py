@@ -0,0 +1,160 @@
+"""WAL checkpoints and storage upkeep, run by the bot's scheduler.
+
+Connections keep SQLite's autocheckpoint only as a safety net
+(WAL_AUTOCHECKPOINT pages, see connection.connect); otherwise the commit
+that crosses the threshold pays for the checkpoint, and that is usually a
+booking. Instead, every WAL_CHECK_INTERVAL seconds a PASSIVE checkpoint
+copies what it can without waiting for anyone. If that copied everything
+(no reader holds old frames) and the -wal file has grown past
+WAL_TRUNCATE_MB, a TRUNCATE checkpoint with a short busy timeout also resets
+it to zero, so a long admin read or a bulk job no longer leaves it grown for
+good.
+
+optimize() runs `PRAGMA optimize` and, if the database uses
+auto_vacuum = INCREMENTAL, frees empty pages a few at a time.
+
+Usage:
+    python maintenance.py                          # WAL / file status
+    python maintenance.py enable-incremental-vacuum  # one-off VACUUM, stop the bot first
+"""
+
+import argparse
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+from config import DB_PATH, WAL_TRUNCATE_MB
+from connection import BUSY_TIMEOUT, connect
+from metrics import Counter, Gauge, Histogram, timed
+
+logger = logging.getLogger("excursion_bot")
+
+CHECKPOINT_SECONDS = Histogram("excursion_wal_checkpoint_seconds", "Duration of WAL checkpoints", ("mode",))
+CHECKPOINT_BUSY = Counter("excursion_wal_checkpoint_busy_total", "Checkpoints that could not finish because of readers or writers", ("mode",))
+WAL_PENDING = Gauge("excursion_wal_pending_frames", "WAL frames not yet copied into the database after the last checkpoint")
+FREELIST_PAGES = Gauge("excursion_db_freelist_pages", "Unused pages in the database file")
+VACUUMED_PAGES = Counter("excursion_db_incremental_vacuum_pages_total", "Pages returned to the file system by incremental vacuum")
+
+TRUNCATE_BUSY_TIMEOUT_MS = 200
+VACUUM_STEP_PAGES = 100
+VACUUM_STEP_PAUSE = 0.05
+
+
+def _file_size(path: str) -> int:
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
+
+
+Gauge("excursion_wal_size_bytes", "Size of the -wal file", lambda: _file_size(DB_PATH + "-wal"))
+Gauge("excursion_db_size_bytes", "Size of the database file", lambda: _file_size(DB_PATH))
+
+
+class WalMaintenance:
+    def __init__(self, path: str = DB_PATH, truncate_bytes: int = int(WAL_TRUNCATE_MB * 1024 * 1024)):
+        self.path = path
+        self.truncate_bytes = truncate_bytes
+        self._conn: sqlite3.Connection | None = None
+        self._lock = threading.Lock()
+
+    def _connection(self) -> sqlite3.Connection:
+        if self._conn is None:
+            self._conn = connect(self.path, check_same_thread=False, isolation_level=None)
+        return self._conn
+
+    def _checkpoint(self, mode: str) -> tuple[int, int, int]:
+        started = time.perf_counter()
+        busy, log, checkpointed = self._connection().execute(f"PRAGMA wal_checkpoint({mode})").fetchone()
+        CHECKPOINT_SECONDS.observe(time.perf_counter() - started, mode.lower())
+        if busy:
+            CHECKPOINT_BUSY.inc(mode.lower())
+        WAL_PENDING.set(max(log - checkpointed, 0))
+        return busy, log, checkpointed
+
+    @timed("job")
+    def checkpoint(self) -> str:
+        """PASSIVE checkpoint; TRUNCATE too if it caught up and the -wal file is
+        larger than truncate_bytes. Returns the last mode used."""
+        with self._lock:
+            conn = self._connection()
+            busy, log, checkpointed = self._checkpoint("PASSIVE")
+            # Frames still needed by a reader: TRUNCATE would only wait for it, holding writers back
+            if busy or log != checkpointed or _file_size(self.path + "-wal") <= self.truncate_bytes:
+                return "passive"
+
+            conn.execute(f"PRAGMA busy_timeout = {TRUNCATE_BUSY_TIMEOUT_MS}")
+            try:
+                busy, _, _ = self._checkpoint("TRUNCATE")
+            finally:
+                conn.execute(f"PRAGMA busy_timeout = {BUSY_TIMEOUT * 1000}")
+            if busy:
+                logger.info("WAL truncate skipped: database busy")
+            return "truncate"
+
+    @timed("job")
+    def optimize(self) -> int:
+        """PRAGMA optimize, then incremental vacuum if enabled. Returns pages freed."""
+        with self._lock:
+            conn = self._connection()
+            conn.execute("PRAGMA optimize")
+            freed = 0
+            if conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 2:  # INCREMENTAL
+                while True:
+                    free = conn.execute("PRAGMA freelist_count").fetchone()[0]
+                    if not free:
+                        break
+                    conn.execute(f"PRAGMA incremental_vacuum({VACUUM_STEP_PAGES})").fetchall()
+                    step = free - conn.execute("PRAGMA freelist_count").fetchone()[0]
+                    if step <= 0:
+                        break
+                    freed += step
+                    time.sleep(VACUUM_STEP_PAUSE)
+                VACUUMED_PAGES.inc(amount=freed)
+            FREELIST_PAGES.set(conn.execute("PRAGMA freelist_count").fetchone()[0])
+        if freed:
+            logger.info("Incremental vacuum freed %d pages", freed)
+        return freed
+
+    def status(self) -> dict:
+        with self._lock:
+            conn = self._connection()
+            return {
+                "db_bytes": _file_size(self.path),
+                "wal_bytes": _file_size(self.path + "-wal"),
+                "page_size": conn.execute("PRAGMA page_size").fetchone()[0],
+                "freelist_pages": conn.execute("PRAGMA freelist_count").fetchone()[0],
+                "auto_vacuum": ("none", "full", "incremental")[conn.execute("PRAGMA auto_vacuum").fetchone()[0]],
+            }
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+
+wal_maintenance = WalMaintenance()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Обслуживание файла базы")
+    commands = parser.add_subparsers(dest="command")
+    commands.add_parser("enable-incremental-vacuum")
+    args = parser.parse_args()
+
+    if args.command == "enable-incremental-vacuum":
+        # auto_vacuum can only be switched on by rebuilding the file
+        conn = connect(isolation_level=None)
+        conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        conn.execute("VACUUM")
+        conn.close()
+
+    for key, value in wal_maintenance.status().items():
+        print(f"{key}: {value}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,178 @@
+"""Process-local metrics in the Prometheus text format.
+
+Both processes keep their own registry: the bot serves it with
+start_http_server(), web_admin on GET /metrics.
+"""
+
+import asyncio
+import functools
+import inspect
+import logging
+import time
+from bisect import bisect_left
+from collections import defaultdict
+
+logger = logging.getLogger("excursion_bot")
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+_registry: list = []
+
+
+def _labels(names: tuple, values: tuple, extra: str = "") -> str:
+    pairs = [f'{n}="{v}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Counter:
+    def __init__(self, name: str, help: str, labelnames: tuple = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self.values: dict[tuple, float] = defaultdict(float)
+        _registry.append(self)
+
+    def inc(self, *labelvalues, amount: float = 1):
+        self.values[labelvalues] += amount
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        for labelvalues, value in self.values.items():
+            lines.append(f"{self.name}{_labels(self.labelnames, labelvalues)} {value}")
+        return lines
+
+
+class Gauge:
+    """A value that is set directly, or read from `function` at scrape time."""
+
+    def __init__(self, name: str, help: str, function=None):
+        self.name = name
+        self.help = help
+        self.function = function
+        self.value = 0.0
+        _registry.append(self)
+
+    def set(self, value: float):
+        self.value = value
+
+    def render(self) -> list[str]:
+        value = self.value
+        if self.function is not None:
+            try:
+                value = self.function()
+            except Exception:
+                logger.exception("Gauge %s failed", self.name)
+                return []
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} gauge", f"{self.name} {value}"]
+
+
+class Histogram:
+    def __init__(self, name: str, help: str, labelnames: tuple = (), buckets: tuple = DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self.buckets = buckets
+        # labelvalues -> [count per bucket (last one is +Inf), sum]
+        self.series: dict[tuple, list] = {}
+        _registry.append(self)
+
+    def observe(self, value: float, *labelvalues):
+        series = self.series.get(labelvalues)
+        if series is None:
+            series = self.series[labelvalues] = [[0] * (len(self.buckets) + 1), 0.0]
+        series[0][bisect_left(self.buckets, value)] += 1
+        series[1] += value
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for labelvalues, (counts, total) in self.series.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = 'le="+Inf"' if bound == float("inf") else f'le="{bound}"'
+                lines.append(f"{self.name}_bucket{_labels(self.labelnames, labelvalues, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels(self.labelnames, labelvalues)} {total}")
+            lines.append(f"{self.name}_count{_labels(self.labelnames, labelvalues)} {cumulative}")
+        return lines
+
+
+def render() -> str:
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+# ── Call instrumentation ──
+
+CALLS = Counter("excursion_calls_total", "Calls of instrumented functions", ("kind", "name"))
+ERRORS = Counter("excursion_errors_total", "Calls that raised an exception", ("kind", "name"))
+LATENCY = Histogram("excursion_call_duration_seconds", "Duration of instrumented calls", ("kind", "name"))
+
+
+def timed(kind: str):
+    """Count calls, errors and latency of a sync or async function.
+    `kind` groups functions: handler, db, job."""
+
+    def decorator(func):
+        name = func.__name__
+
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                started = time.perf_counter()
+                try:
+                    return await func(*args, **kwargs)
+                except Exception:
+                    ERRORS.inc(kind, name)
+                    raise
+                finally:
+                    CALLS.inc(kind, name)
+                    LATENCY.observe(time.perf_counter() - started, kind, name)
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            except Exception:
+                ERRORS.inc(kind, name)
+                raise
+            finally:
+                CALLS.inc(kind, name)
+                LATENCY.observe(time.perf_counter() - started, kind, name)
+        return wrapper
+
+    return decorator
+
+
+# ── HTTP listener for the bot process ──
+
+async def _handle_http(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    try:
+        request_line = await asyncio.wait_for(reader.readline(), timeout=5)
+        parts = request_line.decode("latin-1").split()
+        if len(parts) >= 2 and parts[0] == "GET" and parts[1].split("?")[0] == "/metrics":
+            status, body = "200 OK", render().encode()
+        else:
+            status, body = "404 Not Found", b"not found\n"
+        writer.write(
+            f"HTTP/1.1 {status}\r\n"
+            "Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            "Connection: close\r\n\r\n".encode() + body
+        )
+        await writer.drain()
+    except Exception as e:
+        logger.debug("Metrics request failed: %s", e)
+    finally:
+        writer.close()
+
+
+async def start_http_server(port: int, host: str = "0.0.0.0") -> asyncio.AbstractServer:
+    server = await asyncio.start_server(_handle_http, host, port)
+    logger.info("Metrics listening on %s:%d/metrics", host, port)
+    return server
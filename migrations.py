@@ -0,0 +1,350 @@
+"""Versioned schema migrations, keyed on PRAGMA user_version.
+
+migrate() reads user_version and returns at once when the schema is
+current, so a normal start costs one connection and one PRAGMA and takes no
+write lock. Otherwise each missing step runs in its own short BEGIN
+IMMEDIATE transaction that also bumps user_version; a step that fills a new
+index or table from existing rows does it afterwards in batches of
+BACKFILL_BATCH rows (online mode), so the other process keeps writing in
+between. Steps are idempotent, so a run interrupted between transactions or
+raced by the other container simply continues.
+
+To change the schema, append a step to MIGRATIONS; never edit an applied one.
+
+Usage:
+    python migrations.py              # apply missing steps, online
+    python migrations.py --offline    # backfills in one transaction each (faster, stop the bot first)
+"""
+
+import argparse
+import logging
+import sqlite3
+import time
+
+from config import DB_PATH
+from connection import connect
+from db import SEARCH_INDEXES, _rebuild_stats
+from metrics import timed
+
+logger = logging.getLogger("excursion_bot")
+
+BACKFILL_BATCH = 1000
+BACKFILL_PAUSE = 0.01  # seconds between batches, lets waiting writers in
+
+
+# ── Steps ──
+
+# The schema as it was before migrations; existing databases have most of it already
+BASE_SCHEMA = [
+    """CREATE TABLE IF NOT EXISTS days (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        date TEXT NOT NULL UNIQUE,
+        capacity_day INTEGER NOT NULL
+    )""",
+    """CREATE TABLE IF NOT EXISTS time_slots (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        day_id INTEGER NOT NULL,
+        time TEXT NOT NULL,
+        capacity_time INTEGER NOT NULL,
+        FOREIGN KEY (day_id) REFERENCES days(id)
+    )""",
+    """CREATE TABLE IF NOT EXISTS bookings (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        telegram_user_id INTEGER NOT NULL,
+        name TEXT NOT NULL,
+        persons INTEGER NOT NULL,
+        day_id INTEGER NOT NULL,
+        time_slot_id INTEGER NOT NULL,
+        created_at TEXT NOT NULL,
+        reminder_sent INTEGER DEFAULT 0,
+        phone TEXT,
+        FOREIGN KEY (day_id) REFERENCES days(id),
+        FOREIGN KEY (time_slot_id) REFERENCES time_slots(id)
+    )""",
+    "CREATE UNIQUE INDEX IF NOT EXISTS idx_bookings_user ON bookings(telegram_user_id)",
+    "CREATE INDEX IF NOT EXISTS idx_bookings_day_id ON bookings(day_id)",
+    "CREATE INDEX IF NOT EXISTS idx_bookings_time_slot_id ON bookings(time_slot_id)",
+    """CREATE TABLE IF NOT EXISTS subscribers (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        telegram_user_id INTEGER NOT NULL UNIQUE,
+        username TEXT,
+        first_name TEXT,
+        last_name TEXT,
+        phone TEXT,
+        status TEXT NOT NULL DEFAULT 'active',
+        created_at TEXT NOT NULL,
+        updated_at TEXT NOT NULL
+    )""",
+    """CREATE TABLE IF NOT EXISTS broadcasts (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        text TEXT NOT NULL,
+        image_path TEXT,
+        button_text TEXT,
+        button_url TEXT,
+        status TEXT NOT NULL DEFAULT 'scheduled',
+        scheduled_at TEXT,
+        sent_at TEXT,
+        completed_at TEXT,
+        total INTEGER DEFAULT 0,
+        success INTEGER DEFAULT 0,
+        failed INTEGER DEFAULT 0,
+        created_at TEXT NOT NULL
+    )""",
+    """CREATE TABLE IF NOT EXISTS user_sessions (
+        telegram_user_id INTEGER PRIMARY KEY,
+        data TEXT NOT NULL,
+        updated_at TEXT NOT NULL
+    )""",
+    """CREATE TABLE IF NOT EXISTS seat_holds (
+        telegram_user_id INTEGER PRIMARY KEY,
+        time_slot_id INTEGER NOT NULL,
+        persons INTEGER NOT NULL,
+        expires_at TEXT NOT NULL
+    )""",
+    "CREATE INDEX IF NOT EXISTS idx_seat_holds_slot ON seat_holds(time_slot_id, expires_at)",
+    "CREATE INDEX IF NOT EXISTS idx_seat_holds_expires ON seat_holds(expires_at)",
+    """CREATE TABLE IF NOT EXISTS query_stats (
+        source TEXT NOT NULL,
+        fingerprint TEXT NOT NULL,
+        calls INTEGER NOT NULL,
+        total_ms REAL NOT NULL,
+        max_ms REAL NOT NULL,
+        rows INTEGER NOT NULL,
+        slow_calls INTEGER NOT NULL,
+        plan TEXT,
+        updated_at TEXT NOT NULL,
+        PRIMARY KEY (source, fingerprint)
+    )""",
+    # Keyed by date/time, not ids: rows of past dates are kept as history,
+    # also after the days themselves are archived
+    """CREATE TABLE IF NOT EXISTS day_stats (
+        date TEXT PRIMARY KEY,
+        capacity INTEGER NOT NULL,
+        booked INTEGER NOT NULL DEFAULT 0,
+        bookings INTEGER NOT NULL DEFAULT 0,
+        cancellations INTEGER NOT NULL DEFAULT 0,
+        updated_at TEXT NOT NULL
+    )""",
+    """CREATE TABLE IF NOT EXISTS slot_stats (
+        date TEXT NOT NULL,
+        time TEXT NOT NULL,
+        capacity INTEGER NOT NULL,
+        booked INTEGER NOT NULL DEFAULT 0,
+        bookings INTEGER NOT NULL DEFAULT 0,
+        cancellations INTEGER NOT NULL DEFAULT 0,
+        updated_at TEXT NOT NULL,
+        PRIMARY KEY (date, time)
+    )""",
+    # Append-only change feed of bookings; seq is never reused
+    """CREATE TABLE IF NOT EXISTS booking_events (
+        seq INTEGER PRIMARY KEY AUTOINCREMENT,
+        kind TEXT NOT NULL,
+        booking_id INTEGER NOT NULL,
+        telegram_user_id INTEGER NOT NULL,
+        persons INTEGER NOT NULL,
+        time_slot_id INTEGER NOT NULL,
+        date TEXT,
+        time TEXT,
+        created_at TEXT NOT NULL
+    )""",
+    """CREATE TABLE IF NOT EXISTS event_offsets (
+        consumer TEXT PRIMARY KEY,
+        seq INTEGER NOT NULL,
+        updated_at TEXT NOT NULL
+    )""",
+    # kind: weekly (times on the given weekdays), override (replaces the weekly
+    # times on those dates), closed (no excursions); date_to NULL = open-ended
+    """CREATE TABLE IF NOT EXISTS schedule_rules (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        kind TEXT NOT NULL,
+        date_from TEXT NOT NULL,
+        date_to TEXT,
+        weekdays TEXT,
+        times TEXT,
+        capacity INTEGER,
+        note TEXT,
+        created_at TEXT NOT NULL
+    )""",
+    # Legacy table
+    "DROP TABLE IF EXISTS slots",
+]
+
+
+def _base_schema(conn):
+    for sql in BASE_SCHEMA:
+        conn.execute(sql)
+
+
+def _stats_backfill(conn):
+    """Databases with bookings from before day_stats / slot_stats existed."""
+    has_bookings = conn.execute("SELECT 1 FROM bookings LIMIT 1").fetchone() is not None
+    has_stats = conn.execute("SELECT 1 FROM day_stats LIMIT 1").fetchone() is not None
+    if has_bookings and not has_stats:
+        _rebuild_stats(conn)
+
+
+def _search_index(conn):
+    """FTS5 trigram tables (rowid = source id) kept in sync by triggers."""
+    for table, (columns, sources) in SEARCH_INDEXES.items():
+        fts = f"{table}_fts"
+        new_values = ", ".join(sources).format(row="new.")
+        conn.execute(f"""
+            CREATE VIRTUAL TABLE IF NOT EXISTS {fts}
+            USING fts5({", ".join(columns)}, tokenize = 'trigram')
+        """)
+        conn.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS {fts}_insert AFTER INSERT ON {table} BEGIN
+                INSERT INTO {fts} (rowid, {", ".join(columns)}) VALUES (new.id, {new_values});
+            END
+        """)
+        conn.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS {fts}_update AFTER UPDATE ON {table} BEGIN
+                DELETE FROM {fts} WHERE rowid = old.id;
+                INSERT INTO {fts} (rowid, {", ".join(columns)}) VALUES (new.id, {new_values});
+            END
+        """)
+        conn.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS {fts}_delete AFTER DELETE ON {table} BEGIN
+                DELETE FROM {fts} WHERE rowid = old.id;
+            END
+        """)
+
+
+def _search_backfill(conn, limit: int) -> int:
+    """Index up to `limit` rows written before the triggers existed."""
+    done = 0
+    for table, (columns, sources) in SEARCH_INDEXES.items():
+        fts = f"{table}_fts"
+        done += conn.execute(f"""
+            INSERT INTO {fts} (rowid, {", ".join(columns)})
+            SELECT t.id, {", ".join(sources).format(row="t.")} FROM {table} t
+            WHERE NOT EXISTS (SELECT 1 FROM {fts} WHERE rowid = t.id)
+            LIMIT ?
+        """, (limit,)).rowcount
+    return done
+
+
+def _lookup_indexes(conn):
+    # Slots of a day: availability, schedule diff, archival
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_time_slots_day ON time_slots(day_id, time)")
+    # claim_pending_broadcasts() every minute
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_broadcasts_status ON broadcasts(status, scheduled_at)")
+    # Cancelled bookings export
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_booking_events_kind_date ON booking_events(kind, date)")
+    # get_pending_reminders() every 30 minutes
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_bookings_reminder ON bookings(day_id) WHERE reminder_sent = 0")
+
+
+# Tables the synced caches read (see cache_sync.py); stats change together with bookings
+CACHED_TABLES = ("days", "time_slots", "bookings", "seat_holds", "schedule_rules", "day_stats")
+
+
+def _cache_version(conn):
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS cache_version (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            version INTEGER NOT NULL
+        )
+    """)
+    conn.execute("INSERT OR IGNORE INTO cache_version (id, version) VALUES (1, 0)")
+    for table in CACHED_TABLES:
+        for event in ("INSERT", "UPDATE", "DELETE"):
+            # reminder_sent does not change availability
+            target = "UPDATE OF persons, day_id, time_slot_id" if (table, event) == ("bookings", "UPDATE") else event
+            conn.execute(f"""
+                CREATE TRIGGER IF NOT EXISTS {table}_cache_{event.lower()} AFTER {target} ON {table} BEGIN
+                    UPDATE cache_version SET version = version + 1 WHERE id = 1;
+                END
+            """)
+
+
+# (version, description, DDL step, optional batched backfill)
+MIGRATIONS = [
+    (1, "base schema", _base_schema, None),
+    (2, "day/slot stats backfill", _stats_backfill, None),
+    (3, "search index", _search_index, _search_backfill),
+    (4, "lookup indexes", _lookup_indexes, None),
+    (5, "cache version triggers", _cache_version, None),
+]
+LATEST = MIGRATIONS[-1][0]
+
+
+# ── Runner ──
+
+def _version(conn) -> int:
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+
+def _in_transaction(conn, func, *args):
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        result = func(conn, *args)
+        conn.execute("COMMIT")
+        return result
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+
+
+def _set_version(conn, number: int) -> bool:
+    # Re-checked under the write lock: the other process may have got here first
+    if _version(conn) >= number:
+        return False
+    conn.execute(f"PRAGMA user_version = {number}")
+    return True
+
+
+def _step(conn, number: int, apply, backfill, online: bool) -> bool:
+    def ddl(conn):
+        if _version(conn) >= number:
+            return False
+        apply(conn)
+        if backfill is None:
+            _set_version(conn, number)
+        return True
+
+    if not _in_transaction(conn, ddl):
+        return False
+    if backfill is not None:
+        limit = BACKFILL_BATCH if online else -1
+        while _in_transaction(conn, backfill, limit) >= BACKFILL_BATCH and online:
+            time.sleep(BACKFILL_PAUSE)
+        _in_transaction(conn, _set_version, number)
+    return True
+
+
+@timed("db")
+def migrate(online: bool = True, path: str = DB_PATH) -> int:
+    """Apply missing migrations. Returns the number of steps applied."""
+    conn = connect(path, isolation_level=None)
+    try:
+        version = _version(conn)
+        if version >= LATEST:
+            return 0
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode = WAL")
+        applied = 0
+        for number, description, apply, backfill in MIGRATIONS:
+            if number <= version:
+                continue
+            started = time.perf_counter()
+            if _step(conn, number, apply, backfill, online):
+                applied += 1
+                logger.info("Migration %d (%s) applied in %.2fs", number, description, time.perf_counter() - started)
+        return applied
+    finally:
+        conn.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Миграции схемы базы")
+    parser.add_argument("--offline", action="store_true")
+    args = parser.parse_args()
+    applied = migrate(online=not args.offline)
+    conn = connect()
+    print(f"Applied {applied} migration(s), schema version {_version(conn)} (latest {LATEST})")
+    conn.close()
+
+
+if __name__ == "__main__":
+    main()
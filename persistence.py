@@ -0,0 +1,157 @@
+import asyncio
+import json
+import logging
+from typing import Callable
+
+from telegram.ext import BasePersistence, PersistenceInput
+
+from db import get_user_session, save_user_sessions
+
+logger = logging.getLogger("excursion_bot")
+
+
+class SQLitePersistence(BasePersistence):
+    """Keeps the booking dialog state (user_data) in the user_sessions table.
+
+    Sessions are loaded lazily on a user's first update after start. Changed
+    sessions are collected by the Application every `update_interval` seconds
+    and written in one transaction; an empty session deletes its row.
+    """
+
+    def __init__(self, update_interval: float = 10, is_busy: Callable[[int], bool] | None = None):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+            update_interval=update_interval,
+        )
+        self._loaded: set[int] = set()
+        # Users whose session may have changes the Application has not handed over yet
+        self._pending: set[int] = set()
+        # Whether an update of the user is still running (PerUserUpdateProcessor.is_busy)
+        self._is_busy = is_busy or (lambda user_id: False)
+        self._dirty: dict[int, dict | None] = {}  # None = delete
+        self._writing: dict[int, dict | None] = {}  # the batch being written right now
+        self._flush_task: asyncio.Task | None = None
+
+    # ── user_data ──
+
+    async def get_user_data(self) -> dict:
+        # Nothing is loaded up front, see refresh_user_data
+        return {}
+
+    async def refresh_user_data(self, user_id: int, user_data) -> None:
+        # Called before the handlers of each of the user's updates
+        self._pending.add(user_id)
+        if user_id in self._loaded:
+            return
+        self._loaded.add(user_id)
+        for pending in (self._dirty, self._writing):
+            if user_id in pending:
+                # Not written yet: newer than the row
+                if pending[user_id]:
+                    user_data.update(pending[user_id])
+                return
+        raw = get_user_session(user_id)
+        if raw:
+            user_data.update(json.loads(raw))
+
+    async def update_user_data(self, user_id: int, data) -> None:
+        if not self._is_busy(user_id):
+            # A running update is marked again when it finishes and handed over next round
+            self._pending.discard(user_id)
+        if user_id not in self._loaded:
+            # Unloaded meanwhile: the Application handed over an empty stand-in, not the session
+            return
+        self._dirty[user_id] = dict(data)
+        self._schedule_flush()
+
+    async def drop_user_data(self, user_id: int) -> None:
+        self._pending.discard(user_id)
+        self._loaded.discard(user_id)
+        self._dirty[user_id] = None
+        self._schedule_flush()
+
+    def unload_user_data(self, user_id: int) -> None:
+        """Forget that the user's session is in memory; the row stays and is read
+        again on the user's next update."""
+        self._loaded.discard(user_id)
+
+    def has_pending(self, user_id: int) -> bool:
+        """Whether the user's in-memory session may hold changes not handed over yet."""
+        return user_id in self._pending
+
+    def _schedule_flush(self):
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._flush_soon())
+
+    async def _flush_soon(self):
+        # Let the rest of this Application.update_persistence() round stash its entries first
+        await asyncio.sleep(0)
+        # Entries stashed while a batch was being written go in the next one
+        while self._dirty and await self._write_dirty():
+            pass
+
+    async def _write_dirty(self) -> bool:
+        """Write the stashed entries in a worker thread, so a busy database does not
+        hold up the event loop. Returns False if the write failed."""
+        if not self._dirty:
+            return True
+        dirty, self._dirty = self._dirty, {}
+        self._writing = dirty
+        upserts = []
+        deletes = []
+        for user_id, data in dirty.items():
+            if data:
+                upserts.append((user_id, json.dumps(data, ensure_ascii=False, separators=(",", ":"))))
+            else:
+                deletes.append(user_id)
+        try:
+            await asyncio.to_thread(save_user_sessions, upserts, deletes)
+        except Exception:
+            logger.exception("Failed to save %d sessions, will retry", len(dirty))
+            for user_id, data in dirty.items():
+                self._dirty.setdefault(user_id, data)
+            return False
+        finally:
+            self._writing = {}
+        logger.debug("Sessions flushed: %d saved, %d deleted", len(upserts), len(deletes))
+        return True
+
+    async def flush(self) -> None:
+        if self._flush_task is not None:
+            await self._flush_task
+        await self._write_dirty()
+
+    # ── unused kinds of data ──
+
+    async def get_chat_data(self) -> dict:
+        return {}
+
+    async def get_bot_data(self) -> dict:
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def get_conversations(self, name: str) -> dict:
+        return {}
+
+    async def update_conversation(self, name: str, key, new_state) -> None:
+        pass
+
+    async def update_chat_data(self, chat_id: int, data: dict) -> None:
+        pass
+
+    async def update_bot_data(self, data: dict) -> None:
+        pass
+
+    async def update_callback_data(self, data) -> None:
+        pass
+
+    async def drop_chat_data(self, chat_id: int) -> None:
+        pass
+
+    async def refresh_chat_data(self, chat_id: int, chat_data: dict) -> None:
+        pass
+
+    async def refresh_bot_data(self, bot_data: dict) -> None:
+        pass
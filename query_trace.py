@@ -0,0 +1,269 @@
+"""Per-statement timing for every SQLite connection opened by db.py.
+
+Connections are created with factory=TracedConnection. Each statement is
+timed from execute() until its rows are fetched, aggregated per normalized
+query, and statements slower than SLOW_QUERY_MS are logged together with
+their EXPLAIN QUERY PLAN. Aggregates are kept per WINDOW_SECONDS window for
+the last WINDOWS windows, so the top covers the last quarter of an hour and
+queries that appeared after startup can reach it; it is periodically written
+to the query_stats table, so the admin UI can show both processes.
+"""
+
+import logging
+import re
+import sqlite3
+import threading
+import time
+from collections import deque
+from datetime import datetime
+
+from config import SLOW_QUERY_MS, QUERY_TOP_N
+from connection import connect
+from metrics import Counter, Histogram
+
+logger = logging.getLogger("excursion_bot")
+
+STATEMENT_SECONDS = Histogram("excursion_db_statement_seconds", "Execution time of single SQL statements")
+LOCK_WAIT_SECONDS = Histogram("excursion_db_lock_wait_seconds", "Time spent acquiring the write lock (BEGIN IMMEDIATE, COMMIT)")
+SLOW_STATEMENTS = Counter("excursion_db_slow_statements_total", "Statements slower than SLOW_QUERY_MS")
+
+MAX_FINGERPRINTS = 500  # per window
+WINDOW_SECONDS = 60
+WINDOWS = 15
+
+_source = "cli"
+_lock = threading.Lock()
+# Current window: fingerprint -> [calls, total_s, max_s, rows, slow_calls, sample_sql, plan]
+_stats: dict[str, list] = {}
+_window_started = time.monotonic()
+_windows: deque[dict[str, list]] = deque(maxlen=WINDOWS - 1)  # closed windows, oldest first
+_changed = False  # since the last flush
+
+_WS = re.compile(r"\s+")
+_STRING = re.compile(r"'(?:[^']|'')*'")
+_NUMBER = re.compile(r"\b\d+(?:\.\d+)?\b")
+_IN_LIST = re.compile(r"\bIN\s*\(\s*\?(?:\s*,\s*\?)*\s*\)", re.IGNORECASE)
+_EXPLAINABLE = ("SELECT", "WITH", "INSERT", "UPDATE", "DELETE")
+_LOCKING = ("BEGIN", "COMMIT", "END")
+
+
+def set_source(name: str):
+    """Name of this process in query_stats: bot / admin."""
+    global _source
+    _source = name
+
+
+def normalize(sql: str) -> str:
+    sql = _STRING.sub("?", sql)
+    sql = _NUMBER.sub("?", sql)
+    sql = _IN_LIST.sub("IN (...)", sql)
+    return _WS.sub(" ", sql).strip()
+
+
+def _explain(conn: sqlite3.Connection, sql: str, params) -> str:
+    try:
+        # A plain cursor, so the EXPLAIN itself is not traced
+        rows = sqlite3.Connection.cursor(conn).execute("EXPLAIN QUERY PLAN " + sql, params).fetchall()
+        return "\n".join(row[3] for row in rows)
+    except sqlite3.Error as e:
+        return f"(no plan: {e})"
+
+
+def _record(conn: sqlite3.Connection, sql: str, params, seconds: float, rows: int):
+    keyword = sql.lstrip()[:6].upper()
+    if keyword.startswith(_LOCKING):
+        LOCK_WAIT_SECONDS.observe(seconds)
+        return
+    STATEMENT_SECONDS.observe(seconds)
+
+    fingerprint = normalize(sql)
+    slow = seconds * 1000 >= SLOW_QUERY_MS
+    plan = None
+    if slow:
+        SLOW_STATEMENTS.inc()
+        # executemany() passes params=None: there is no single parameter set to explain
+        plan = _explain(conn, sql, params) if params is not None and keyword.startswith(_EXPLAINABLE) else ""
+        logger.warning(
+            "Slow query %.0f ms, %d rows: %s\nPlan:\n%s",
+            seconds * 1000, rows, fingerprint[:500], plan,
+        )
+
+    global _changed
+    with _lock:
+        _rotate()
+        _changed = True
+        entry = _stats.get(fingerprint)
+        if entry is None:
+            if len(_stats) >= MAX_FINGERPRINTS:
+                # Make room by dropping the cheapest query, not the new one
+                del _stats[min(_stats, key=lambda key: _stats[key][1])]
+            entry = _stats[fingerprint] = [0, 0.0, 0.0, 0, 0, sql.strip(), None]
+        entry[0] += 1
+        entry[1] += seconds
+        entry[2] = max(entry[2], seconds)
+        entry[3] += rows
+        if slow:
+            entry[4] += 1
+            entry[6] = plan
+
+
+class TracedCursor(sqlite3.Cursor):
+    _trace = None  # [sql, params, seconds, rows] of the statement being fetched
+
+    def _finish(self):
+        trace, self._trace = self._trace, None
+        if trace is not None:
+            _record(self.connection, *trace)
+
+    def execute(self, sql, parameters=()):
+        self._finish()
+        started = time.perf_counter()
+        super().execute(sql, parameters)
+        self._trace = [sql, parameters, time.perf_counter() - started, 0]
+        if self.description is None:
+            self._trace[3] = max(self.rowcount, 0)
+            self._finish()
+        return self
+
+    def executemany(self, sql, seq_of_parameters):
+        self._finish()
+        started = time.perf_counter()
+        super().executemany(sql, seq_of_parameters)
+        _record(self.connection, sql, None, time.perf_counter() - started, max(self.rowcount, 0))
+        return self
+
+    def fetchone(self):
+        started = time.perf_counter()
+        row = super().fetchone()
+        if self._trace is not None:
+            self._trace[2] += time.perf_counter() - started
+            if row is None:
+                self._finish()
+            else:
+                self._trace[3] += 1
+        return row
+
+    def fetchmany(self, size=None):
+        size = self.arraysize if size is None else size
+        started = time.perf_counter()
+        rows = super().fetchmany(size)
+        if self._trace is not None:
+            self._trace[2] += time.perf_counter() - started
+            self._trace[3] += len(rows)
+            if len(rows) < size:
+                self._finish()
+        return rows
+
+    def fetchall(self):
+        started = time.perf_counter()
+        rows = super().fetchall()
+        if self._trace is not None:
+            self._trace[2] += time.perf_counter() - started
+            self._trace[3] += len(rows)
+            self._finish()
+        return rows
+
+    def __next__(self):
+        row = self.fetchone()
+        if row is None:
+            raise StopIteration
+        return row
+
+    def close(self):
+        self._finish()
+        super().close()
+
+    def __del__(self):
+        # A single fetchone() never sees the end of the result set
+        self._finish()
+
+
+class TracedConnection(sqlite3.Connection):
+    def cursor(self, factory=TracedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+    def commit(self):
+        started = time.perf_counter()
+        super().commit()
+        LOCK_WAIT_SECONDS.observe(time.perf_counter() - started)
+
+
+def _rotate():
+    """Close the current window once it is WINDOW_SECONDS old; windows that
+    passed without a single query are added empty. Call under _lock."""
+    global _stats, _window_started, _changed
+    elapsed = int((time.monotonic() - _window_started) // WINDOW_SECONDS)
+    if not elapsed:
+        return
+    for window in [_stats] + [{}] * (min(elapsed, WINDOWS) - 1):
+        if len(_windows) == _windows.maxlen and _windows[0]:
+            _changed = True  # the oldest window falls out of the top
+        _windows.append(window)
+    _stats = {}
+    _window_started += elapsed * WINDOW_SECONDS
+
+
+def top_queries(limit: int = QUERY_TOP_N) -> list[dict]:
+    """This process's costliest normalized queries over the last WINDOWS windows, by total time."""
+    merged: dict[str, list] = {}
+    with _lock:
+        _rotate()
+        for window in (*_windows, _stats):
+            for fingerprint, (calls, total, max_s, rows, slow_calls, sample, plan) in window.items():
+                entry = merged.get(fingerprint)
+                if entry is None:
+                    merged[fingerprint] = [calls, total, max_s, rows, slow_calls, sample, plan]
+                    continue
+                entry[0] += calls
+                entry[1] += total
+                entry[2] = max(entry[2], max_s)
+                entry[3] += rows
+                entry[4] += slow_calls
+                if plan is not None:
+                    entry[6] = plan
+    items = sorted(merged.items(), key=lambda item: item[1][1], reverse=True)[:limit]
+    return [
+        {
+            "fingerprint": fingerprint, "calls": calls, "total_ms": total * 1000,
+            "avg_ms": total * 1000 / calls, "max_ms": max_s * 1000, "rows": rows,
+            "slow_calls": slow_calls, "sample_sql": sample, "plan": plan,
+        }
+        for fingerprint, (calls, total, max_s, rows, slow_calls, sample, plan) in items
+    ]
+
+
+def flush_query_stats():
+    """Write this process's top-N aggregates to query_stats (untraced connection).
+    Skipped when nothing changed since the last flush."""
+    global _changed
+    with _lock:
+        _rotate()
+        if not _changed:
+            return
+        _changed = False
+    rows = top_queries()
+    now = datetime.now().isoformat(timespec="seconds")
+    conn = connect()
+    try:
+        conn.execute("DELETE FROM query_stats WHERE source = ?", (_source,))
+        conn.executemany("""
+            INSERT INTO query_stats
+                (source, fingerprint, calls, total_ms, max_ms, rows, slow_calls, plan, updated_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """, [
+            (_source, r["fingerprint"], r["calls"], r["total_ms"], r["max_ms"],
+             r["rows"], r["slow_calls"], r["plan"], now)
+            for r in rows
+        ])
+        conn.commit()
+    except Exception:
+        _changed = True  # retry on the next flush
+        raise
+    finally:
+        conn.close()
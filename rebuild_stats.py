@@ -0,0 +1,23 @@
+"""Recompute day_stats / slot_stats from the bookings table.
+
+Run after editing bookings by hand or if the dashboards look off.
+
+Usage:
+    python rebuild_stats.py
+    # or inside Docker:
+    docker compose exec bot python rebuild_stats.py
+"""
+
+from db import init_db, rebuild_stats, get_stats
+
+
+def main():
+    init_db()
+    rebuild_stats()
+    for row in get_stats():
+        print(f"{row['date']}: {row['booked']}/{row['capacity_day']} "
+              f"({row['bookings']} bookings, {row['cancellations']} cancellations)")
+
+
+if __name__ == "__main__":
+    main()
@@ -13,6 +13,7 @@ from telegram import Bot
 
 from config import BOT_TOKEN
 from db import get_pending_reminders, mark_reminder_sent
+from render import reminder_text
 
 logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
 logger = logging.getLogger(__name__)
@@ -28,20 +29,7 @@ def main():
     rows = get_pending_reminders(from_dt, to_dt)
 
     for r in rows:
-        text = (
-            "⏰ Напоминание о записи\n\n"
-            "Завтра у вас экскурсия в теплицы «Верёвкин Хутор» 🌷\n\n"
-            f"📅 Дата: {r['date']}\n"
-            f"🕘 Время: {r['time']}\n"
-            f"👥 Количество человек: {r['persons']}\n\n"
-            "📍 Адрес:\n"
-            "Симферопольский р-н, с. Молодёжное,\n"
-            "Московское ш., 11-й км, КрымТеплица\n\n"
-            "🗺 Яндекс Карты:\n"
-            "https://yandex.ru/maps/-/CPE3zSma\n\n"
-            "⚠️ Просим приходить вовремя.\n"
-            "При опоздании более 15 минут вход может быть ограничен."
-        )
+        text = reminder_text(r["date"], r["time"], r["persons"])
 
         try:
             bot.send_message(chat_id=r["telegram_user_id"], text=text)
@@ -0,0 +1,78 @@
+"""Texts and inline keyboards of the booking flow, prepared ahead of time.
+
+Keyboards depend only on what is available (the same for every user until
+the next booking), so they are built once per availability state and shared;
+PTB's InlineKeyboardMarkup is immutable. Message templates keep their
+constant parts as module strings; handlers only fill in the user's fields.
+"""
+
+from functools import lru_cache
+
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+
+from helpers import format_day, decline_places
+
+PERSONS_KEYBOARD = InlineKeyboardMarkup([
+    [
+        InlineKeyboardButton("1", callback_data="persons_1"),
+        InlineKeyboardButton("2", callback_data="persons_2"),
+        InlineKeyboardButton("3", callback_data="persons_3"),
+    ],
+])
+
+
+@lru_cache(maxsize=256)
+def days_keyboard(days: tuple[tuple[str, int], ...]) -> InlineKeyboardMarkup:
+    """Keyboard for ((date, remaining), ...)."""
+    return InlineKeyboardMarkup([
+        [InlineKeyboardButton(f"{format_day(day)} ({decline_places(remaining)})", callback_data=f"day_{day}")]
+        for day, remaining in days
+    ])
+
+
+@lru_cache(maxsize=1024)
+def times_keyboard(times: tuple[tuple[int, str, int], ...]) -> InlineKeyboardMarkup:
+    """Keyboard for ((time_slot_id, time, remaining), ...)."""
+    return InlineKeyboardMarkup([
+        [InlineKeyboardButton(f"{slot_time} ({decline_places(remaining)})", callback_data=f"time_{slot_id}")]
+        for slot_id, slot_time, remaining in times
+    ])
+
+
+def persons_label(persons: int):
+    return "10+" if persons >= 10 else persons
+
+
+_CONFIRMATION_TAIL = "\n\nКнопки «Как проехать» и «Важная информация» доступны в меню ⬇️"
+
+
+def confirmation_text(name: str, phone: str, persons: int, date_str: str, slot_time: str) -> str:
+    return (
+        f"✅ Запись подтверждена!\n\n👤 {name}\n📞 {phone}\n👥 {persons_label(persons)} человек\n"
+        f"📅 Дата: {format_day(date_str)}\n🕒 Время: {slot_time}{_CONFIRMATION_TAIL}"
+    )
+
+
+def my_booking_text(name: str, phone: str | None, persons: int, date_str: str, slot_time: str) -> str:
+    phone_line = f"📞 Телефон: {phone}\n" if phone else ""
+    return (
+        f"📄 Моя запись\n\n👤 Имя: {name}\n{phone_line}👥 Количество: {persons_label(persons)}\n"
+        f"📅 Дата: {format_day(date_str)}\n🕒 Время: {slot_time}"
+    )
+
+
+_REMINDER_HEAD = "⏰ Напоминание о записи\n\nЗавтра у вас экскурсия в теплицы «Верёвкин Хутор» 🌷\n\n"
+_REMINDER_TAIL = (
+    "\n\n"
+    "📍 Адрес:\n"
+    "Симферопольский р-н, с. Молодёжное,\n"
+    "Московское ш., 11-й км, КрымТеплица\n\n"
+    "🗺 Яндекс Карты:\n"
+    "https://yandex.ru/maps/-/CPE3zSma\n\n"
+    "⚠️ Просим приходить вовремя.\n"
+    "При опоздании более 15 минут вход может быть ограничен."
+)
+
+
+def reminder_text(date_str: str, slot_time: str, persons: int) -> str:
+    return f"{_REMINDER_HEAD}📅 Дата: {date_str}\n🕘 Время: {slot_time}\n👥 Количество человек: {persons}{_REMINDER_TAIL}"
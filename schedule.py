@@ -0,0 +1,297 @@
+"""The excursion schedule: rules, lazy materialization and diff-applying.
+
+The schedule is defined by schedule_rules. Concrete days/time_slots rows
+exist only within SCHEDULE_HORIZON_DAYS (kept in sync by a daily job) and
+for days someone picked further ahead (created by ensure_day()); the rest
+of the BOOKING_WINDOW_DAYS window is computed from the rules when the day
+list is shown. Without any rules the rows are the schedule, as before.
+
+Rows are changed as a diff (apply_schedule()): existing rows keep their
+ids, so bookings stay attached to their day and slot, and only new days and
+slots, capacity changes and removals are written, with executemany in short
+transactions of BATCH_DAYS days each, so live bookings wait at most one
+small batch. Slots with bookings or active seat holds are never removed and
+never get less capacity; such changes are reported as conflicts and skipped.
+"""
+
+import logging
+import time
+from datetime import date, datetime, timedelta
+
+from config import SCHEDULE_HORIZON_DAYS, BOOKING_WINDOW_DAYS
+from db import _connect, get_schedule_rules, get_available_days, get_day_id, get_day_dates, create_day
+from metrics import timed
+
+logger = logging.getLogger("excursion_bot")
+
+BATCH_DAYS = 50
+BATCH_PAUSE = 0.01  # seconds between transactions, lets waiting writers in
+
+
+def _load_existing(conn, from_date: str) -> dict:
+    """date -> {"id": day_id, "slots": {time: (slot_id, capacity, taken)}} for dates >= from_date."""
+    existing = {}
+    for row in conn.execute("SELECT id, date FROM days WHERE date >= ?", (from_date,)):
+        existing[row["date"]] = {"id": row["id"], "slots": {}}
+    for row in conn.execute("""
+        SELECT d.date, ts.id, ts.time, ts.capacity_time,
+               (SELECT COUNT(*) FROM bookings WHERE time_slot_id = ts.id)
+               + (SELECT COUNT(*) FROM seat_holds
+                  WHERE time_slot_id = ts.id AND expires_at > datetime('now')) AS taken
+        FROM time_slots ts
+        JOIN days d ON d.id = ts.day_id
+        WHERE d.date >= ?
+    """, (from_date,)):
+        existing[row["date"]]["slots"][row["time"]] = (row["id"], row["capacity_time"], row["taken"])
+    return existing
+
+
+# ── Rules ──
+
+def _dates(date_from: str, date_to: str):
+    day = date.fromisoformat(date_from)
+    end = date.fromisoformat(date_to)
+    while day <= end:
+        yield day
+        day += timedelta(days=1)
+
+
+def expand_rules(rules, date_from: str, date_to: str) -> dict[str, dict[str, int]]:
+    """{date: {time: capacity}} the rules give for dates in [date_from, date_to].
+
+    weekly rules add their times on matching weekdays (a later rule wins for
+    the same time), an override replaces that day's times, closed removes the day.
+    """
+    schedule = {}
+    for day in _dates(date_from, date_to):
+        ymd = day.isoformat()
+        times, override, closed = {}, None, False
+        for rule in rules:
+            if ymd < rule["date_from"] or (rule["date_to"] and ymd > rule["date_to"]):
+                continue
+            if rule["weekdays"] and str(day.weekday()) not in rule["weekdays"].split(","):
+                continue
+            slot_times = [t.strip() for t in (rule["times"] or "").split(",") if t.strip()]
+            if rule["kind"] == "closed":
+                closed = True
+            elif rule["kind"] == "override":
+                override = {t: rule["capacity"] for t in slot_times}
+            else:
+                times.update({t: rule["capacity"] for t in slot_times})
+        times = override if override is not None else times
+        if times and not closed:
+            schedule[ymd] = times
+    return schedule
+
+
+def available_days(persons: int) -> list[dict]:
+    """Bookable days: materialized rows plus days the rules add later in the
+    booking window. Returns [{"date", "remaining"}], sorted by date."""
+    days = [{"date": row["date"], "remaining": row["remaining"]} for row in get_available_days(persons)]
+    rules = get_schedule_rules()
+    if not rules:
+        return days
+
+    tomorrow = (date.today() + timedelta(days=1)).isoformat()
+    window_end = (date.today() + timedelta(days=BOOKING_WINDOW_DAYS)).isoformat()
+    days = [d for d in days if d["date"] <= window_end]
+    # A date with rows is shown from the rows (or not at all if it is full)
+    created = set(get_day_dates(tomorrow))
+    for ymd, times in expand_rules(rules, tomorrow, window_end).items():
+        if ymd not in created and max(times.values()) >= persons:
+            days.append({"date": ymd, "remaining": sum(times.values())})
+    days.sort(key=lambda d: d["date"])
+    return days
+
+
+def ensure_day(date_str: str) -> int | None:
+    """Id of the day's row, creating it (and its slots) from the rules on first
+    use. None if the date is not bookable."""
+    day_id = get_day_id(date_str)
+    if day_id is not None:
+        return day_id
+    today = date.today()
+    if not today.isoformat() <= date_str <= (today + timedelta(days=BOOKING_WINDOW_DAYS)).isoformat():
+        return None
+    times = expand_rules(get_schedule_rules(), date_str, date_str).get(date_str)
+    if not times:
+        return None
+    return create_day(date_str, times)
+
+
+@timed("job")
+def materialize_horizon(dry_run: bool = False) -> dict | None:
+    """Sync rows with the rules for the next SCHEDULE_HORIZON_DAYS days, and for
+    days further ahead that were already created. No-op without rules."""
+    rules = get_schedule_rules()
+    if not rules:
+        return None
+    today = date.today()
+    horizon_end = (today + timedelta(days=SCHEDULE_HORIZON_DAYS)).isoformat()
+    window_end = (today + timedelta(days=BOOKING_WINDOW_DAYS)).isoformat()
+
+    created = set(get_day_dates(horizon_end))
+    desired = {
+        ymd: times
+        for ymd, times in expand_rules(rules, today.isoformat(), window_end).items()
+        if ymd <= horizon_end or ymd in created
+    }
+    return apply_schedule(desired, remove_from=today.isoformat(), remove_to=window_end, dry_run=dry_run)
+
+
+# ── Applying ──
+
+def diff_schedule(conn, desired: dict[str, dict[str, int]], remove_from: str,
+                  remove_to: str = "9999-12-31") -> dict:
+    """Compare desired {date: {time: capacity}} with the rows.
+
+    Days and slots between `remove_from` and `remove_to` that are not desired are removed.
+    """
+    existing = _load_existing(conn, min([remove_from, *desired]) if desired else remove_from)
+    plan = {"new_days": [], "new_slots": [], "capacity": [], "remove_slots": [], "conflicts": []}
+
+    for ymd, times in sorted(desired.items()):
+        day = existing.get(ymd)
+        if day is None:
+            plan["new_days"].append((ymd, times))
+            continue
+        for slot_time, capacity in sorted(times.items()):
+            current = day["slots"].get(slot_time)
+            if current is None:
+                plan["new_slots"].append((day["id"], slot_time, capacity))
+            elif current[1] != capacity:
+                slot_id, old_capacity, taken = current
+                if taken and capacity < old_capacity:
+                    plan["conflicts"].append(f"{ymd} {slot_time}: capacity {old_capacity} -> {capacity}, slot is booked")
+                else:
+                    plan["capacity"].append((capacity, slot_id))
+
+    for ymd, day in sorted(existing.items()):
+        if not remove_from <= ymd <= remove_to:
+            continue
+        wanted = desired.get(ymd, {})
+        for slot_time, (slot_id, _, taken) in sorted(day["slots"].items()):
+            if slot_time in wanted:
+                continue
+            if taken:
+                plan["conflicts"].append(f"{ymd} {slot_time}: removal refused, slot is booked")
+            else:
+                plan["remove_slots"].append(slot_id)
+    return plan
+
+
+def _batches(items: list, size: int):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+def _write(conn, statements):
+    """Run (sql, rows) pairs in one short write transaction."""
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        for sql, rows in statements:
+            if rows:
+                conn.executemany(sql, rows)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    time.sleep(BATCH_PAUSE)
+
+
+def apply_schedule(desired: dict[str, dict[str, int]], remove_from: str | None = None,
+                   remove_to: str = "9999-12-31", dry_run: bool = False) -> dict:
+    """Bring days/time_slots to `desired` {date: {time: capacity}}.
+
+    Days and slots from `remove_from` (default today) to `remove_to` that are
+    not in `desired` are removed. Returns the plan of changes.
+    """
+    remove_from = remove_from or datetime.now().strftime("%Y-%m-%d")
+    conn = _connect()
+    try:
+        plan = diff_schedule(conn, desired, remove_from, remove_to)
+        for conflict in plan["conflicts"]:
+            logger.warning("Schedule change skipped: %s", conflict)
+        if dry_run:
+            return plan
+
+        raced = 0
+        for days in _batches(plan["new_days"], BATCH_DAYS):
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                # A day may have been created since the diff (ensure_day() for a user
+                # picking it): that one already has its slots, like create_day()
+                ids = {}
+                for ymd, times in days:
+                    row = conn.execute(
+                        "INSERT INTO days (date, capacity_day) VALUES (?, ?) "
+                        "ON CONFLICT (date) DO NOTHING RETURNING id",
+                        (ymd, sum(times.values())),
+                    ).fetchone()
+                    if row is None:
+                        raced += 1
+                    else:
+                        ids[ymd] = row["id"]
+                conn.executemany(
+                    "INSERT INTO time_slots (day_id, time, capacity_time) VALUES (?, ?, ?)",
+                    [(ids[ymd], slot_time, capacity)
+                     for ymd, times in days if ymd in ids for slot_time, capacity in sorted(times.items())],
+                )
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+            time.sleep(BATCH_PAUSE)
+
+        slot_batch = BATCH_DAYS * 4
+        for rows in _batches(plan["new_slots"], slot_batch):
+            _write(conn, [("INSERT INTO time_slots (day_id, time, capacity_time) VALUES (?, ?, ?)", rows)])
+        for rows in _batches(plan["capacity"], slot_batch):
+            _write(conn, [("UPDATE time_slots SET capacity_time = ? WHERE id = ?", rows)])
+        for rows in _batches(plan["remove_slots"], slot_batch):
+            # Re-checked inside the transaction: a booking may have arrived since the diff
+            _write(conn, [(
+                """DELETE FROM time_slots WHERE id = ?
+                   AND NOT EXISTS (SELECT 1 FROM bookings WHERE time_slot_id = time_slots.id)
+                   AND NOT EXISTS (SELECT 1 FROM seat_holds WHERE time_slot_id = time_slots.id
+                                   AND expires_at > datetime('now'))""",
+                [(slot_id,) for slot_id in rows],
+            )])
+
+        # Day capacity follows its slots; days left without slots go away
+        touched_from = min([remove_from, *desired]) if desired else remove_from
+        stats_from = max(touched_from, datetime.now().strftime("%Y-%m-%d"))
+        _write(conn, [
+            ("""UPDATE days SET capacity_day =
+                   (SELECT COALESCE(SUM(capacity_time), 0) FROM time_slots WHERE day_id = days.id)
+                WHERE date >= ?""", [(touched_from,)]),
+            ("""DELETE FROM days WHERE date BETWEEN ? AND ?
+                AND NOT EXISTS (SELECT 1 FROM time_slots WHERE day_id = days.id)
+                AND NOT EXISTS (SELECT 1 FROM bookings WHERE day_id = days.id)""", [(remove_from, remove_to)]),
+            # Stats rows take capacity only from bookings and cancels: bring it to the new
+            # schedule here, 0 for removed slots and days. Past days are history (and may be archived)
+            ("""UPDATE slot_stats SET capacity = new.capacity, updated_at = datetime('now')
+                FROM (SELECT s.date, s.time, COALESCE(ts.capacity_time, 0) AS capacity
+                      FROM slot_stats s
+                      LEFT JOIN days d ON d.date = s.date
+                      LEFT JOIN time_slots ts ON ts.day_id = d.id AND ts.time = s.time
+                      WHERE s.date >= ?1) AS new
+                WHERE slot_stats.date = new.date AND slot_stats.time = new.time
+                  AND slot_stats.capacity != new.capacity""", [(stats_from,)]),
+            ("""UPDATE day_stats SET capacity = new.capacity, updated_at = datetime('now')
+                FROM (SELECT s.date, COALESCE(d.capacity_day, 0) AS capacity
+                      FROM day_stats s
+                      LEFT JOIN days d ON d.date = s.date
+                      WHERE s.date >= ?1) AS new
+                WHERE day_stats.date = new.date AND day_stats.capacity != new.capacity""", [(stats_from,)]),
+        ])
+        if raced:
+            logger.info("Schedule: %d new days were created meanwhile, kept as they are", raced)
+        logger.info(
+            "Schedule applied: %d new days, %d new slots, %d capacity changes, %d slots removed, %d conflicts",
+            len(plan["new_days"]), len(plan["new_slots"]), len(plan["capacity"]),
+            len(plan["remove_slots"]), len(plan["conflicts"]),
+        )
+        return plan
+    finally:
+        conn.close()
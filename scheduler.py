@@ -3,12 +3,22 @@ from datetime import datetime, timedelta
 
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 
-from db import get_pending_reminders, mark_reminder_sent, claim_pending_broadcasts
-from broadcast_sender import send_broadcast
+from config import SESSION_TTL, SESSION_MAX, WAL_CHECK_INTERVAL
+from db import get_pending_reminders, mark_reminder_sent, claim_pending_broadcasts, delete_expired_holds
+from metrics import timed
+from archive import run_archival
+from backup import run_backup
+from image_store import collect_garbage
+from maintenance import wal_maintenance
+from query_trace import flush_query_stats
+from render import reminder_text
+from schedule import materialize_horizon
+from session_store import evict_idle_sessions
 
 logger = logging.getLogger("excursion_bot")
 
 
+@timed("job")
 async def send_reminders(bot):
     now = datetime.now()
     from_dt = (now + timedelta(hours=23)).strftime("%Y-%m-%d %H:%M")
@@ -17,20 +27,7 @@ async def send_reminders(bot):
     rows = get_pending_reminders(from_dt, to_dt)
 
     for r in rows:
-        text = (
-            "⏰ Напоминание о записи\n\n"
-            "Завтра у вас экскурсия в теплицы «Верёвкин Хутор» 🌷\n\n"
-            f"📅 Дата: {r['date']}\n"
-            f"🕘 Время: {r['time']}\n"
-            f"👥 Количество человек: {r['persons']}\n\n"
-            "📍 Адрес:\n"
-            "Симферопольский р-н, с. Молодёжное,\n"
-            "Московское ш., 11-й км, КрымТеплица\n\n"
-            "🗺 Яндекс Карты:\n"
-            "https://yandex.ru/maps/-/CPE3zSma\n\n"
-            "⚠️ Просим приходить вовремя.\n"
-            "При опоздании более 15 минут вход может быть ограничен."
-        )
+        text = reminder_text(r["date"], r["time"], r["persons"])
 
         try:
             await bot.send_message(chat_id=r["telegram_user_id"], text=text)
@@ -40,8 +37,13 @@ async def send_reminders(bot):
             logger.error("Failed to send reminder to user=%s: %s", r["telegram_user_id"], e)
 
 
+@timed("job")
 async def process_scheduled_broadcasts():
     rows = claim_pending_broadcasts()
+    if not rows:
+        return
+    from broadcast_sender import send_broadcast
+
     for b in rows:
         logger.info("Starting scheduled broadcast #%s", b["id"])
         await send_broadcast(b["id"])
@@ -62,5 +64,65 @@ def setup_scheduler(application):
         minutes=1,
         id="process_broadcasts",
     )
+    scheduler.add_job(
+        evict_idle_sessions,
+        "interval",
+        minutes=1,
+        args=[application, SESSION_TTL, SESSION_MAX],
+        id="evict_sessions",
+    )
+    scheduler.add_job(
+        delete_expired_holds,
+        "interval",
+        minutes=1,
+        id="delete_expired_holds",
+    )
+    scheduler.add_job(
+        flush_query_stats,
+        "interval",
+        minutes=1,
+        id="flush_query_stats",
+    )
+    scheduler.add_job(
+        materialize_horizon,
+        "interval",
+        hours=6,
+        next_run_time=datetime.now(),
+        id="materialize_schedule",
+    )
+    scheduler.add_job(
+        wal_maintenance.checkpoint,
+        "interval",
+        seconds=WAL_CHECK_INTERVAL,
+        id="wal_checkpoint",
+    )
+    scheduler.add_job(
+        wal_maintenance.optimize,
+        "cron",
+        hour=4,
+        minute=0,
+        id="db_optimize",
+    )
+    scheduler.add_job(
+        collect_garbage,
+        "cron",
+        hour=4,
+        minute=30,
+        id="collect_images",
+    )
+    scheduler.add_job(
+        run_backup,
+        "cron",
+        hour=3,
+        minute=0,
+        id="run_backup",
+    )
+    scheduler.add_job(
+        run_archival,
+        "cron",
+        hour=3,
+        minute=30,
+        id="run_archival",
+    )
     scheduler.start()
-    logger.info("Scheduler started (reminders every 30 min, broadcasts every 1 min)")
+    logger.info("Scheduler started (reminders every 30 min, broadcasts, sessions, seat holds and query stats every 1 min, WAL checkpoint every %d s, schedule every 6 h, backup, archival, optimize and image cleanup daily)", WAL_CHECK_INTERVAL)
@@ -0,0 +1,119 @@
+import logging
+import sys
+import time
+
+from metrics import Gauge, timed
+from persistence import SQLitePersistence
+
+logger = logging.getLogger("excursion_bot")
+
+
+class Session:
+    """Compact per-user dialog state, used as context.user_data.
+
+    Behaves like the small dict the handlers expect, but only the booking flow
+    fields exist and unset fields cost nothing beyond their slot.
+    """
+
+    FIELDS = ("persons", "day_id", "time_slot_id", "name", "waiting_name", "waiting_phone")
+    __slots__ = FIELDS + ("touched",)
+
+    def __init__(self):
+        for field in self.FIELDS:
+            setattr(self, field, None)
+        self.touched = time.monotonic()
+
+    def __getitem__(self, key: str):
+        self.touched = time.monotonic()
+        value = getattr(self, key, None) if key in self.FIELDS else None
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key: str, value):
+        if key not in self.FIELDS:
+            raise KeyError(key)
+        self.touched = time.monotonic()
+        setattr(self, key, value)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.FIELDS and getattr(self, key) is not None
+
+    def __len__(self) -> int:
+        return sum(1 for field in self.FIELDS if getattr(self, field) is not None)
+
+    def get(self, key: str, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def keys(self) -> list[str]:
+        return [field for field in self.FIELDS if getattr(self, field) is not None]
+
+    def update(self, data: dict):
+        for key, value in data.items():
+            if key in self.FIELDS:
+                self[key] = value
+
+    def clear(self):
+        for field in self.FIELDS:
+            setattr(self, field, None)
+        self.touched = time.monotonic()
+
+    def __repr__(self) -> str:
+        return f"Session({dict(self)!r})"
+
+    def size(self) -> int:
+        """Approximate bytes held by this session."""
+        total = sys.getsizeof(self)
+        for field in self.FIELDS:
+            value = getattr(self, field)
+            if value is not None and not isinstance(value, bool):
+                total += sys.getsizeof(value)
+        return total
+
+
+# Refreshed by evict_idle_sessions()
+SESSIONS_LIVE = Gauge("excursion_sessions_live", "Dialog sessions held in memory")
+SESSION_BYTES = Gauge("excursion_session_bytes", "Approximate memory held by dialog sessions")
+
+
+@timed("job")
+async def evict_idle_sessions(application, ttl: float, max_sessions: int) -> int:
+    """Unload sessions idle longer than `ttl` seconds, then the least recently used
+    ones above `max_sessions`. Returns the number of unloaded sessions.
+
+    Runs on the event loop, like the handlers that change user_data. Only the
+    in-memory copy goes: the user_sessions row stays and is loaded again on the
+    user's next update.
+    """
+    now = time.monotonic()
+    persistence = application.persistence
+    # Changes the Application has not handed to the persistence yet would be lost
+    tracked = isinstance(persistence, SQLitePersistence)
+    by_age = sorted(
+        ((user_id, session) for user_id, session in application.user_data.items()
+         if not (tracked and persistence.has_pending(user_id))),
+        key=lambda item: item[1].touched,
+    )
+
+    evict = [user_id for user_id, session in by_age if now - session.touched > ttl]
+    overflow = len(application.user_data) - len(evict) - max_sessions
+    if overflow > 0:
+        evict.extend(user_id for user_id, _ in by_age[len(evict):len(evict) + overflow])
+
+    for user_id in evict:
+        if tracked:
+            persistence.unload_user_data(user_id)
+        # user_data is a read-only view and drop_user_data() would also delete the
+        # row, so the in-memory copy is removed from the Application's own dict
+        application._user_data.pop(user_id, None)
+
+    live = len(application.user_data)
+    held = sum(session.size() for session in application.user_data.values())
+    SESSIONS_LIVE.set(live)
+    SESSION_BYTES.set(held)
+    if evict:
+        logger.info("Sessions unloaded: %d, live: %d (%d bytes)", len(evict), live, held)
+    return len(evict)
@@ -0,0 +1,199 @@
+"""Startup cost of the bot and the web admin.
+
+`imports` runs `python -X importtime -c "import <module>"` in a fresh
+interpreter and reports what the import costs: per module imported directly
+by it (cumulative), the heaviest modules overall (self time) and our own
+modules. `bench` starts each process from scratch several times and
+measures what a deploy costs: for the bot, the time from exec to the
+reply to the first update (fake Bot API, as in loadtest.py, with the
+phases in between); for the admin, from exec of uvicorn to the first 200.
+
+Usage:
+    python startup_profile.py imports bot [--top 15]
+    python startup_profile.py imports web_admin
+    python startup_profile.py bench [--runs 5]
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+from base64 import b64encode
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+
+# ── Import profile ──
+
+def import_times(module: str) -> list[tuple[str, int, int, int]]:
+    """[(name, depth, self_us, cumulative_us)] in import order, from -X importtime."""
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=ROOT, capture_output=True, text=True, env=_env(),
+    )
+    if result.returncode:
+        raise RuntimeError(result.stderr.strip().splitlines()[-1])
+    rows = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "[us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        rows.append((name.strip(), depth, int(self_us), int(cumulative_us)))
+    return rows
+
+
+def _own_modules() -> set[str]:
+    return {name[:-3] for name in os.listdir(ROOT) if name.endswith(".py")}
+
+
+def report_imports(module: str, top: int):
+    rows = import_times(module)
+    total = next(cumulative for name, depth, _, cumulative in rows if name == module and depth == 0)
+    print(f"import {module}: {total / 1000:.1f} ms\n")
+
+    # -X importtime prints a module after its children, so the direct children
+    # of `module` are the depth-1 rows right before it
+    end = next(i for i, (name, depth, _, _) in enumerate(rows) if name == module and depth == 0)
+    start = max((i + 1 for i, (_, depth, _, _) in enumerate(rows[:end]) if depth == 0), default=0)
+    direct = sorted((r for r in rows[start:end] if r[1] == 1), key=lambda r: r[3], reverse=True)
+    print(f"Imported by {module} (cumulative):")
+    for name, _, _, cumulative in direct[:top]:
+        print(f"  {cumulative / 1000:8.1f} ms  {name}")
+
+    print("\nHeaviest modules (self):")
+    for name, _, self_us, _ in sorted(rows, key=lambda r: r[2], reverse=True)[:top]:
+        print(f"  {self_us / 1000:8.1f} ms  {name}")
+
+    own = _own_modules()
+    print("\nOwn modules (self):")
+    for name, _, self_us, _ in sorted((r for r in rows if r[0] in own), key=lambda r: r[2], reverse=True):
+        print(f"  {self_us / 1000:8.1f} ms  {name}")
+
+
+# ── Startup benchmark ──
+
+def _env(**extra) -> dict:
+    env = dict(os.environ, PYTHONPATH=ROOT, **extra)
+    env.setdefault("BOT_TOKEN", "123456:STARTUP")
+    env.setdefault("BOT_METRICS_PORT", "0")
+    return env
+
+
+async def _bot_child():
+    """Runs in the benchmarked process: start like bot.main() and answer one /start."""
+    t0 = float(os.environ["STARTUP_T0"])
+    phases = {}
+    from loadtest import ApiRecorder, VirtualUser, make_fake_bot
+    from bot import build_application, post_init, post_shutdown
+    from db import init_db
+    from query_trace import set_source
+    phases["import"] = time.time() - t0
+
+    set_source("bot")
+    init_db()
+    phases["init_db"] = time.time() - t0
+
+    recorder = ApiRecorder(latency=0)
+    app = build_application(bot=make_fake_bot(recorder))
+    await app.initialize()
+    await post_init(app)
+    await app.start()
+    phases["ready"] = time.time() - t0
+
+    await VirtualUser(1, app, recorder, {"latency": {"start": []}, "outcomes": {}, "updates": 0}, 0).text("start", "/start")
+    phases["first_update"] = time.time() - t0
+
+    await app.stop()
+    await post_shutdown(app)
+    await app.shutdown()
+    print(json.dumps(phases))
+
+
+def bench_bot(db_path: str) -> dict:
+    env = _env(DB_PATH=db_path, STARTUP_T0=repr(time.time()))
+    result = subprocess.run(
+        [sys.executable, __file__, "_bot_child"], cwd=ROOT, env=env, capture_output=True, text=True,
+    )
+    if result.returncode:
+        raise RuntimeError(result.stderr.strip())
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def bench_admin(db_path: str, timeout: float = 30) -> dict:
+    port = _free_port()
+    request = urllib.request.Request(
+        f"http://127.0.0.1:{port}/",
+        headers={"Authorization": "Basic " + b64encode(b"admin:startup").decode()},
+    )
+    started = time.time()
+    process = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "web_admin:app", "--port", str(port), "--log-level", "warning"],
+        cwd=ROOT, env=_env(DB_PATH=db_path, ADMIN_PASSWORD="startup"),
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    try:
+        while time.time() - started < timeout:
+            try:
+                with urllib.request.urlopen(request, timeout=1) as response:
+                    if response.status == 200:
+                        return {"first_request": time.time() - started}
+            except OSError:
+                time.sleep(0.005)
+        raise RuntimeError("web admin did not answer")
+    finally:
+        process.terminate()
+        process.wait()
+
+
+def _median(values: list[float]) -> float:
+    return sorted(values)[len(values) // 2]
+
+
+def report_bench(runs: int):
+    db_path = os.path.join(tempfile.mkdtemp(prefix="startup-"), "excursions.db")
+    # Both processes start against a migrated database, as after the first deploy
+    subprocess.run([sys.executable, "migrations.py"], cwd=ROOT, env=_env(DB_PATH=db_path), check=True,
+                   capture_output=True)
+
+    for name, bench in (("bot", bench_bot), ("web admin", bench_admin)):
+        samples = [bench(db_path) for _ in range(runs)]
+        print(f"{name} ({runs} runs, median / min):")
+        for phase in samples[0]:
+            values = [sample[phase] for sample in samples]
+            print(f"  {phase:14} {_median(values) * 1000:8.0f} ms  {min(values) * 1000:8.0f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Время запуска бота и веб-админки")
+    commands = parser.add_subparsers(dest="command", required=True)
+    imports = commands.add_parser("imports")
+    imports.add_argument("module", nargs="?", default="bot")
+    imports.add_argument("--top", type=int, default=15)
+    bench = commands.add_parser("bench")
+    bench.add_argument("--runs", type=int, default=5)
+    commands.add_parser("_bot_child")
+    args = parser.parse_args()
+
+    if args.command == "imports":
+        report_imports(args.module, args.top)
+    elif args.command == "bench":
+        report_bench(args.runs)
+    else:
+        asyncio.run(_bot_child())
+
+
+if __name__ == "__main__":
+    main()
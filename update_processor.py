@@ -0,0 +1,134 @@
+import asyncio
+import inspect
+import logging
+import time
+
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+from metrics import Gauge, Histogram
+
+logger = logging.getLogger("excursion_bot")
+
+UPDATES_IN_FLIGHT = Gauge("excursion_updates_in_flight", "Updates holding a concurrency slot")
+UPDATES_WAITING = Gauge("excursion_updates_waiting", "Updates queued behind the same user's previous update")
+ACTIVE_USERS = Gauge("excursion_updates_active_users", "Users with an update being processed")
+UPDATE_WAIT = Histogram("excursion_update_wait_seconds", "Time an update waited for the same user's previous one")
+
+SLOW_WAIT_WARNING = 5.0  # seconds an update may wait behind the same user's previous one
+PENDING_PER_SLOT = 16  # updates accepted (queued or running) per concurrency slot
+
+
+def _user_key(update: object) -> int | None:
+    if not isinstance(update, Update):
+        return None
+    if update.effective_user:
+        return update.effective_user.id
+    if update.effective_chat:
+        return update.effective_chat.id
+    return None
+
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """Processes updates of different users concurrently, but updates of one user
+    strictly one after another, so the waiting_name/waiting_phone flow in
+    user_data never sees two of its own updates at once."""
+
+    def __init__(self, max_concurrent_updates: int):
+        # PTB's own semaphore only bounds how many updates are accepted at once;
+        # the concurrency slots are taken in do_process_update, after the user's lock
+        super().__init__(max_concurrent_updates * PENDING_PER_SLOT)
+        self.max_running_updates = max_concurrent_updates
+        self._slots = asyncio.BoundedSemaphore(max_concurrent_updates)
+        self._locks: dict[int, asyncio.Lock] = {}
+        self._depth: dict[int, int] = {}  # updates queued or running, per user
+
+        self.running = 0  # updates holding a concurrency slot
+        self.waiting = 0  # updates currently queued behind the same user
+        self.processed = 0
+        self.wait_seconds_total = 0.0
+        self.wait_seconds_max = 0.0
+
+    async def do_process_update(self, update: object, coroutine) -> None:
+        """Wait for the same user's previous update first and take a concurrency
+        slot only to run the handler, so one user's burst queues on its own lock
+        instead of holding slots other users need."""
+        key = _user_key(update)
+        if key is None:
+            async with self._slots:
+                await self._run(coroutine)
+            return
+
+        lock = self._locks.get(key)
+        if lock is None:
+            lock = self._locks[key] = asyncio.Lock()
+        self._depth[key] = self._depth.get(key, 0) + 1
+
+        queued_at = time.monotonic()
+        self.waiting += 1
+        self._publish()
+        queued = True
+        try:
+            async with lock:
+                self.waiting -= 1
+                queued = False
+                self._record_wait(key, time.monotonic() - queued_at)
+                async with self._slots:
+                    await self._run(coroutine)
+        finally:
+            if queued:
+                self.waiting -= 1
+            if inspect.getcoroutinestate(coroutine) == inspect.CORO_CREATED:
+                # Cancelled while queued: the handler coroutine never ran
+                coroutine.close()
+            self.processed += 1
+            depth = self._depth[key] - 1
+            if depth:
+                self._depth[key] = depth
+            else:
+                del self._depth[key]
+                del self._locks[key]
+            self._publish()
+
+    async def _run(self, coroutine) -> None:
+        self.running += 1
+        self._publish()
+        try:
+            await coroutine
+        finally:
+            self.running -= 1
+
+    def is_busy(self, user_id: int) -> bool:
+        """Whether an update of the user is queued or running."""
+        return user_id in self._depth
+
+    def _publish(self):
+        UPDATES_IN_FLIGHT.set(self.running)
+        UPDATES_WAITING.set(self.waiting)
+        ACTIVE_USERS.set(len(self._depth))
+
+    def _record_wait(self, user_id: int, waited: float):
+        self.wait_seconds_total += waited
+        UPDATE_WAIT.observe(waited)
+        if waited > self.wait_seconds_max:
+            self.wait_seconds_max = waited
+        if waited > SLOW_WAIT_WARNING:
+            logger.warning("Update of user=%s waited %.1fs behind the previous one", user_id, waited)
+
+    def stats(self) -> dict:
+        """Snapshot of queue depth and per-user wait time."""
+        return {
+            "in_flight": self.running,
+            "waiting": self.waiting,
+            "active_users": len(self._depth),
+            "max_user_depth": max(self._depth.values(), default=0),
+            "processed": self.processed,
+            "wait_seconds_avg": self.wait_seconds_total / self.processed if self.processed else 0.0,
+            "wait_seconds_max": self.wait_seconds_max,
+        }
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
@@ -0,0 +1,124 @@
+"""Event-loop lag watchdog.
+
+A heartbeat task sleeps `interval` seconds and measures how late it wakes up:
+that delay is the loop lag every other coroutine sees. A monitor thread checks
+the heartbeat; when it is late by more than the threshold, the loop thread is
+stuck in a blocking call, and the monitor captures that thread's stack while
+it is still blocked and logs it with the running task and handler.
+"""
+
+import asyncio
+import logging
+import os
+import sys
+import threading
+import time
+import traceback
+
+from config import LOOP_LAG_THRESHOLD
+from metrics import Counter, Gauge, Histogram
+
+logger = logging.getLogger("excursion_bot")
+
+LOOP_LAG = Histogram("excursion_loop_lag_seconds", "How late the event loop heartbeat woke up")
+LOOP_LAG_LAST = Gauge("excursion_loop_lag_last_seconds", "Loop lag measured by the last heartbeat")
+LOOP_STALLS = Counter("excursion_loop_stalls_total", "Event loop stalls longer than LOOP_LAG_THRESHOLD")
+
+_ROOT = os.path.dirname(os.path.abspath(__file__))
+# Wrappers that sit on every stack and say nothing about who blocked
+_SKIP_FILES = {os.path.join(_ROOT, name) for name in ("watchdog.py", "metrics.py", "query_trace.py")}
+
+
+_ASYNCIO_DIR = os.path.dirname(os.path.abspath(asyncio.__file__))
+
+
+def _own_frames(frame) -> list:
+    """Frames of this repo's modules in the running task's step, outermost first."""
+    frames = []
+    for summary in traceback.extract_stack(frame):
+        filename = os.path.abspath(summary.filename)
+        if filename.startswith(_ASYNCIO_DIR + os.sep):
+            frames = []  # everything above the loop's callback is main() / run_polling()
+        elif filename.startswith(_ROOT + os.sep) and filename not in _SKIP_FILES:
+            frames.append(summary)
+    return frames
+
+
+class LoopWatchdog:
+    def __init__(self, threshold: float = LOOP_LAG_THRESHOLD, interval: float = 0.1):
+        self.threshold = threshold
+        self.interval = interval
+        self.stalls = 0
+        self.max_lag = 0.0
+
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._loop_thread_id: int | None = None
+        self._heartbeat: asyncio.Task | None = None
+        self._monitor: threading.Thread | None = None
+        self._stopped = threading.Event()
+        self._last_beat = 0.0
+
+    def start(self):
+        if self._heartbeat is not None or self.threshold <= 0:
+            return
+        self._loop = asyncio.get_running_loop()
+        self._loop_thread_id = threading.get_ident()
+        self._last_beat = time.monotonic()
+        self._stopped.clear()
+        self._heartbeat = asyncio.create_task(self._beat(), name="loop_watchdog")
+        self._monitor = threading.Thread(target=self._watch, name="loop-watchdog", daemon=True)
+        self._monitor.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._heartbeat is not None:
+            self._heartbeat.cancel()
+            self._heartbeat = None
+        self._monitor = None
+
+    async def _beat(self):
+        while True:
+            expected = time.monotonic() + self.interval
+            await asyncio.sleep(self.interval)
+            now = time.monotonic()
+            lag = max(now - expected, 0.0)
+            self._last_beat = now
+            LOOP_LAG.observe(lag)
+            LOOP_LAG_LAST.set(lag)
+            self.max_lag = max(self.max_lag, lag)
+
+    def _watch(self):
+        reported_beat = None
+        while not self._stopped.wait(self.interval):
+            beat = self._last_beat
+            late = time.monotonic() - beat - self.interval
+            if late > self.threshold and beat != reported_beat:
+                reported_beat = beat  # one report per stall
+                self.stalls += 1
+                LOOP_STALLS.inc()
+                self._report(late)
+
+    def _report(self, late: float):
+        frame = sys._current_frames().get(self._loop_thread_id)
+        if frame is None:
+            return
+        task = asyncio.current_task(self._loop)
+        task_name = task.get_name() if task is not None else "-"
+
+        own = _own_frames(frame)
+        if own:
+            # Outermost own frame is the handler/job, innermost is where it blocks
+            handler = own[0].name
+            where = f"{os.path.basename(own[-1].filename)}:{own[-1].lineno} in {own[-1].name}"
+        else:
+            handler, where = "-", "outside the bot's modules"
+        logger.warning(
+            "Event loop blocked for %.2fs in %s (handler %s, task %s)\n%s",
+            late, where, handler, task_name, "".join(traceback.format_stack(frame)),
+        )
+
+    def stats(self) -> dict:
+        return {"stalls": self.stalls, "max_lag": self.max_lag, "threshold": self.threshold}
+
+
+loop_watchdog = LoopWatchdog()
@@ -1,26 +1,54 @@
 import asyncio
+import itertools
 import logging
-import os
 import secrets
-import uuid
+import time
+from contextlib import asynccontextmanager
+from datetime import datetime
 
-import httpx
 from fastapi import FastAPI, Request, Depends, HTTPException, Form, UploadFile, File
-from fastapi.responses import HTMLResponse, RedirectResponse
+from fastapi.responses import HTMLResponse, RedirectResponse, PlainTextResponse, StreamingResponse
 from fastapi.security import HTTPBasic, HTTPBasicCredentials
 from fastapi.templating import Jinja2Templates
 
-from config import ADMIN_PASSWORD, BOT_TOKEN, BROADCAST_UPLOAD_DIR
+from config import ADMIN_PASSWORD, BOT_TOKEN, QUERY_TOP_N
 from db import (
-    get_stats, get_bookings_by_date, get_booking_by_id, cancel_booking_by_id,
-    get_subscribers, create_broadcast, get_broadcast_history, _utc_to_msk,
+    get_stats, get_bookings_by_date, get_booking_by_id, cancel_booking_by_id, cancel_bookings,
+    get_subscribers, create_broadcast, get_broadcast_history, get_query_stats, _utc_to_msk,
+    iter_bookings, iter_subscribers, search_subscribers, search_bookings,
 )
-from broadcast_sender import send_broadcast, send_test_message
+from archive import iter_booking_history
+from export import csv_stream, xlsx_stream
 from helpers import format_day
+from image_store import save_image
+from metrics import render as render_metrics
+from query_trace import set_source, flush_query_stats
+from watchdog import loop_watchdog
 
 logger = logging.getLogger("excursion_bot")
 
-app = FastAPI(title="Excursion Admin")
+set_source("admin")
+
+
+async def _flush_query_stats_periodically():
+    while True:
+        await asyncio.sleep(60)
+        try:
+            await asyncio.to_thread(flush_query_stats)
+        except Exception as e:
+            logger.error("Failed to flush query stats: %s", e)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    task = asyncio.create_task(_flush_query_stats_periodically())
+    loop_watchdog.start()
+    yield
+    loop_watchdog.stop()
+    task.cancel()
+
+
+app = FastAPI(title="Excursion Admin", lifespan=lifespan)
 security = HTTPBasic()
 templates = Jinja2Templates(directory="templates")
 
@@ -50,6 +78,7 @@ async def index(request: Request, username: str = Depends(verify_admin)):
 async def date_view(request: Request, date: str, username: str = Depends(verify_admin)):
     bookings = get_bookings_by_date(date)
     items = []
+    slots = {}
     for b in bookings:
         items.append({
             "id": b["id"],
@@ -58,12 +87,14 @@ async def date_view(request: Request, date: str, username: str = Depends(verify_
             "persons": b["persons"],
             "time": b["time"],
         })
+        slots[b["time_slot_id"]] = b["time"]
     total = sum(b["persons"] for b in bookings)
     return templates.TemplateResponse("date.html", {
         "request": request,
         "date": date,
         "date_fmt": format_day(date),
         "bookings": items,
+        "slots": sorted(slots.items(), key=lambda item: item[1]),
         "total": total,
     })
 
@@ -86,6 +117,8 @@ async def cancel_booking(booking_id: int, username: str = Depends(verify_admin))
         f"❌ Ваша запись на экскурсию {date_fmt} в {time_str} "
         "отменена администратором.\nВы можете записаться снова."
     )
+    import httpx
+
     try:
         async with httpx.AsyncClient() as client:
             await client.post(
@@ -99,6 +132,99 @@ async def cancel_booking(booking_id: int, username: str = Depends(verify_admin))
     return RedirectResponse(url=f"/date/{booking['date']}", status_code=303)
 
 
+# ── Bulk cancellation ──
+
+# job_id -> progress of the background notifications; only the latest jobs are kept
+cancel_jobs: dict[int, dict] = {}
+_cancel_job_ids = itertools.count(1)
+MAX_CANCEL_JOBS = 20
+
+
+def _start_cancel_job(cancelled: list[dict], scope: str) -> int:
+    job_id = next(_cancel_job_ids)
+    messages = [
+        (b["telegram_user_id"],
+         f"❌ Ваша запись на экскурсию {format_day(b['date'])} в {b['time']} "
+         "отменена администратором.\nВы можете записаться снова.")
+        for b in cancelled
+    ]
+    job = {
+        "id": job_id,
+        "scope": scope,
+        "date": cancelled[0]["date"] if cancelled else None,
+        "cancelled": len(cancelled),
+        "persons": sum(b["persons"] for b in cancelled),
+        "total": len(messages),
+        "sent": 0,
+        "failed": 0,
+        "done": False,
+        "started": time.monotonic(),
+        "elapsed": 0.0,
+    }
+
+    async def run():
+        from broadcast_sender import send_notifications
+
+        try:
+            await send_notifications(messages, job)
+        except Exception as e:
+            logger.error("Cancel job #%s notifications failed: %s", job_id, e)
+        finally:
+            job["done"] = True
+            job["elapsed"] = time.monotonic() - job["started"]
+            logger.info("Cancel job #%s: %d/%d users notified", job_id, job["sent"], job["total"])
+
+    job["task"] = asyncio.create_task(run())
+    cancel_jobs[job_id] = job
+    for old_id in sorted(cancel_jobs)[:-MAX_CANCEL_JOBS]:
+        if cancel_jobs[old_id]["done"]:
+            del cancel_jobs[old_id]
+    return job_id
+
+
+def _valid_date(value: str) -> str:
+    """`value` if it is a date as YYYY-MM-DD, otherwise a 400."""
+    try:
+        if datetime.strptime(value, "%Y-%m-%d").date().isoformat() == value:
+            return value
+    except ValueError:
+        pass
+    raise HTTPException(status_code=400, detail="date must be YYYY-MM-DD")
+
+
+# cancel_bookings() waits for the write lock and writes stats and events: off the event loop
+
+@app.post("/cancel-slot/{time_slot_id}")
+async def cancel_slot(time_slot_id: int, username: str = Depends(verify_admin)):
+    cancelled = await asyncio.to_thread(cancel_bookings, time_slot_id=time_slot_id)
+    logger.info("Admin cancelled %d bookings of slot #%s via web", len(cancelled), time_slot_id)
+    job_id = _start_cancel_job(cancelled, "slot")
+    return RedirectResponse(url=f"/cancel-jobs/{job_id}", status_code=303)
+
+
+@app.post("/cancel-date/{date}")
+async def cancel_date(date: str, username: str = Depends(verify_admin)):
+    cancelled = await asyncio.to_thread(cancel_bookings, date_str=_valid_date(date))
+    logger.info("Admin cancelled %d bookings on %s via web", len(cancelled), date)
+    job_id = _start_cancel_job(cancelled, "date")
+    return RedirectResponse(url=f"/cancel-jobs/{job_id}", status_code=303)
+
+
+@app.get("/cancel-jobs/{job_id}", response_class=HTMLResponse)
+async def cancel_job_view(request: Request, job_id: int, username: str = Depends(verify_admin)):
+    job = cancel_jobs.get(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Job not found")
+    elapsed = job["elapsed"] if job["done"] else time.monotonic() - job["started"]
+    return templates.TemplateResponse("cancel_job.html", {
+        "request": request,
+        "job": job,
+        "date_fmt": format_day(job["date"]) if job["date"] else "",
+        "pct": int((job["sent"] + job["failed"]) / job["total"] * 100) if job["total"] else 100,
+        "elapsed": round(elapsed, 1),
+    })
+
+
 @app.get("/subscribers", response_class=HTMLResponse)
 async def subscribers_view(request: Request, filter: str = "all", username: str = Depends(verify_admin)):
     rows = get_subscribers(filter)
@@ -120,6 +246,86 @@ async def subscribers_view(request: Request, filter: str = "all", username: str
     })
 
 
+# ── Search ──
+
+SEARCH_PAGE_SIZE = 50
+
+
+@app.get("/search", response_class=HTMLResponse)
+async def search_view(request: Request, q: str = "", scope: str = "subscribers", page: int = 1,
+                      username: str = Depends(verify_admin)):
+    page = max(page, 1)
+    offset = (page - 1) * SEARCH_PAGE_SIZE
+    if scope == "bookings":
+        rows, total = search_bookings(q, SEARCH_PAGE_SIZE, offset)
+        results = [{
+            "date": r["date"],
+            "date_fmt": format_day(r["date"]),
+            "time": r["time"],
+            "name": r["name"],
+            "phone": r["phone"] or "—",
+            "persons": r["persons"],
+        } for r in rows]
+    else:
+        scope = "subscribers"
+        rows, total = search_subscribers(q, SEARCH_PAGE_SIZE, offset)
+        results = [{
+            "first_name": r["first_name"] or "",
+            "last_name": r["last_name"] or "",
+            "username": r["username"] or "",
+            "phone": r["phone"] or "—",
+            "status": r["status"],
+            "created_at": r["created_at"][:10] if r["created_at"] else "",
+        } for r in rows]
+    return templates.TemplateResponse("search.html", {
+        "request": request,
+        "q": q,
+        "scope": scope,
+        "query_ok": total is not None,
+        "results": results,
+        "total": total or 0,
+        "page": page,
+        "pages": max(((total or 0) + SEARCH_PAGE_SIZE - 1) // SEARCH_PAGE_SIZE, 1),
+    })
+
+
+# ── Export ──
+
+BOOKING_COLUMNS = ["ID", "Дата", "Время", "Имя", "Телефон", "Человек", "Telegram ID", "Создана", "Статус"]
+SUBSCRIBER_COLUMNS = ["Telegram ID", "Username", "Имя", "Фамилия", "Телефон", "Статус", "Дата входа", "Обновлён"]
+
+
+def _export_response(columns: list[str], rows, name: str, fmt: str) -> StreamingResponse:
+    if fmt == "xlsx":
+        body = xlsx_stream(columns, rows, sheet_name=name)
+        media_type = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+    elif fmt == "csv":
+        body = csv_stream(columns, rows)
+        media_type = "text/csv; charset=utf-8"
+    else:
+        raise HTTPException(status_code=400, detail="format must be csv or xlsx")
+    return StreamingResponse(body, media_type=media_type, headers={
+        "Content-Disposition": f'attachment; filename="{name}.{fmt}"',
+    })
+
+
+@app.get("/export/bookings")
+async def export_bookings(format: str = "csv", date_from: str | None = None, date_to: str | None = None,
+                          status: str = "active", username: str = Depends(verify_admin)):
+    if status == "history":
+        rows = iter_booking_history(date_from, date_to)
+    else:
+        rows = iter_bookings(date_from, date_to, status)
+    return _export_response(BOOKING_COLUMNS, rows, "bookings", format)
+
+
+@app.get("/export/subscribers")
+async def export_subscribers(format: str = "csv", filter: str = "all", date_from: str | None = None,
+                             date_to: str | None = None, username: str = Depends(verify_admin)):
+    rows = iter_subscribers(filter, date_from, date_to)
+    return _export_response(SUBSCRIBER_COLUMNS, rows, "subscribers", format)
+
+
 # ── Broadcast ──
 
 @app.get("/broadcast", response_class=HTMLResponse)
@@ -138,24 +344,9 @@ async def broadcast_create(
     image: UploadFile = File(None),
     username: str = Depends(verify_admin),
 ):
-    # Save image if provided (resize if too large for Telegram)
     image_path = None
     if image and image.filename:
-        os.makedirs(BROADCAST_UPLOAD_DIR, exist_ok=True)
-        filename = f"{uuid.uuid4().hex}.jpg"
-        image_path = os.path.join(BROADCAST_UPLOAD_DIR, filename)
-        content = await image.read()
-
-        from PIL import Image
-        import io
-        img = Image.open(io.BytesIO(content))
-        if img.mode in ("RGBA", "P"):
-            img = img.convert("RGB")
-        # Telegram limit: width+height <= 10000, each side <= 5000
-        max_side = 2000
-        if img.width > max_side or img.height > max_side:
-            img.thumbnail((max_side, max_side), Image.LANCZOS)
-        img.save(image_path, "JPEG", quality=90)
+        image_path = await asyncio.to_thread(save_image, await image.read())
 
     schedule_dt = None
     if send_mode == "scheduled" and scheduled_at:
@@ -173,6 +364,8 @@ async def broadcast_create(
     )
 
     if send_mode == "now":
+        from broadcast_sender import send_broadcast
+
         asyncio.create_task(send_broadcast(broadcast_id))
         logger.info("Broadcast #%s started immediately", broadcast_id)
     else:
@@ -191,23 +384,9 @@ async def broadcast_test(
     image: UploadFile = File(None),
     username: str = Depends(verify_admin),
 ):
-    # Save image if provided
     image_path = None
     if image and image.filename:
-        os.makedirs(BROADCAST_UPLOAD_DIR, exist_ok=True)
-        filename = f"{uuid.uuid4().hex}.jpg"
-        image_path = os.path.join(BROADCAST_UPLOAD_DIR, filename)
-        content = await image.read()
-
-        from PIL import Image
-        import io
-        img = Image.open(io.BytesIO(content))
-        if img.mode in ("RGBA", "P"):
-            img = img.convert("RGB")
-        max_side = 2000
-        if img.width > max_side or img.height > max_side:
-            img.thumbnail((max_side, max_side), Image.LANCZOS)
-        img.save(image_path, "JPEG", quality=90)
+        image_path = await asyncio.to_thread(save_image, await image.read())
 
     try:
         uid = int(test_user_id.strip())
@@ -219,6 +398,8 @@ async def broadcast_test(
     btn_text = button_text.strip() or None
     btn_url = button_url.strip() or None
 
+    from broadcast_sender import send_test_message
+
     ok, err = await send_test_message(text, image_path, btn_text, btn_url, uid)
     if ok:
         return templates.TemplateResponse("broadcast.html", {
@@ -250,3 +431,32 @@ async def broadcast_history_view(request: Request, username: str = Depends(verif
         "request": request,
         "broadcasts": broadcasts,
     })
+
+
+@app.get("/queries", response_class=HTMLResponse)
+async def queries_view(request: Request, username: str = Depends(verify_admin)):
+    flush_query_stats()
+    rows = get_query_stats(QUERY_TOP_N)
+    queries = []
+    for q in rows:
+        queries.append({
+            "source": q["source"],
+            "sql": q["fingerprint"],
+            "calls": q["calls"],
+            "avg_ms": round(q["avg_ms"], 1),
+            "max_ms": round(q["max_ms"], 1),
+            "total_ms": round(q["total_ms"]),
+            "rows": q["rows"],
+            "slow_calls": q["slow_calls"],
+            "plan": q["plan"] or "",
+            "updated_at": q["updated_at"],
+        })
+    return templates.TemplateResponse("queries.html", {
+        "request": request,
+        "queries": queries,
+    })
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def metrics_view(username: str = Depends(verify_admin)):
+    return PlainTextResponse(render_metrics(), media_type="text/plain; version=0.0.4")